@@ -0,0 +1,11 @@
+"""
+Benchmarks run as modules, eg. `python -m benchmarks.suite`, and the fakes they share with the tests
+
+Nothing connects to Discord or MongoDB, so the `config` module the bot imports is stubbed if there is none
+"""
+from types import SimpleNamespace
+import importlib.util
+import sys
+
+if importlib.util.find_spec('config') is None:
+    sys.modules['config'] = SimpleNamespace(TOKEN=None, MONGO_URI='memory://')
@@ -0,0 +1,142 @@
+"""
+How long a change made by one process takes to be applied by another, through the change feed
+
+    python -m benchmarks.changes --count 1000
+    python -m benchmarks.changes --mongo-uri mongodb://localhost:27017/?replicaSet=rs0
+
+Two bots share the same database, `A` writes and `B` applies:
+
+- config update: A updates a guild config, until B serves the new prefix
+- giveaway create: A stores a new giveaway, until B runs it
+- giveaway delete: A deletes it like a finish does, until B stops running it
+- burst: A updates `count` configs at once, until B applied all of them
+
+Without the feed, B serves the old prefix until its cached config expires (CONFIG_CACHE_TTL, 10 minutes
+by default) and never runs the giveaways created by A
+"""
+from datetime import datetime, timedelta
+import argparse
+import asyncio
+import time
+import uuid
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from benchmarks.fakes import FakeBot
+from benchmarks.memorydb import MemoryClient
+from cogs.giveaway import GiveawayCog
+
+TIMEOUT = 10
+
+
+class Arrivals:
+    "Tells when B applied a change to a given document"
+    def __init__(self, bot: FakeBot):
+        self.waiting = {}
+        for collection in ('guilds', 'giveaways'):
+            bot.changes.subscribe(collection, self.applied)
+
+    def applied(self, change):
+        future = self.waiting.pop((change.collection, change.key, change.operation), None)
+        if future is not None and not future.done():
+            future.set_result(time.perf_counter())
+
+    async def timed(self, collection: str, key: int, operation: str, write) -> float:
+        "Returns the time between `write()` being called and its change being applied by B"
+        future = self.waiting[collection, key, operation] = asyncio.get_event_loop().create_future()
+        start = time.perf_counter()
+        await write()
+        return await asyncio.wait_for(future, TIMEOUT) - start
+
+
+def quantiles(samples: list) -> str:
+    samples = sorted(samples)
+    p50, p99 = samples[len(samples) // 2], samples[min(int(len(samples) * 0.99), len(samples) - 1)]
+    return f'p50 {p50 * 1000:7.3f}ms  p99 {p99 * 1000:7.3f}ms'
+
+
+async def run(args):
+    name = 'dpy'
+    if args.mongo_uri:
+        # Separate clients, like separate processes
+        clients = AsyncIOMotorClient(args.mongo_uri), AsyncIOMotorClient(args.mongo_uri)
+        name = f'changes_{uuid.uuid4().hex[:8]}'
+    else:
+        client = MemoryClient()
+        clients = client, client
+
+    a = FakeBot(guilds=10, channels=2, latency=0.001, client=clients[0], name=name)
+    b = FakeBot(guilds=10, channels=2, latency=0.001, client=clients[1], name=name)
+    await a.connect()
+    await b.connect()
+    for guild in a.guilds:
+        await a.storage.update_config(guild.id, {'prefix': '?'})
+    await b.changes.open()
+    cog = GiveawayCog(b)
+    while not cog.scheduler.running:
+        await asyncio.sleep(0.01)
+    b.changes.start()
+    arrivals = Arrivals(b)
+    # B serves every guild from its cache
+    await b.configs.warm()
+
+    results = {'config update': [], 'giveaway create': [], 'giveaway delete': []}
+    stale = missed = 0
+    for i in range(args.count):
+        guild = b.guilds[i % len(b.guilds)]
+        prefix = f'?{i}'
+        results['config update'].append(await arrivals.timed(
+            'guilds', guild.id, 'update', lambda: a.storage.update_config(guild.id, {'prefix': prefix})
+        ))
+        stale += (b.configs.peek(guild.id) or {}).get('prefix') != prefix
+
+        messageID = a.http.next_id()
+        data = {
+            'authorID': 1, 'channelID': guild.channels[0].id, 'guildID': guild.id, 'messageID': messageID,
+            'title': 'Nitro', 'endsat': datetime.utcnow() + timedelta(hours=1), 'winners': 1, 'entrants': []
+        }
+        results['giveaway create'].append(await arrivals.timed(
+            'giveaways', messageID, 'insert', lambda: a.storage.insert_giveaway(data)
+        ))
+        missed += b.get_guild(guild.id) is not None and cog.running.get(messageID) is None
+
+        async def delete():
+            a.writer.delete('giveaways', {'messageID': messageID})
+            await a.writer.flush()
+        results['giveaway delete'].append(await arrivals.timed('giveaways', messageID, 'delete', delete))
+        missed += cog.running.get(messageID) is not None
+
+    applied = b.metrics.get('changes_applied_total')
+    before = applied.get(collection='guilds', operation='update')
+    start = time.perf_counter()
+    await asyncio.gather(*[a.storage.update_config(b.guilds[i % len(b.guilds)].id, {'prefix': f'!{i}'}) for i in range(args.count)])
+    while applied.get(collection='guilds', operation='update') < before + args.count and time.perf_counter() - start < TIMEOUT:
+        await asyncio.sleep(0.001)
+    burst = time.perf_counter() - start
+
+    print('memory' if not args.mongo_uri else 'mongo')
+    for operation, samples in results.items():
+        print(f'  {operation:<16} {quantiles(samples)}')
+    print(f'  {"burst":<16} {args.count} changes applied in {burst * 1000:.1f}ms ({args.count / burst:,.0f}/s)')
+    lag = b.metrics.get('change_propagation_seconds')
+    print(f'  {"feed lag":<16} configs p99 {lag.quantile(0.99, collection="guilds") * 1000:.1f}ms, '
+          f'giveaways p99 {lag.quantile(0.99, collection="giveaways") * 1000:.1f}ms (stored to applied, as reported by B)')
+    print(f'  stale configs after an update: {stale}, giveaways not created / deleted: {missed}')
+
+    cog.cog_unload()
+    await a.close()
+    await b.close()
+    if args.mongo_uri:
+        await clients[0].drop_database(name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=1000, help='Changes measured per kind of change')
+    parser.add_argument('--mongo-uri', help='Uses this MongoDB replica set instead, in a throwaway database')
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
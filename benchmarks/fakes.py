@@ -0,0 +1,259 @@
+"""
+In-memory stand-ins for Discord used by the benchmarks
+
+`FakeHTTP` models the routes used by the bot with per route buckets (keyed by the major
+parameter like Discord does), a global limit and random latency. Like discord.py, requests
+wait for their bucket to reset instead of failing, the waits are counted per route.
+MongoDB is replaced by an in-memory `Database`
+"""
+from bisect import bisect_right
+from collections import Counter
+from types import SimpleNamespace
+import asyncio
+import itertools
+import random
+
+import discord
+
+from cogs.utils.changes import ChangeFeed
+from cogs.utils.configs import GuildConfigCache
+from cogs.utils.database import Database
+from cogs.utils.metrics import Registry
+from cogs.utils.persistence import WriteBehindQueue
+from cogs.utils.startup import StartupReport
+from cogs.utils.storage import MongoStorage
+
+BOT_ID = 543796400165748736
+
+# route -> (requests, per seconds), roughly what Discord returns in its headers
+ROUTES = {
+    'send_message': (5, 5),
+    'edit_message': (5, 5),
+    'delete_message': (5, 1),
+    'get_message': (50, 1),
+    'get_reaction_users': (10, 1),
+    'get_member': (10, 1),
+    'query_members': (120, 60),
+}
+
+
+class FakeHTTP:
+    def __init__(self, *, latency: float = 0.05, global_limit: int = 50):
+        self.latency = latency
+        self.global_limit = global_limit
+        self.calls = Counter()
+        self.waits = Counter()
+        self.reactions = {}
+
+        self._buckets = {}
+        self._global = [global_limit, 0]
+        self._ids = itertools.count(10 ** 17)
+
+    async def _request(self, route: str, major: int):
+        loop = asyncio.get_event_loop()
+        limit, per = ROUTES[route]
+        while True:
+            now = loop.time()
+            bucket = self._buckets.get((route, major))
+            if bucket is None or bucket[1] <= now:
+                bucket = self._buckets[route, major] = [limit, now + per]
+            if self._global[1] <= now:
+                self._global = [self.global_limit, now + 1]
+
+            if bucket[0] > 0 and self._global[0] > 0:
+                bucket[0] -= 1
+                self._global[0] -= 1
+                break
+
+            self.waits[route] += 1
+            await asyncio.sleep(max(min(bucket[1], self._global[1]) - now, 0.001))
+
+        await asyncio.sleep(self.latency * (0.5 + random.random()))
+        self.calls[route] += 1
+
+    def next_id(self) -> int:
+        return next(self._ids)
+
+    async def send_message(self, channelID: int, content: str = None, *, embed: dict = None) -> dict:
+        await self._request('send_message', channelID)
+        return {'id': self.next_id(), 'channel_id': channelID, 'content': content, 'embeds': [embed] if embed else []}
+
+    async def edit_message(self, channelID: int, messageID: int, **fields) -> dict:
+        await self._request('edit_message', channelID)
+        return dict(fields, id=messageID, channel_id=channelID)
+
+    async def delete_message(self, channelID: int, messageID: int, *, reason=None):
+        await self._request('delete_message', channelID)
+
+    async def get_message(self, channelID: int, messageID: int) -> dict:
+        await self._request('get_message', channelID)
+        return {'id': messageID, 'channel_id': channelID}
+
+    async def get_reaction_users(self, channelID: int, messageID: int, emoji: str, limit: int, after=None) -> list:
+        "Pages through `reactions[messageID]`, a sorted list of user ids"
+        await self._request('get_reaction_users', channelID)
+        users = self.reactions.get(messageID, [])
+        start = 0 if after is None else bisect_right(users, int(after))
+        return [{'id': str(userID), 'bot': False} for userID in users[start:start + limit]]
+
+    async def get_member(self, guildID: int, userID: int) -> dict:
+        await self._request('get_member', guildID)
+        return {'user': {'id': str(userID), 'bot': False}, 'roles': []}
+
+
+class FakeMember(discord.Member):
+    "A member holding only what eligibility checks read"
+    __slots__ = ()
+    roles = ()
+
+    def __init__(self, id: int, bot: bool = False):
+        self._user = SimpleNamespace(id=id, bot=bot)
+
+
+class FakeGuild:
+    def __init__(self, http: FakeHTTP, id: int, *, members: int = 0, large: bool = False):
+        self.http = http
+        self.id = id
+        self.shard_id = 0
+        self.large = large
+        self.chunked = not large
+        self.members = {self.id + i: FakeMember(self.id + i) for i in range(members)}
+        self.member_count = len(self.members)
+        self.channels = []
+
+    def get_member(self, userID: int):
+        return self.members.get(userID)
+
+    async def query_members(self, *, user_ids, limit: int, cache: bool = True) -> list:
+        await self.http._request('query_members', self.id)
+        return [self.members[u] for u in user_ids if u in self.members]
+
+
+class FakeReaction:
+    def __init__(self, http: FakeHTTP, channelID: int, messageID: int):
+        self.http = http
+        self.emoji = '🎉'
+        self.channelID = channelID
+        self.messageID = messageID
+
+    async def users(self):
+        after = None
+        while True:
+            page = await self.http.get_reaction_users(self.channelID, self.messageID, self.emoji, 100, after=after)
+            for data in page:
+                yield FakeMember(int(data['id']))
+            if len(page) < 100:
+                return
+            after = page[-1]['id']
+
+
+class FakeMessage:
+    def __init__(self, channel, data: dict):
+        self.channel = channel
+        self.id = data['id']
+        self.embeds = [discord.Embed.from_dict(e) for e in data.get('embeds', [])]
+        self.reactions = [FakeReaction(channel.http, channel.id, self.id)]
+        self.author = SimpleNamespace(id=BOT_ID)
+
+    async def edit(self, *, content=None, embed=None):
+        await self.channel.http.edit_message(self.channel.id, self.id, content=content, embed=embed and embed.to_dict())
+
+    async def delete(self):
+        await self.channel.http.delete_message(self.channel.id, self.id)
+
+
+class FakeChannel:
+    def __init__(self, http: FakeHTTP, id: int, guild: FakeGuild):
+        self.http = http
+        self.id = id
+        self.guild = guild
+
+    async def send(self, content: str = None, *, embed: discord.Embed = None) -> FakeMessage:
+        data = await self.http.send_message(self.id, content, embed=embed and embed.to_dict())
+        return FakeMessage(self, data)
+
+    async def fetch_message(self, messageID: int) -> FakeMessage:
+        return FakeMessage(self, await self.http.get_message(self.id, messageID))
+
+
+class FakeBot:
+    """
+    The parts of `GiveawaySnake` used by the cogs, with `guilds` guilds of
+    `channels` channels and `members` cached members each
+
+    Bots given the same `client` (and database `name`) share their data like separate processes would
+    """
+    def __init__(self, *, guilds: int = 100, channels: int = 10, members: int = 0,
+                 latency: float = 0.05, global_limit: int = 50, client=None, name: str = 'dpy'):
+        self.loop = asyncio.get_event_loop()
+        self.user = SimpleNamespace(id=BOT_ID)
+        self.http = FakeHTTP(latency=latency, global_limit=global_limit)
+
+        self.worker_concurrency = 10
+        self.channel_concurrency = 2
+        self.edit_budget = 30
+        self.warmup_concurrency = 0
+        self.lease_duration = None
+        self.instance_id = 'benchmark'
+        self.shard_ids = None
+        self.shard_count = None
+        self.metrics = Registry()
+        self.startup = StartupReport(self.metrics)
+
+        self.database = Database('memory://', self.metrics, self.loop, name=name, client=client)
+        self.storage = MongoStorage(self.database)
+        self.writer = WriteBehindQueue(self.storage)
+        self.writer.start()
+        self.configs = GuildConfigCache(self.storage)
+        self.changes = ChangeFeed(self.storage, self.metrics)
+        self.changes.subscribe('guilds', self.configs.apply)
+        self.configs.set_user(BOT_ID)
+
+        self.guilds = []
+        self.channels = []
+        self._guilds = {}
+        self._channels = {}
+        for i in range(guilds):
+            guild = FakeGuild(self.http, (i + 1) << 32, members=members)
+            for j in range(channels):
+                channel = FakeChannel(self.http, guild.id + (1 << 31) + j, guild)
+                guild.channels.append(channel)
+                self.channels.append(channel)
+                self._channels[channel.id] = channel
+            self.guilds.append(guild)
+            self._guilds[guild.id] = guild
+
+    async def connect(self):
+        "Does what the startup does with the storage"
+        await self.storage.setup()
+
+    def shard_of(self, guildID: int) -> int:
+        return 0
+
+    def owns_guild(self, guildID: int) -> bool:
+        return True
+
+    def get_guild(self, guildID: int):
+        return self._guilds.get(guildID)
+
+    def get_channel(self, channelID: int):
+        return self._channels.get(channelID)
+
+    def get_user(self, userID: int):
+        return None
+
+    async def fetch_channel(self, channelID: int):
+        return self._channels[channelID]
+
+    async def wait_until_ready(self):
+        pass
+
+    async def request_offline_members(self, *guilds):
+        for guild in guilds:
+            await asyncio.sleep(self.http.latency * len(guild.members) / 1000)
+            guild.chunked = True
+
+    async def close(self):
+        await self.changes.close()
+        await self.writer.close()
+        await self.storage.close()
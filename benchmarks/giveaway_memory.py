@@ -0,0 +1,82 @@
+"""
+Memory retained per running giveaway, by the compact Giveaway and by the previous class
+
+    python -m benchmarks.giveaway_memory --giveaways 10000
+"""
+from datetime import datetime, timedelta
+import argparse
+import asyncio
+import random
+import tracemalloc
+
+from cogs.giveaway import Giveaway
+
+from .fakes import FakeBot, FakeMessage
+
+
+class LegacyGiveaway:
+    "The attributes the giveaway class held before it was made compact"
+    def __init__(self, bot, **data):
+        self.bot = bot
+        self.authorID = data.get('authorID')
+        self.channelID = data.get('channelID')
+        self.messageID = data.get('messageID', None)
+        self.title = data.get('title')
+        self.endsat = data.get('endsat')
+        self.winners = data.get('winners')
+
+        self.channel = self.bot.get_channel(self.channelID)
+        self.guildID = data.get('guildID') or getattr(getattr(self.channel, 'guild', None), 'id', None)
+        self.author = self.bot.get_user(self.authorID)
+        self.finished = False
+        self.message = None
+        self.next_refresh = self.endsat - timedelta(seconds=random.randrange(60))
+
+
+def measure(build, documents: list) -> float:
+    "Returns the bytes retained per object built"
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objects = [build(data) for data in documents]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    del objects
+    return size / len(documents)
+
+
+def main(args):
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    bot = FakeBot(guilds=10, channels=100)
+    now = datetime.utcnow()
+    documents = []
+    for _ in range(args.giveaways):
+        channel = random.choice(bot.channels)
+        documents.append({
+            'authorID': random.getrandbits(60), 'channelID': channel.id, 'guildID': channel.guild.id,
+            'messageID': bot.http.next_id(), 'title': 'Nitro Classic', 'winners': 1,
+            'endsat': now + timedelta(seconds=random.uniform(60, 14 * 86400))
+        })
+
+    def fetched(data):
+        giveaway = LegacyGiveaway(bot, **data)
+        # Kept after finishing through reactions or warming up, a real discord.Message holds much more
+        giveaway.message = FakeMessage(giveaway.channel, {'id': giveaway.messageID})
+        return giveaway
+
+    # The documents are built before measuring, only what the giveaways add is counted
+    compact = measure(lambda data: Giveaway(bot, **data), documents)
+    legacy = measure(lambda data: LegacyGiveaway(bot, **data), documents)
+    legacy_fetched = measure(fetched, documents)
+
+    print(f'{args.giveaways} giveaways, bytes retained per giveaway')
+    print(f'compact:                 {compact:8.0f}')
+    print(f'previous:                {legacy:8.0f} ({1 - compact / legacy:.0%} saved)')
+    print(f'previous, message kept:  {legacy_fetched:8.0f} ({1 - compact / legacy_fetched:.0%} saved)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--giveaways', type=int, default=10000)
+    main(parser.parse_args())
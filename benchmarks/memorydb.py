@@ -0,0 +1,543 @@
+"""
+In-memory stand-in for the parts of the motor API used by the bot, for development and tests
+
+Used when MONGO_URI is `memory://`, which is handy for local development and for
+running several bot instances in the same process without a mongodb server
+(assign the same MemoryClient to `bot.client` of each instance before starting them).
+Changes can be watched like with a replica set, so instances sharing a client see each other's writes.
+Nothing is persisted, and only the query and update operators used by the bot are supported
+"""
+from collections import deque
+from copy import deepcopy
+from datetime import datetime, timedelta
+import asyncio
+import itertools
+import time
+
+from bson.timestamp import Timestamp
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.results import BulkWriteResult, DeleteResult, InsertOneResult, UpdateResult
+
+MISSING = object()
+# Changes kept for change streams to resume from, bounded like the oplog
+CHANGE_HISTORY = 10000
+
+
+def get_field(document: dict, path: str):
+    "Returns the value at a dotted path, MISSING if it does not exist"
+    value = document
+    for part in path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return MISSING
+        value = value[part]
+    return value
+
+
+def set_field(document: dict, path: str, value):
+    *parents, last = path.split('.')
+    for part in parents:
+        document = document.setdefault(part, {})
+    document[last] = value
+
+
+def unset_field(document: dict, path: str):
+    *parents, last = path.split('.')
+    for part in parents:
+        document = document.get(part)
+        if not isinstance(document, dict):
+            return
+    document.pop(last, None)
+
+
+def _compare(value, op: str, arg) -> bool:
+    if op == '$exists':
+        return (value is not MISSING) == bool(arg)
+    if op == '$ne':
+        return not _compare(value, '$eq', arg)
+    if op == '$nin':
+        return not _compare(value, '$in', arg)
+
+    values = value if isinstance(value, list) else [value]
+    if op == '$eq':
+        return value == arg or arg in values or (arg is None and value is MISSING)
+    if op == '$in':
+        return any(v in arg for v in values)
+    if value is MISSING or value is None:
+        return False
+    try:
+        if op == '$lt':
+            return value < arg
+        if op == '$lte':
+            return value <= arg
+        if op == '$gt':
+            return value > arg
+        if op == '$gte':
+            return value >= arg
+    except TypeError:
+        return False
+
+    raise NotImplementedError(f'Unsupported query operator {op}')
+
+
+def matches(document: dict, query: dict) -> bool:
+    "Checks whether a document matches a query"
+    for key, condition in query.items():
+        if key == '$or':
+            if not any(matches(document, q) for q in condition):
+                return False
+        elif key == '$and':
+            if not all(matches(document, q) for q in condition):
+                return False
+        elif isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+            value = get_field(document, key)
+            if not all(_compare(value, op, arg) for op, arg in condition.items()):
+                return False
+        elif not _compare(get_field(document, key), '$eq', condition):
+            return False
+
+    return True
+
+
+def apply_update(document: dict, update: dict):
+    "Applies update operators to a document in place, `$setOnInsert` is only applied by upserts"
+    for op, fields in update.items():
+        if op == '$setOnInsert':
+            continue
+        for path, arg in fields.items():
+            if op == '$set':
+                set_field(document, path, deepcopy(arg))
+            elif op == '$unset':
+                unset_field(document, path)
+            elif op == '$inc':
+                current = get_field(document, path)
+                set_field(document, path, (0 if current is MISSING else current) + arg)
+            elif op == '$addToSet':
+                current = get_field(document, path)
+                if current is MISSING:
+                    current = []
+                    set_field(document, path, current)
+                for item in (arg['$each'] if isinstance(arg, dict) and '$each' in arg else [arg]):
+                    if item not in current:
+                        current.append(item)
+            elif op == '$pull':
+                current = get_field(document, path)
+                if isinstance(current, list):
+                    removed = arg['$in'] if isinstance(arg, dict) and '$in' in arg else [arg]
+                    current[:] = [item for item in current if item not in removed]
+            else:
+                raise NotImplementedError(f'Unsupported update operator {op}')
+
+
+def project(document: dict, projection: dict) -> dict:
+    "Returns a copy of the document with only the projected fields"
+    if not projection:
+        return deepcopy(document)
+
+    included = [k for k, v in projection.items() if v and k != '_id']
+    if included:
+        result = {}
+        for path in included:
+            value = get_field(document, path)
+            if value is not MISSING:
+                set_field(result, path, deepcopy(value))
+        if projection.get('_id', 1) and '_id' in document:
+            result['_id'] = document['_id']
+        return result
+
+    result = deepcopy(document)
+    for path, value in projection.items():
+        if not value:
+            unset_field(result, path)
+    return result
+
+
+class MemoryCursor:
+    def __init__(self, collection, query: dict, projection: dict = None):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self._sort = None
+        self._limit = 0
+
+    def sort(self, key, direction: int = 1):
+        self._sort = (key, direction)
+        return self
+
+    def limit(self, count: int):
+        self._limit = count
+        return self
+
+    def _documents(self) -> list:
+        documents = self.collection._matching(self.query)
+        if self._sort:
+            key, direction = self._sort
+            documents.sort(key=lambda d: get_field(d, key), reverse=direction < 0)
+        if self._limit:
+            documents = documents[:self._limit]
+        return documents
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self._documents():
+            yield project(document, self.projection)
+
+    async def to_list(self, length=None):
+        return [d async for d in self][:length]
+
+    async def explain(self) -> dict:
+        field = next((f for f in self.collection._unique if f in self.query), None)
+        examined = len(self.collection._candidates(self.query))
+        plan = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': field}} if field else {'stage': 'COLLSCAN'}
+        return {
+            'queryPlanner': {'winningPlan': plan},
+            'executionStats': {'totalKeysExamined': examined if field else 0, 'totalDocsExamined': examined, 'executionTimeMillis': 0}
+        }
+
+
+class MemoryCollection:
+    """
+    A collection of documents keyed by _id
+
+    Unique indexes are kept as dicts, so queries that match a unique field by equality
+    don't scan the whole collection
+    """
+    def __init__(self, database, name: str):
+        self.database = database
+        self.name = name
+        self._documents = {}
+        self._unique = {}
+        self._ids = itertools.count(1)
+        self._ttl = None
+        self._next_expiry = 0
+
+    def _expire(self):
+        "Deletes the documents past their TTL, checked once a minute at most like mongodb does"
+        now = time.monotonic()
+        if now < self._next_expiry:
+            return
+
+        field, seconds = self._ttl
+        cutoff = datetime.utcnow() - timedelta(seconds=seconds)
+        for document in list(self._documents.values()):
+            value = get_field(document, field)
+            if isinstance(value, datetime) and value <= cutoff:
+                del self._documents[document['_id']]
+                self._unindex(document)
+                self.database._record(self.name, 'delete', document['_id'])
+        self._next_expiry = now + 60
+
+    def _candidates(self, query: dict):
+        "Returns the documents that can match a query, using a unique index if possible"
+        for field, index in self._unique.items():
+            value = query.get(field, MISSING)
+            if isinstance(value, dict) and set(value) == {'$eq'}:
+                value = value['$eq']
+            if value is not MISSING and not isinstance(value, (dict, list)):
+                _id = index.get(value)
+                return [self._documents[_id]] if _id is not None else []
+
+        return list(self._documents.values())
+
+    def _matching(self, query: dict, many: bool = True) -> list:
+        if self._ttl:
+            self._expire()
+        documents = []
+        for document in self._candidates(query):
+            if matches(document, query):
+                documents.append(document)
+                if not many:
+                    break
+        return documents
+
+    def _index(self, document: dict):
+        for field, index in self._unique.items():
+            value = get_field(document, field)
+            if value is not MISSING:
+                index[value] = document['_id']
+
+    def _unindex(self, document: dict):
+        for field, index in self._unique.items():
+            value = get_field(document, field)
+            if value is not MISSING and index.get(value) == document['_id']:
+                del index[value]
+
+    def _check_unique(self, document: dict):
+        for field, index in self._unique.items():
+            value = get_field(document, field)
+            if value is not MISSING and index.get(value, document['_id']) != document['_id']:
+                raise DuplicateKeyError(f'E11000 duplicate key error collection: {self.name} index: {field}')
+
+    def _find(self, query: dict, sort=None):
+        if sort:
+            documents = MemoryCursor(self, query).sort(*sort[0]).limit(1)._documents()
+        else:
+            documents = self._matching(query, many=False)
+        return documents[0] if documents else None
+
+    def _insert(self, document: dict):
+        document.setdefault('_id', next(self._ids))
+        if document['_id'] in self._documents:
+            raise DuplicateKeyError(f'E11000 duplicate key error collection: {self.name} index: _id_')
+        self._check_unique(document)
+
+        stored = deepcopy(document)
+        self._documents[stored['_id']] = stored
+        self._index(stored)
+        self.database._record(self.name, 'insert', stored['_id'], stored)
+        return stored['_id']
+
+    def _update(self, query: dict, update: dict, upsert: bool = False, many: bool = False):
+        documents = self._matching(query, many)
+        for document in documents:
+            updated = deepcopy(document)
+            apply_update(updated, update)
+            self._check_unique(updated)
+
+            self._unindex(document)
+            self._documents[document['_id']] = updated
+            self._index(updated)
+            self.database._record(self.name, 'update', document['_id'])
+
+        if documents or not upsert:
+            return len(documents), None
+
+        document = {k: deepcopy(v) for k, v in query.items() if not k.startswith('$') and not isinstance(v, dict)}
+        apply_update(document, update)
+        apply_update(document, {'$set': update.get('$setOnInsert', {})})
+        return 0, self._insert(document)
+
+    def _delete(self, query: dict, many: bool = False) -> int:
+        documents = self._matching(query, many)
+        for document in documents:
+            del self._documents[document['_id']]
+            self._unindex(document)
+            self.database._record(self.name, 'delete', document['_id'])
+        return len(documents)
+
+    async def create_indexes(self, indexes):
+        for index in indexes:
+            document = index.document
+            if 'expireAfterSeconds' in document:
+                self._ttl = (next(iter(document['key'])), document['expireAfterSeconds'])
+            if document.get('unique') and len(document['key']) == 1:
+                field = next(iter(document['key']))
+                if field not in self._unique:
+                    self._unique[field] = {}
+                    for stored in self._documents.values():
+                        self._check_unique(stored)
+                        self._index(stored)
+        return [index.document['name'] for index in indexes]
+
+    def find(self, query: dict = None, projection: dict = None) -> MemoryCursor:
+        return MemoryCursor(self, query or {}, projection)
+
+    async def find_one(self, query: dict = None, projection: dict = None):
+        document = self._find(query or {})
+        return project(document, projection) if document else None
+
+    async def count_documents(self, query: dict) -> int:
+        return len(self._matching(query))
+
+    async def insert_one(self, document: dict) -> InsertOneResult:
+        return InsertOneResult(self._insert(document), True)
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False) -> UpdateResult:
+        modified, upserted = self._update(query, update, upsert)
+        return UpdateResult({'n': modified or int(upserted is not None), 'nModified': modified, 'upserted': upserted}, True)
+
+    async def update_many(self, query: dict, update: dict, upsert: bool = False) -> UpdateResult:
+        modified, upserted = self._update(query, update, upsert, many=True)
+        return UpdateResult({'n': modified or int(upserted is not None), 'nModified': modified, 'upserted': upserted}, True)
+
+    async def delete_one(self, query: dict) -> DeleteResult:
+        return DeleteResult({'n': self._delete(query)}, True)
+
+    async def delete_many(self, query: dict) -> DeleteResult:
+        return DeleteResult({'n': self._delete(query, many=True)}, True)
+
+    async def find_one_and_update(self, query: dict, update: dict, projection: dict = None, sort=None,
+                                  upsert: bool = False, return_document: bool = False):
+        document = self._find(query, sort)
+        if document is None:
+            if not upsert:
+                return None
+            _, _id = self._update(query, update, upsert=True)
+            return project(self._documents[_id], projection) if return_document else None
+
+        before = project(document, projection)
+        self._update({'_id': document['_id']}, update)
+        return project(self._documents[document['_id']], projection) if return_document else before
+
+    async def bulk_write(self, requests, ordered: bool = True) -> BulkWriteResult:
+        result = {'nInserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'nUpserted': 0, 'upserted': [], 'writeErrors': []}
+        for index, request in enumerate(requests):
+            try:
+                if isinstance(request, InsertOne):
+                    self._insert(request._doc)
+                    result['nInserted'] += 1
+                elif isinstance(request, (UpdateOne, UpdateMany, ReplaceOne)):
+                    modified, upserted = self._update(request._filter, request._doc, request._upsert, isinstance(request, UpdateMany))
+                    result['nMatched'] += modified
+                    result['nModified'] += modified
+                    if upserted is not None:
+                        result['nUpserted'] += 1
+                        result['upserted'].append({'index': index, '_id': upserted})
+                elif isinstance(request, (DeleteOne, DeleteMany)):
+                    result['nRemoved'] += self._delete(request._filter, isinstance(request, DeleteMany))
+            except DuplicateKeyError as err:
+                result['writeErrors'].append({'index': index, 'code': 11000, 'errmsg': str(err), 'op': request})
+                if ordered:
+                    break
+
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+
+class MemoryChangeStream:
+    """
+    Drop-in for AsyncIOMotorChangeStream, over the changes recorded by a `MemoryDatabase`
+
+    Only `$match` stages are supported. Like motor, the stream only starts on the first `__anext__`
+    (from `start_at_operation_time` if given). Like mongodb, resuming from a change that is not
+    in the history anymore raises an OperationFailure with the ChangeStreamHistoryLost code
+    """
+    def __init__(self, database, pipeline: list = None, *, full_document: str = None,
+                 resume_after: dict = None, start_at_operation_time: Timestamp = None):
+        self.database = database
+        self.query = {'$and': [stage['$match'] for stage in pipeline or ()]}
+        self.lookup = full_document == 'updateLookup'
+        self.resume_token = resume_after
+        self._position = start_at_operation_time.inc if start_at_operation_time is not None else None
+        self._closed = False
+
+    def _open(self):
+        if self._position is None:
+            self._position = int(self.resume_token['_data'], 16) if self.resume_token else self.database._sequence
+
+    def _next(self):
+        history = self.database._history
+        while self._position < self.database._sequence:
+            first = history[0][0] if history else self.database._sequence + 1
+            if self._position + 1 < first:
+                raise OperationFailure('Resume of change stream was not possible, as the resume point may no longer be in the oplog', 286)
+
+            self._position, event = history[self._position + 1 - first]
+            self.resume_token = event['_id']
+            if matches(event, self.query):
+                change = {k: v for k, v in event.items() if k != 'fullDocument'}
+                if event['operationType'] == 'insert':
+                    change['fullDocument'] = deepcopy(event['fullDocument'])
+                elif self.lookup and event['operationType'] == 'update':
+                    # Like mongodb, the current version of the document, None if it was deleted since
+                    collection = self.database[event['ns']['coll']]
+                    change['fullDocument'] = deepcopy(collection._documents.get(event['documentKey']['_id']))
+                return change
+        return None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> dict:
+        self._open()
+        while not self._closed:
+            change = self._next()
+            if change is not None:
+                return change
+            await self.database._wait()
+        raise StopAsyncIteration
+
+    async def close(self):
+        self._closed = True
+
+
+class MemoryDatabase:
+    def __init__(self, client, name: str):
+        self.client = client
+        self.name = name
+        self._collections = {}
+        # Changes are only recorded once a change stream was opened
+        self._watched = False
+        self._history = deque(maxlen=CHANGE_HISTORY)
+        self._sequence = 0
+        self._waiter = None
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        if name not in self._collections:
+            self._collections[name] = MemoryCollection(self, name)
+        return self._collections[name]
+
+    def __getattr__(self, name: str) -> MemoryCollection:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    async def command(self, command: str, value=1, **kwargs) -> dict:
+        "Supports ping, and collMod to change the expiry of a TTL index"
+        if command == 'collMod':
+            self[value]._ttl = (self[value]._ttl[0], kwargs['index']['expireAfterSeconds'])
+        elif command != 'ping':
+            raise NotImplementedError(f'Unsupported command {command}')
+        # Like a replica set, the time of the last change (its position in the history)
+        return {'ok': 1.0, 'operationTime': Timestamp(int(time.time()), self._sequence)}
+
+    def watch(self, pipeline: list = None, **kwargs) -> MemoryChangeStream:
+        # Changes are recorded from now on, the stream may start from here
+        self._watched = True
+        return MemoryChangeStream(self, pipeline, **kwargs)
+
+    def _record(self, collection: str, operation: str, _id, document: dict = None):
+        """
+        Records a change for the change streams, stored documents are never modified in place so they are not copied.
+        Only inserted and deleted documents are kept, updated ones are looked up when the change is read
+        """
+        if not self._watched:
+            return
+
+        self._sequence += 1
+        self._history.append((self._sequence, {
+            '_id': {'_data': f'{self._sequence:016x}'},
+            'operationType': operation,
+            'ns': {'db': self.name, 'coll': collection},
+            'documentKey': {'_id': _id},
+            'fullDocument': document,
+            'wallTime': datetime.utcnow()
+        }))
+        if self._waiter is not None:
+            self._waiter.set_result(None)
+            self._waiter = None
+
+    async def _wait(self):
+        "Waits for the next change"
+        if self._waiter is None:
+            self._waiter = asyncio.get_event_loop().create_future()
+        # Shared by every stream, one of them being closed must not cancel it for the others
+        await asyncio.shield(self._waiter)
+
+
+class MemoryClient:
+    "Drop-in for AsyncIOMotorClient, databases are shared by everything using the same client"
+    def __init__(self):
+        self._databases = {}
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        if name not in self._databases:
+            self._databases[name] = MemoryDatabase(self, name)
+        return self._databases[name]
+
+    def __getattr__(self, name: str) -> MemoryDatabase:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def close(self):
+        pass
@@ -0,0 +1,99 @@
+"""
+Messages per second through command processing, before and after the prefix fast path
+
+    python -m benchmarks.prefixes --messages 200000 --guilds 1000 --commands 0.01
+"""
+from types import SimpleNamespace
+import argparse
+import asyncio
+import random
+import time
+
+from discord.ext import commands
+
+from bot import GiveawaySnake
+from cogs.utils.configs import GuildConfigCache
+from cogs.utils.storage import MongoStorage
+
+from .memorydb import MemoryClient
+
+USER_ID = 543796400165748736
+CHATTER = ['hello', 'lol', 'has anyone seen the new update?', '<:pog:1234> nice', 'gg', '!rank', 'what time is it']
+
+
+async def old_prefix_resolver(bot, msg):
+    "The resolver as it was before the fast path"
+    prefixes = [f'<@{bot.user.id}> ', f'<@!{bot.user.id}> ']
+    prefix = 'm!'
+    if msg.guild:
+        config = await bot.configs.get(msg.guild.id)
+        prefix = config.get('prefix', 'm!')
+
+    prefixes.append(prefix)
+    return prefixes
+
+
+def make_messages(count: int, guilds: int, commands_ratio: float) -> list:
+    messages = []
+    for _ in range(count):
+        guild = SimpleNamespace(id=random.randrange(guilds) + 1)
+        if random.random() < commands_ratio:
+            content = random.choice(['m!glist', f'<@{USER_ID}> ghelp', '?gend 1'])
+        else:
+            content = random.choice(CHATTER)
+        messages.append(SimpleNamespace(content=content, guild=guild, author=SimpleNamespace(id=1, bot=False), _state=None))
+
+    return messages
+
+
+async def make_bot(guilds: int):
+    bot = GiveawaySnake()
+    bot._connection.user = SimpleNamespace(id=USER_ID)
+
+    async def ignore(*_):
+        pass
+    # Keeps the default handler from printing every CommandNotFound
+    bot.add_listener(ignore, 'on_command_error')
+
+    storage = MongoStorage(MemoryClient().dpy)
+    for guildID in range(1, guilds + 1, 10):
+        await storage.update_config(guildID, {'prefix': '?'})
+    bot.configs = GuildConfigCache(storage)
+    bot.configs.set_user(USER_ID)
+    return bot
+
+
+async def measure(process, messages: list) -> float:
+    # Loads every config first, only the steady state is measured
+    for msg in messages[:1000]:
+        await process(msg)
+
+    start = time.perf_counter()
+    for msg in messages:
+        await process(msg)
+    return len(messages) / (time.perf_counter() - start)
+
+
+async def main(args):
+    random.seed(args.seed)
+    messages = make_messages(args.messages, args.guilds, args.commands)
+    bot = await make_bot(args.guilds)
+
+    bot.command_prefix = old_prefix_resolver
+    before = await measure(lambda msg: commands.Bot.process_commands(bot, msg), messages)
+
+    bot.command_prefix = GiveawaySnake().command_prefix
+    after = await measure(bot.process_commands, messages)
+
+    print(f'{len(messages)} messages, {args.guilds} guilds, {args.commands:.1%} commands')
+    print(f'before: {before:>12,.0f} messages/s')
+    print(f'after:  {after:>12,.0f} messages/s ({after / before:.1f}x)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--guilds', type=int, default=1000)
+    parser.add_argument('--commands', type=float, default=0.01, help='share of messages that start with a prefix')
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
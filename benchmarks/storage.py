@@ -0,0 +1,125 @@
+"""
+Latency of the storage operations on the giveaway paths, per backend
+
+    python -m benchmarks.storage --count 2000
+    python -m benchmarks.storage --mongo-uri mongodb://localhost:27017
+
+- create: a giveaway is inserted, as `gstart` does
+- finish: a giveaway is archived and deleted, one flush per giveaway
+- finish batch: the same, 100 giveaways per flush as when giveaways end together
+- config update: a guild config is updated, as the config commands do
+"""
+from datetime import datetime, timedelta
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import uuid
+
+from cogs.utils.database import Database
+from cogs.utils.metrics import Registry
+from cogs.utils.persistence import WriteBehindQueue
+from cogs.utils.selection import pack_ids
+from cogs.utils.sqlite import SQLiteStorage
+from cogs.utils.storage import MongoStorage
+
+BATCH = 100
+
+
+def giveaway(messageID: int) -> dict:
+    return {
+        'messageID': messageID, 'guildID': messageID % 1000, 'channelID': messageID % 10000, 'authorID': 1,
+        'title': 'Nitro', 'endsat': datetime.utcnow() + timedelta(hours=1), 'winners': 1, 'entrants': list(range(20))
+    }
+
+
+def finish(writer: WriteBehindQueue, data: dict):
+    "Queues what `GiveawayCog.close_giveaway` writes"
+    writer.insert('archive', {
+        'messageID': data['messageID'], 'guildID': data['guildID'], 'channelID': data['channelID'], 'title': data['title'],
+        'endedat': datetime.utcnow(), 'winners': [1], 'eligible': pack_ids(data['entrants'])
+    })
+    writer.delete('giveaways', {'messageID': data['messageID']})
+
+
+def quantiles(samples: list) -> str:
+    samples = sorted(samples)
+    p50, p99 = samples[len(samples) // 2], samples[min(int(len(samples) * 0.99), len(samples) - 1)]
+    return f'p50 {p50 * 1000:7.3f}ms  p99 {p99 * 1000:7.3f}ms'
+
+
+async def measure(storage, count: int) -> dict:
+    writer = WriteBehindQueue(storage)
+    await storage.setup()
+    results = {}
+
+    created = [giveaway(i) for i in range(1, 2 * count + 1)]
+    samples = []
+    for data in created:
+        start = time.perf_counter()
+        await storage.insert_giveaway(data)
+        samples.append(time.perf_counter() - start)
+    results['create'] = samples
+
+    samples = []
+    for data in created[:count]:
+        start = time.perf_counter()
+        finish(writer, data)
+        await writer.flush()
+        samples.append(time.perf_counter() - start)
+    results['finish'] = samples
+
+    # Per giveaway, the time of its batch divided by its size
+    samples = []
+    for i in range(count, 2 * count, BATCH):
+        batch = created[i:i + BATCH]
+        start = time.perf_counter()
+        for data in batch:
+            finish(writer, data)
+        await writer.flush()
+        samples.extend([(time.perf_counter() - start) / len(batch)] * len(batch))
+    results['finish batch'] = samples
+
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        await storage.update_config(i % 1000, {'prefix': f'?{i}'})
+        samples.append(time.perf_counter() - start)
+    results['config update'] = samples
+
+    await storage.close()
+    return results
+
+
+async def run(args):
+    registry = Registry()
+    loop = asyncio.get_event_loop()
+    backends = [
+        ('memory', MongoStorage(Database('memory://', registry, loop))),
+        ('sqlite', SQLiteStorage(os.path.join(tempfile.mkdtemp(), 'benchmark.db')))
+    ]
+    if args.mongo_uri:
+        name = f'benchmark_{uuid.uuid4().hex[:8]}'
+        backends.append(('mongo', MongoStorage(Database(args.mongo_uri, registry, loop, name=name))))
+
+    for backend, storage in backends:
+        results = await measure(storage, args.count)
+        if backend == 'mongo':
+            client = storage.database.client
+            await client.drop_database(storage.database.db.name)
+        print(f'{backend}')
+        for operation, samples in results.items():
+            print(f'  {operation:<14} {quantiles(samples)}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=2000, help='Operations measured per operation type')
+    parser.add_argument('--mongo-uri', help='Also measures this MongoDB server, in a throwaway database')
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+"""
+Offline benchmarks of the giveaway hot paths, against `benchmarks.fakes`
+
+    python -m benchmarks.suite --output before.json
+    python -m benchmarks.suite --output after.json --compare before.json
+    python -m benchmarks.suite --scenarios running-1k mass-expiry-1k
+
+Each scenario runs in its own process so that peak RSS is its own
+"""
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import argparse
+import asyncio
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+
+from bot import prefix_resolver
+from cogs.giveaway import Giveaway, GiveawayCog, select_winners
+from cogs.utils.context import Context
+
+from .fakes import FakeBot, FakeMessage
+
+
+# Seconds over which the giveaways of the mass expiry scenarios end
+EXPIRY_SPREAD = 3
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {'count': 0}
+
+    values = sorted(values)
+    pick = lambda p: values[min(int(len(values) * p), len(values) - 1)]
+    return {
+        'count': len(values),
+        'p50': round(pick(0.5), 4),
+        'p90': round(pick(0.9), 4),
+        'p99': round(pick(0.99), 4),
+        'max': round(values[-1], 4)
+    }
+
+
+class LoopLag:
+    "Measures how late the event loop wakes up a task sleeping every `interval` seconds"
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(loop.time() - start - self.interval)
+
+    def __enter__(self):
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    def __exit__(self, *_):
+        self._task.cancel()
+
+
+def giveaway_data(bot: FakeBot, endsat: datetime, entrants=()) -> dict:
+    channel = random.choice(bot.channels)
+    return {
+        'authorID': 1, 'channelID': channel.id, 'guildID': channel.guild.id, 'messageID': bot.http.next_id(),
+        'title': 'Nitro', 'endsat': endsat, 'winners': 1, 'entrants': list(entrants)
+    }
+
+
+async def start_cog(bot: FakeBot) -> GiveawayCog:
+    cog = GiveawayCog(bot)
+    while not cog.scheduler.running:
+        await asyncio.sleep(0.01)
+    return cog
+
+
+def timed_finishes(cog: GiveawayCog) -> list:
+    "Records how late the winners of each giveaway were announced compared to its end"
+    latencies = []
+    announce = cog.announce
+
+    async def timed(channelID, ended, delays, semaphore):
+        announced = await announce(channelID, ended, delays, semaphore)
+        now = time.time()
+        latencies.extend(now - giveaway.ends for giveaway, _ in announced)
+        return announced
+
+    cog.announce = timed
+    return latencies
+
+
+async def running(args, count: int) -> dict:
+    "`count` giveaways ending within the next hours are loaded and run for a while"
+    bot = FakeBot(guilds=100, channels=max(count // 200, 1), latency=args.latency, global_limit=args.global_limit)
+    await bot.connect()
+    now = datetime.utcnow()
+    for _ in range(count):
+        data = giveaway_data(bot, now + timedelta(seconds=random.uniform(60, 6 * 3600)), range(random.randrange(20)))
+        await bot.storage.insert_giveaway(data)
+
+    with LoopLag() as lag:
+        start = time.perf_counter()
+        cog = await start_cog(bot)
+        await asyncio.sleep(args.duration)
+        elapsed = time.perf_counter() - start
+
+    cog.cog_unload()
+    await bot.close()
+    return {
+        'giveaways': count,
+        'time_to_schedulable': round(cog.time_to_schedulable, 4),
+        'edits_per_second': round(bot.http.calls['edit_message'] / elapsed, 2),
+        'suppressed_edits': cog.renders.edits.get(result='suppressed'),
+        'loop_lag': percentiles(lag.samples),
+        'calls': dict(bot.http.calls),
+        'rate_limit_waits': dict(bot.http.waits)
+    }
+
+
+async def mass_expiry(args, count: int) -> dict:
+    "`count` giveaways end within `EXPIRY_SPREAD` seconds of each other, at random sub-second offsets"
+    # About 10 giveaways per channel, so that announcements can be merged
+    bot = FakeBot(guilds=10, channels=max(count // 100, 1), members=50, latency=args.latency, global_limit=args.global_limit)
+    await bot.connect()
+    start = datetime.utcnow() + timedelta(seconds=2)
+    for _ in range(count):
+        guild = random.choice(bot.guilds)
+        endsat = start + timedelta(seconds=random.uniform(0, EXPIRY_SPREAD))
+        data = giveaway_data(bot, endsat, random.sample(list(guild.members), 20))
+        await bot.storage.insert_giveaway(data)
+
+    with LoopLag() as lag:
+        cog = await start_cog(bot)
+        latencies = timed_finishes(cog)
+        deadline = time.perf_counter() + args.timeout
+        while len(cog.running) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.1)
+
+    cog.cog_unload()
+    await bot.close()
+    return {
+        'giveaways': count,
+        'finished': len(latencies),
+        'finish_latency': percentiles(latencies),
+        'finish_batches': cog.finish_batch.count(),
+        # Below 1 when giveaways that end close together are finished and announced together
+        'batches_per_giveaway': round(cog.finish_batch.count() / count, 4),
+        'sends_per_giveaway': round(bot.http.calls['send_message'] / count, 4),
+        'loop_lag': percentiles(lag.samples),
+        'calls': dict(bot.http.calls),
+        'rate_limit_waits': dict(bot.http.waits)
+    }
+
+
+async def finish_entrants(args, count: int) -> dict:
+    "A giveaway with `count` tracked entrants is finished"
+    bot = FakeBot(guilds=1, channels=1, members=count, latency=args.latency, global_limit=args.global_limit)
+    await bot.connect()
+    guild = bot.guilds[0]
+    cog = await start_cog(bot)
+
+    with LoopLag() as lag:
+        data = giveaway_data(bot, datetime.utcnow(), guild.members)
+        giveaway = Giveaway(bot, **data)
+        cog.running.add(giveaway)
+        cog.entrants.track(giveaway.messageID, data['entrants'])
+
+        start = time.perf_counter()
+        await cog.finish_giveaway(giveaway)
+        elapsed = time.perf_counter() - start
+
+    cog.cog_unload()
+    await bot.close()
+    return {'entrants': count, 'finish_seconds': round(elapsed, 4), 'loop_lag': percentiles(lag.samples)}
+
+
+async def finish_reactions(args, count: int) -> dict:
+    "Winners are selected out of `count` reactions fetched page by page, as untracked giveaways are"
+    bot = FakeBot(guilds=1, channels=1, latency=args.latency, global_limit=args.global_limit)
+    await bot.connect()
+    channel = bot.channels[0]
+    message = FakeMessage(channel, {'id': bot.http.next_id()})
+    bot.http.reactions[message.id] = list(range(1, count + 1))
+
+    with LoopLag() as lag:
+        start = time.perf_counter()
+        selection = await select_winners(message, 1)
+        elapsed = time.perf_counter() - start
+
+    await bot.close()
+    return {
+        'entrants': count,
+        'eligible': selection.eligible,
+        'select_seconds': round(elapsed, 4),
+        'pages': bot.http.calls['get_reaction_users'],
+        'loop_lag': percentiles(lag.samples)
+    }
+
+
+async def lookups(args, count: int) -> dict:
+    "`count` messages spread over 1000 guilds go through prefix_resolver and Context.get_config"
+    bot = FakeBot(guilds=0, latency=args.latency, global_limit=args.global_limit)
+    await bot.connect()
+    for guildID in range(1, 1001, 10):
+        await bot.storage.update_config(guildID, {'prefix': '?'})
+    messages = [SimpleNamespace(guild=SimpleNamespace(id=random.randrange(1000) + 1)) for _ in range(count)]
+
+    results = {'messages': count}
+    for name, lookup in [
+        ('prefix_resolver', lambda msg: prefix_resolver(bot, msg)),
+        ('get_config', lambda msg: Context.get_config(SimpleNamespace(bot=bot, guild=msg.guild)))
+    ]:
+        bot.configs._entries.clear()
+        start = time.perf_counter()
+        for msg in messages:
+            await lookup(msg)
+        results[f'{name}_per_second'] = round(count / (time.perf_counter() - start))
+
+    await bot.close()
+    return results
+
+
+SCENARIOS = {
+    'running-1k': (running, 1000),
+    'running-10k': (running, 10000),
+    'running-100k': (running, 100000),
+    'mass-expiry-1k': (mass_expiry, 1000),
+    'mass-expiry-10k': (mass_expiry, 10000),
+    'finish-100k-entrants': (finish_entrants, 100000),
+    'finish-100k-reactions': (finish_reactions, 100000),
+    'lookups-100k': (lookups, 100000),
+}
+
+
+def run_scenario(args) -> dict:
+    random.seed(args.seed)
+    func, count = SCENARIOS[args.run]
+    start = time.perf_counter()
+    result = asyncio.get_event_loop().run_until_complete(func(args, count))
+    result['wall_seconds'] = round(time.perf_counter() - start, 3)
+    # KiB on Linux
+    result['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return result
+
+
+def flatten(result: dict, prefix: str = '') -> dict:
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(old: dict, new: dict):
+    for name, result in new['scenarios'].items():
+        if name not in old['scenarios']:
+            continue
+
+        print(f'\n{name} ({old["commit"]} -> {new["commit"]})')
+        before = flatten(old['scenarios'][name])
+        for key, value in flatten(result).items():
+            if key in before and before[key] != value:
+                change = f'{(value - before[key]) / before[key]:+.1%}' if before[key] else ''
+                print(f'  {key:<40} {before[key]:>12} -> {value:<12} {change}')
+
+
+def main(args):
+    if args.run:
+        print(json.dumps(run_scenario(args)))
+        return
+
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    report = {
+        'commit': commit or None,
+        'date': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'settings': {'latency': args.latency, 'global_limit': args.global_limit, 'duration': args.duration,
+                     'timeout': args.timeout, 'seed': args.seed},
+        'scenarios': {}
+    }
+
+    options = ['--latency', str(args.latency), '--global-limit', str(args.global_limit), '--duration', str(args.duration),
+               '--timeout', str(args.timeout), '--seed', str(args.seed)]
+    for name in args.scenarios:
+        print(f'Running {name}...', file=sys.stderr)
+        proc = subprocess.run([sys.executable, '-m', 'benchmarks.suite', '--run', name, *options], capture_output=True, text=True)
+        if proc.returncode:
+            print(proc.stderr, file=sys.stderr)
+            report['scenarios'][name] = {'error': proc.stderr.strip().splitlines()[-1:]}
+            continue
+
+        report['scenarios'][name] = result = json.loads(proc.stdout.strip().splitlines()[-1])
+        print(json.dumps(result, indent=2), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--output', help='file the JSON report is written to, printed otherwise')
+    parser.add_argument('--compare', help='previous JSON report to compare with')
+    parser.add_argument('--latency', type=float, default=0.05, help='average latency of a request in seconds')
+    parser.add_argument('--global-limit', type=int, default=50, help='requests per second across every route')
+    parser.add_argument('--duration', type=float, default=20, help='seconds the running scenarios run for')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds the mass expiry scenarios are given to finish')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--run', choices=list(SCENARIOS), help=argparse.SUPPRESS)
+    main(parser.parse_args())
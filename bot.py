@@ -1,12 +1,25 @@
 from datetime import datetime
+import asyncio
 import logging
 
 import discord
 from discord.ext import commands
-from motor.motor_asyncio import AsyncIOMotorClient
 
-from config import TOKEN, MONGO_URI
+import config
+from config import TOKEN
 from cogs.utils.context import Context
+from cogs.utils.persistence import WriteBehindQueue
+from cogs.utils.schema import ARCHIVE_TTL
+from cogs.utils.configs import GuildConfigCache
+from cogs.utils.leases import instance_id
+from cogs.utils.database import Database
+from cogs.utils.storage import MongoStorage
+from cogs.utils.sqlite import SQLiteStorage
+from cogs.utils.changes import ChangeFeed
+from cogs.utils.metrics import Registry, LoopLagMonitor, MetricsServer, instrument_http
+from cogs.utils.startup import StartupReport
+
+log = logging.getLogger(__name__)
 
 
 COGS = [
@@ -19,52 +32,118 @@ COGS = [
 
 
 async def prefix_resolver(bot, msg):
-    prefixes = [f'<@{bot.user.id}> ', f'<@!{bot.user.id}> ']
-    prefix = 'm!'
-    if msg.guild:
-        config = bot.guild_config.get(msg.guild.id)
-        if config:
-            prefix = config.get('prefix', 'm!')
+    # The prefixes are built once per guild config, nothing is allocated here
+    if msg.guild is None:
+        return bot.configs.default_prefixes[0]
 
-    prefixes.append(prefix)
-    return prefixes
+    prefixes = bot.configs.peek_prefixes(msg.guild.id) or await bot.configs.get_prefixes(msg.guild.id)
+    return prefixes[0]
 
 
-class GiveawaySnake(commands.Bot):
+class GiveawaySnake(commands.AutoShardedBot):
     def __init__(self):
+        # Each process can run a subset of the shards, all of them are run by default
         super().__init__(
             command_prefix=prefix_resolver,
             help_command=None,
             case_insensitive=True,
             reconnect=True,
-            owner_id=410806297580011520
+            owner_id=410806297580011520,
+            activity=discord.Activity(type=1, name="development"),
+            shard_ids=getattr(config, 'SHARD_IDS', None),
+            shard_count=getattr(config, 'SHARD_COUNT', None)
         )
 
         self.version = 'v0.0.1'
         self.invite = 'https://discord.com/oauth2/authorize?client_id=543796400165748736&scope=bot&permissions=81984'
         self.support = 'https://discord.gg/b8S3HAw'
-        self.guild_config = {}
+
+        # Maximum amount of giveaways refreshed / finished at once, in total and per channel
+        self.worker_concurrency = getattr(config, 'WORKER_CONCURRENCY', 10)
+        self.channel_concurrency = getattr(config, 'CHANNEL_CONCURRENCY', 2)
+        # Countdown edits per second shared by every giveaway, leaving the rest of the rate limit to other requests
+        self.edit_budget = getattr(config, 'EDIT_BUDGET', 30)
+        # Amount of giveaway messages fetched at once after a restart, 0 fetches them only when needed
+        self.warmup_concurrency = getattr(config, 'WARMUP_CONCURRENCY', 0)
+        # Seconds a giveaway lease lasts when running several instances, None disables leases
+        self.lease_duration = getattr(config, 'LEASE_DURATION', None)
+        self.instance_id = getattr(config, 'INSTANCE_ID', None) or instance_id()
+        # Maximum amount of guild configs kept in memory and for how many seconds
+        self.config_cache_size = getattr(config, 'CONFIG_CACHE_SIZE', 10000)
+        self.config_cache_ttl = getattr(config, 'CONFIG_CACHE_TTL', 600)
+        self.archive_ttl = getattr(config, 'ARCHIVE_TTL', ARCHIVE_TTL)
+        # Stores everything in this SQLite file instead of MongoDB, for a single process
+        self.sqlite_path = getattr(config, 'SQLITE_PATH', None)
+        if self.sqlite_path and self.lease_duration:
+            raise RuntimeError('LEASE_DURATION needs MongoDB, SQLITE_PATH only supports a single process')
+        # Applies the configs and giveaways changed by other processes, needs a replica set
+        self.watch_changes = getattr(config, 'WATCH_CHANGES', True)
+        # Connection pool of the database, timeouts are in seconds
+        self.database_options = {
+            'min_pool_size': getattr(config, 'MONGO_MIN_POOL_SIZE', 0),
+            'max_pool_size': getattr(config, 'MONGO_MAX_POOL_SIZE', 100),
+            'server_selection_timeout': getattr(config, 'MONGO_SERVER_SELECTION_TIMEOUT', 30),
+            'connect_timeout': getattr(config, 'MONGO_CONNECT_TIMEOUT', 20),
+            'socket_timeout': getattr(config, 'MONGO_SOCKET_TIMEOUT', None),
+            'retry_reads': getattr(config, 'MONGO_RETRY_READS', True),
+            'retry_writes': getattr(config, 'MONGO_RETRY_WRITES', True),
+            'health_interval': getattr(config, 'MONGO_HEALTH_INTERVAL', 30)
+        }
+
+        self.metrics = Registry()
+        instrument_http(self.http, self.metrics)
+        self.loop_lag = LoopLagMonitor(self.metrics)
+        # Metrics are served on http://METRICS_HOST:METRICS_PORT/metrics when a port is set
+        self.metrics_server = None
+        if getattr(config, 'METRICS_PORT', None):
+            self.metrics_server = MetricsServer(self.metrics, getattr(config, 'METRICS_HOST', '127.0.0.1'), config.METRICS_PORT)
+        self.startup = StartupReport(self.metrics)
+        self._startup = None
+
+    def shard_of(self, guildID: int) -> int:
+        "Returns the shard id a guild belongs to"
+        return (guildID >> 22) % (self.shard_count or 1)
+
+    def owns_guild(self, guildID: int) -> bool:
+        "Checks whether the guild is served by one of the shards of this process"
+        return self.shard_ids is None or self.shard_of(guildID) in self.shard_ids
 
     async def get_context(self, message, *, cls=None):
         return await super().get_context(message, cls=Context)
 
-    async def on_connect(self):
-        print(f"\n{self.user} is starting up...")
-
-        self.client = AsyncIOMotorClient(MONGO_URI)
-        self.db = self.client.dpy
-
-        async for conf in self.db.guilds.find({}, {'id': 0}):
-            guildid = conf.pop('guild')
-            self.guild_config[guildid] = conf
-
-        print("Successfully connected to mongodb server")
-
-    async def on_ready(self):
-        await self.change_presence(activity=discord.Activity(type=1, name="development"))
-        if not hasattr(self, 'uptime'):
-            self.uptime = datetime.utcnow()
-
+    async def process_commands(self, message):
+        content = message.content
+        if message.author.bot or not content:
+            return
+
+        # Most messages are not commands, they are rejected before a context is built
+        if message.guild is None:
+            prefixes, initials = self.configs.default_prefixes
+        else:
+            prefixes, initials = self.configs.peek_prefixes(message.guild.id) or await self.configs.get_prefixes(message.guild.id)
+        if content[0] not in initials or not content.startswith(prefixes):
+            return
+
+        ctx = await self.get_context(message)
+        await self.invoke(ctx)
+
+    def setup_database(self):
+        "Creates the storage, the write queue and the guild config cache, they live as long as the process"
+        if self.sqlite_path:
+            self.database = None
+            self.storage = SQLiteStorage(self.sqlite_path)
+        else:
+            # With memory://, instances sharing their data can be given the same client beforehand
+            self.database = Database(config.MONGO_URI, self.metrics, self.loop, client=getattr(self, 'client', None), **self.database_options)
+            self.client = self.database.client
+            self.storage = MongoStorage(self.database)
+        self.configs = GuildConfigCache(self.storage, maxsize=self.config_cache_size, ttl=self.config_cache_ttl)
+        self.writer = WriteBehindQueue(self.storage)
+        self.changes = ChangeFeed(self.storage, self.metrics)
+        self.changes.subscribe('guilds', self.configs.apply)
+        self.changes.resets.append(self.configs.clear)
+
+    def load_extensions(self):
         for cog in COGS:
             try:
                 self.load_extension(cog)
@@ -72,6 +151,87 @@ class GiveawaySnake(commands.Bot):
                 print(f"\nFailed to load extension: {cog}")
                 print(err)
 
+    async def start(self, *args, **kwargs):
+        # Everything that doesn't need the gateway is started once, before logging in
+        if self._startup is None:
+            self.setup_database()
+            self._startup = self.loop.create_task(self.run_startup())
+        await super().start(*args, **kwargs)
+
+    async def run_startup(self):
+        """
+        Runs once per process, the storage setup, the config warm up and the giveaway rehydration
+        (started by the giveaway cog) overlap with the gateway handshake.
+        Changes made by other processes are watched from the start and applied once everything is loaded
+
+        Prints how long each phase took once they are all done
+        """
+        startup = self.startup
+        self.storage.start()
+        self.writer.start()
+        self.loop_lag.start()
+
+        if self.watch_changes:
+            with startup.phase('changes'):
+                await self.changes.open()
+
+        async def gateway():
+            with startup.phase('gateway'):
+                await self.wait_until_ready()
+
+        async def storage():
+            with startup.phase('storage'):
+                await self.storage.setup(archive_ttl=self.archive_ttl)
+
+        async def configs():
+            with startup.phase('configs'):
+                return await self.configs.warm(self.owns_guild)
+
+        phases = [gateway(), storage(), configs()]
+        if self.metrics_server:
+            phases.append(self.metrics_server.start())
+        with startup.phase('extensions'):
+            self.load_extensions()
+
+        results = await asyncio.gather(*phases, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                log.error('Startup phase failed', exc_info=result)
+
+        warmed = results[2]
+        if not isinstance(warmed, Exception) and warmed < self.configs.maxsize:
+            # Every stored config is cached, the other guilds have none
+            self.configs.fill(g.id for g in self.guilds)
+        await startup.settled()
+        if self.watch_changes:
+            self.changes.start()
+        self.time_to_serving = startup.elapsed()
+        print(f"\nStarted in {round(self.time_to_serving, 3)}s\n{startup.format()}\n")
+
+    async def on_connect(self):
+        # Runs again on every reconnect, it must stay cheap. Everything else is set up once by `start`
+        if not self.configs.mentions:
+            self.configs.set_user(self.user.id)
+
+    async def close(self):
+        if self._startup is not None:
+            self._startup.cancel()
+        # Make sure every queued write is stored before shutting down
+        if hasattr(self, 'writer'):
+            await self.changes.close()
+            await self.writer.close()
+            await self.storage.close()
+        self.loop_lag.cancel()
+        if self.metrics_server:
+            await self.metrics_server.close()
+        await super().close()
+
+    async def on_ready(self):
+        # Dispatched again for every new session
+        if hasattr(self, 'uptime'):
+            return
+        self.uptime = datetime.utcnow()
+
         print("\n==========================================")
         print(f"Successfully connected to {self.user}")
         print(f"Ready to serve {len(self.guilds)} Guilds")
@@ -1,9 +1,19 @@
+from datetime import datetime
+import asyncio
+import io
+import os
+import threading
 import time
 import traceback
+import tracemalloc
 
 import discord
 from discord.ext import commands
-from .utils import utils
+from .utils import utils, profiling
+
+# Discord rejects bigger attachments, larger reports are written to PROFILE_DIR instead
+MAX_ATTACHMENT = 8 * 1024 ** 2
+PROFILE_DIR = 'profiles'
 
 
 def cleanup_code(content):
@@ -16,6 +26,8 @@ def cleanup_code(content):
 class AdminCog(commands.Cog, name="🔒 Admin Commands", command_attrs=dict(hidden=True)):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self.profiling = False
+        self.snapshot = None
 
     async def cog_check(self, ctx: commands.Context):
         return await self.bot.is_owner(ctx.author)
@@ -56,6 +68,101 @@ class AdminCog(commands.Cog, name="🔒 Admin Commands", command_attrs=dict(hidd
         await ctx.send('Shutting down...')
         await self.bot.logout()
 
+    @commands.command()
+    async def explain(self, ctx: commands.Context):
+        """Shows the query plans of the main storage queries"""
+        results = await self.bot.storage.explain()
+        await ctx.send(utils.codeblock("\n".join(
+            f"{r['query']} :: {r['plan']} | keys: {r['keys']}, docs: {r['docs']}, {r['ms']}ms"
+            for r in results
+        ), 'asciidoc'))
+
+    async def send_report(self, ctx: commands.Context, name: str, text: str):
+        "Sends a report as an attachment, or writes it to disk if it is too big"
+        filename = f"{name}-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.txt"
+        data = text.encode()
+        if len(data) <= MAX_ATTACHMENT:
+            return await ctx.send(file=discord.File(io.BytesIO(data), filename=filename))
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, filename)
+        with open(path, 'wb') as f:
+            f.write(data)
+        await ctx.send(f'The report is too big to be uploaded, it was written to `{path}`')
+
+    @commands.command()
+    async def profile(self, ctx: commands.Context, seconds: float = 10, interval: float = 5):
+        """Samples the stack of the event loop every `interval` ms for some seconds"""
+        if self.profiling:
+            return await ctx.send('❌ A profile is already being taken')
+
+        self.profiling = True
+        sampler = profiling.StackSampler(threading.get_ident(), interval / 1000)
+        try:
+            await ctx.send(f'Profiling for {seconds} seconds...')
+            sampler.start()
+            await asyncio.sleep(seconds)
+        finally:
+            sampler.stop()
+            self.profiling = False
+
+        # The collapsed stacks can be turned into a flame graph with flamegraph.pl or speedscope
+        await self.send_report(ctx, 'profile', f'{sampler.top()}\n\n{sampler.collapsed()}')
+
+    @commands.command()
+    async def blocking(self, ctx: commands.Context, seconds: float = 30, threshold: float = 100):
+        """Reports the tasks that block the event loop for longer than `threshold` ms"""
+        if self.profiling:
+            return await ctx.send('❌ A profile is already being taken')
+
+        self.profiling = True
+        detector = profiling.BlockingDetector(self.bot.loop, threshold / 1000)
+        try:
+            await ctx.send(f'Watching the event loop for {seconds} seconds...')
+            detector.start()
+            await asyncio.sleep(seconds)
+        finally:
+            detector.stop()
+            self.profiling = False
+
+        await self.send_report(ctx, 'blocking', detector.format())
+
+    @commands.group(name='tracemalloc', invoke_without_command=True)
+    async def _tracemalloc(self, ctx: commands.Context):
+        """Traces memory allocations, use the start, snapshot and stop subcommands"""
+        state = f'tracing with {tracemalloc.get_traceback_limit()} frame(s)' if tracemalloc.is_tracing() else 'not tracing'
+        await ctx.send(f'tracemalloc is {state}')
+
+    @_tracemalloc.command(name='start')
+    async def tracemalloc_start(self, ctx: commands.Context, frames: int = 1):
+        """Starts tracing allocations, this slows every allocation down until it is stopped"""
+        if tracemalloc.is_tracing():
+            return await ctx.send('❌ tracemalloc is already tracing')
+
+        tracemalloc.start(frames)
+        self.snapshot = None
+        await ctx.send(f'Started tracing allocations with {frames} frame(s)')
+
+    @_tracemalloc.command(name='snapshot')
+    async def tracemalloc_snapshot(self, ctx: commands.Context, limit: int = 25):
+        """Shows the top allocators, and the difference with the previous snapshot"""
+        if not tracemalloc.is_tracing():
+            return await ctx.send('❌ tracemalloc is not tracing, start it first')
+
+        snapshot = await self.bot.loop.run_in_executor(None, profiling.take_snapshot)
+        report = profiling.format_top(snapshot, limit)
+        if self.snapshot is not None:
+            report += '\n\n' + profiling.format_diff(self.snapshot, snapshot, limit)
+        self.snapshot = snapshot
+        await self.send_report(ctx, 'tracemalloc', report)
+
+    @_tracemalloc.command(name='stop')
+    async def tracemalloc_stop(self, ctx: commands.Context):
+        """Stops tracing allocations and drops the snapshots"""
+        tracemalloc.stop()
+        self.snapshot = None
+        await ctx.send('Stopped tracing allocations')
+
     @commands.command(name="eval")
     async def _eval(self, ctx: commands.Context, *, inp: str):
         """Evaluates python code"""
@@ -53,7 +53,7 @@ class ConfigCog(commands.Cog, name="⚙️ Config Commands"):
                 await ctx.update_config({conf['name']: converted})
                 return await ctx.send(f"Successfully set the **{conf['title']}** to `{converted}`")
 
-            config = ctx.get_config()
+            config = await ctx.get_config()
             current = config.get(conf['name'], 'None')
             embed = discord.Embed(
                 title=conf['title'],
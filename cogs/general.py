@@ -1,3 +1,4 @@
+from collections import Counter
 from datetime import datetime
 import time as timer
 import platform
@@ -13,6 +14,38 @@ class GeneralCog(commands.Cog, name="💬 General Commands"):
     def __init__(self, bot):
         self.bot = bot
         self.process = psutil.Process()
+        self.guild_count = bot.metrics.gauge('discord_guilds', 'Guilds cached by this process, per shard', ('shard',))
+        self.member_count = bot.metrics.gauge('discord_members', 'Members of the guilds cached by this process')
+        self.count_guilds()
+
+    def count_guilds(self):
+        "Counts the cached guilds and their members, the counts are then kept up to date from events"
+        per_shard = Counter(g.shard_id for g in self.bot.guilds)
+        for shard in set(self.bot.shards) | set(per_shard):
+            self.guild_count.set(per_shard.get(shard, 0), shard=shard)
+        self.member_count.set(sum(g.member_count or 0 for g in self.bot.guilds))
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        self.count_guilds()
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        self.guild_count.inc(shard=guild.shard_id)
+        self.member_count.inc(guild.member_count or 0)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.guild_count.dec(shard=guild.shard_id)
+        self.member_count.dec(guild.member_count or 0)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        self.member_count.inc()
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        self.member_count.dec()
 
     @commands.command()
     async def ping(self, ctx):
@@ -30,18 +63,13 @@ class GeneralCog(commands.Cog, name="💬 General Commands"):
         """Add me to your discord server"""
         await ctx.send(f"To add **{self.bot.user.name}** to your guild, use the following link\n{self.bot.invite}")
 
-    @commands.command()
+    @commands.group(invoke_without_command=True)
     @commands.bot_has_permissions(embed_links=True)
     async def stats(self, ctx):
         """Shows you bot statistics"""
         uptime = time.friendly_duration(datetime.utcnow() - self.bot.uptime, long=True)
         memory_usage = self.process.memory_full_info().uss / 1024**2
         cpu_usage = self.process.cpu_percent() / psutil.cpu_count()
-        guilds = members = 0
-
-        for guild in self.bot.guilds:
-            guilds += 1
-            members += guild.member_count
 
         embed = discord.Embed()
         embed.title = 'Bot Statistics'
@@ -50,18 +78,91 @@ class GeneralCog(commands.Cog, name="💬 General Commands"):
             f"• Version      :: {self.bot.version}",
             f"• Uptime       :: {uptime}",
             f"• Users        :: {len(self.bot.users)}",
-            f"• Guilds       :: {len(self.bot.guilds)}",
+            f"• Members      :: {int(self.member_count.get())}",
+            f"• Guilds       :: {int(sum(self.guild_count.series().values()))}",
             f"• Discord.py   :: {discord.__version__}",
             f"• Python       :: {platform.python_version()}",
             f"• Memory Usage :: {memory_usage} MiB",
             f"• CPU Usage    :: {cpu_usage}%"
         ]), 'asciidoc')
 
+        giveaways = self.bot.get_cog("🎉 Giveaway Commands")
+        if giveaways:
+            # How the running giveaways of this process are spread over its shards
+            per_shard = giveaways.running.gauge
+            embed.add_field(name="Shards", value=utils.codeblock("\n".join(
+                [f"• Giveaways :: {len(giveaways.running)} (queued: {len(giveaways.scheduler)})"] +
+                [f"• Shard {shard}  :: {int(per_shard.get(shard=shard))} giveaways, {int(self.guild_count.get(shard=shard))} guilds"
+                 for shard in sorted(self.bot.shards)]
+            ), 'asciidoc'), inline=False)
+
         embed.add_field(name="Invite", value=f"[`Click Here`]({self.bot.invite})")
         embed.add_field(name="Support", value=f"[`Click Here`]({self.bot.support})")
 
         await ctx.send(embed=embed)
 
+    @commands.is_owner()
+    @commands.bot_has_permissions(embed_links=True)
+    @stats.command(name='full')
+    async def stats_full(self, ctx):
+        """Shows the scheduler, Discord and database metrics"""
+        metrics = self.bot.metrics
+
+        def ms(histogram, **labels):
+            p50, p99 = histogram.quantile(0.5, **labels), histogram.quantile(0.99, **labels)
+            if p50 is None:
+                return 'n/a'
+            return f'p50 {round(p50 * 1000, 1)}ms, p99 {round(p99 * 1000, 1)}ms'
+
+        lines = [f"• Loop Lag      :: {ms(metrics.get('event_loop_lag_seconds'))}"]
+        # Only when the storage is MongoDB
+        database = self.bot.database
+        if database is not None:
+            in_use = sum(metrics.get('mongo_pool_checked_out').series().values()) if metrics.get('mongo_pool_checked_out') else 0
+            lines += [
+                f"• Database      :: {'up' if database.healthy else 'down' if database.healthy is False else 'unknown'}, ping {ms(database.ping_latency)}",
+                f"• DB Pool       :: {int(in_use)} in use / {database.max_pool_size}"
+            ]
+        changes = metrics.get('changes_applied_total')
+        if changes and changes.total():
+            lag = metrics.get('change_propagation_seconds')
+            lines.append(f"• Changes       :: {int(changes.total())} applied, configs {ms(lag, collection='guilds')}, giveaways {ms(lag, collection='giveaways')}")
+        if metrics.get('giveaway_running'):
+            jobs = metrics.get('giveaway_job_seconds')
+            batches = metrics.get('giveaway_finish_batch_size')
+            edits = metrics.get('giveaway_edits_total')
+            lines += [
+                f"• Giveaways     :: {metrics.get('giveaway_running').get()} running, {metrics.get('giveaway_scheduled').get()} scheduled",
+                f"• Due Queue     :: {metrics.get('giveaway_due_queue').get()}",
+                f"• Schedule Lag  :: {ms(metrics.get('giveaway_schedule_lag_seconds'))}",
+                f"• Refresh       :: {ms(jobs, kind='refresh')}",
+                f"• Edits         :: {int(edits.get(result='sent'))} sent, {int(edits.get(result='suppressed'))} suppressed",
+                f"• Finish        :: {ms(jobs, kind='finish')}",
+                f"• Finish Delay  :: {ms(metrics.get('giveaway_finish_delay_seconds'))}",
+                f"• Finish Batch  :: {batches.count()} batches, p50 {round(batches.quantile(0.5) or 0)} giveaways"
+            ]
+
+        embed = discord.Embed(title='Bot Metrics', timestamp=datetime.utcnow())
+        embed.description = utils.codeblock("\n".join(lines), 'asciidoc')
+
+        rest = metrics.get('discord_rest_latency_seconds')
+        limited = metrics.get('discord_rest_ratelimited_total')
+        routes = sorted(rest.series().items(), key=lambda item: -sum(item[1][0]))[:8]
+        if routes:
+            embed.add_field(name="Discord REST", value=utils.codeblock("\n".join(
+                f"• {method} {route}\n  {sum(data[0])} requests, {limited.get(route=route)} 429s, {ms(rest, method=method, route=route)}"
+                for (method, route), data in routes
+            ), 'asciidoc'), inline=False)
+
+        mongo = metrics.get('mongo_command_latency_seconds')
+        if mongo and mongo.series():
+            embed.add_field(name="MongoDB", value=utils.codeblock("\n".join(
+                f"• {command} :: {sum(data[0])} commands, {ms(mongo, command=command)}"
+                for (command,), data in mongo.series().items()
+            ), 'asciidoc'), inline=False)
+
+        await ctx.send(embed=embed)
+
     @commands.bot_has_permissions(embed_links=True)
     @commands.command()
     async def help(self, ctx: commands.Context, *, cmd=''):
@@ -1,30 +1,70 @@
+from array import array
 from datetime import timedelta, datetime
 import asyncio
-import random
+import logging
+import math
+import time
 
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 
-from .utils.time import human_duration, friendly_duration
+from .utils.time import human_duration, friendly_duration, to_timestamp
 from .utils.context import Context, PromptCancelled
-
-
-async def select_winners(message: discord.Message, winner_count: int):
+from .utils.scheduler import Scheduler
+from .utils.workers import WorkerPool
+from .utils.registry import GiveawayRegistry
+from .utils.entrants import EntrantTracker
+from .utils.selection import Selection, reservoir_sample, rng, pack_ids, unpack_ids
+from .utils.eligibility import EligibilityResolver
+from .utils.render import RenderCache, displayed_seconds
+from .utils.planner import RefreshPlanner, refresh_interval
+from .utils.batching import Coalescer
+from .utils.utils import paginate
+
+log = logging.getLogger(__name__)
+
+# At 8 bytes each, the archived entrants of a giveaway stay well under the 16MB document limit
+MAX_ARCHIVED_ENTRANTS = 1000000
+# Giveaways loaded at startup between two yields to the event loop
+LOAD_BATCH = 500
+# Seconds before finishing a giveaway again after a failed attempt, doubled after each failure up to the max
+FINISH_RETRY = 5
+MAX_FINISH_RETRY = 15 * 60
+# Giveaways ending within the same window of seconds are finished together, at the end of the window
+FINISH_WINDOW = 1
+
+
+def is_eligible(user) -> bool:
+    "Checks whether a user that reacted can win a giveaway"
+    return isinstance(user, discord.Member) and not user.bot
+
+
+async def select_winners(message: discord.Message, winner_count: int, pool: array = None) -> Selection:
     """
-    Selects a given amount of winners, returns None if the number of reactions
-    are lesser than the required amount
+    Selects a given amount of winner ids from the reactions, the selection has no winners
+    if the number of eligible reactions are lesser than the required amount
+
+    Reactions are streamed page by page and only `winner_count` users are kept in memory,
+    the ids of every eligible user are added to `pool` if it is given
 
     NOTE: Make sure to fetch the message first in order to cache reactions
     """
     reaction = discord.utils.get(message.reactions, emoji="🎉")
     if not reaction:
-        return
+        return Selection(None, 0, 0)
 
-    users = await reaction.users().flatten() # users is now a list of User..
-    filtered = [u for u in users if isinstance(u, discord.Member) and not u.bot]
+    def check(user):
+        if not is_eligible(user):
+            return False
+        if pool is not None:
+            pool.append(user.id)
+        return True
 
-    if len(filtered) >= winner_count:
-        return random.sample(filtered, winner_count)
+    selection = await reservoir_sample(reaction.users(), winner_count, check)
+    selection.pool = pool
+    if selection.winners:
+        selection.winners = [u.id for u in selection.winners]
+    return selection
 
 
 def winnercount(arg: str) -> int:
@@ -36,6 +76,14 @@ def winnercount(arg: str) -> int:
     return num
 
 
+def message_id(arg: str) -> int:
+    "Takes a message id, a channelID-messageID pair or a message link"
+    try:
+        return int(arg.rstrip('/').replace('-', '/').rsplit('/', 1)[-1])
+    except ValueError:
+        raise commands.BadArgument("❌ That is not a message id or link")
+
+
 def convert_duration(arg: str) -> timedelta:
     "Makes sure the giveaway duration is in the limit"
     seconds = human_duration(arg)
@@ -48,45 +96,80 @@ def convert_duration(arg: str) -> timedelta:
 
 
 class Giveaway:
+    """
+    A running giveaway, kept as compact as possible since there can be tens of thousands of them
+
+    Only ids and epoch timestamps are stored. The channel, author and message are resolved
+    when needed and never kept, edits and announcements go through the ids directly
+    """
+    __slots__ = ('bot', 'authorID', 'channelID', 'messageID', 'guildID', 'title', 'ends', 'winners', 'finished', 'next_refresh', 'unit')
+
     def __init__(self, bot: commands.Bot, **data):
         self.bot = bot
         self.authorID = data.get('authorID')
         self.channelID = data.get('channelID')
         self.messageID = data.get('messageID', None)
         self.title = data.get('title')
-        self.endsat = data.get('endsat')
+        self.ends = to_timestamp(data['endsat'])
         self.winners = data.get('winners')
 
-        self.channel = self.bot.get_channel(self.channelID)
-        self.author = self.bot.get_user(self.authorID)
+        self.guildID = data.get('guildID') or getattr(getattr(self.channel, 'guild', None), 'id', None)
         self.finished = False
-        self.message = None
 
+        self.unit = refresh_interval(self.seconds_left())
         self.next_refresh = self.calculate_next_refresh()
 
     @property
-    def duration(self) -> timedelta:
-        "Gives the timedelta object for the time left for the giveaway to finish"
-        return self.endsat - datetime.utcnow()
+    def endsat(self) -> datetime:
+        "Returns when the giveaway ends, as a naive UTC datetime"
+        return datetime.utcfromtimestamp(self.ends)
+
+    @property
+    def channel(self) -> discord.TextChannel:
+        "Returns the channel of the giveaway if it is cached"
+        return self.bot.get_channel(self.channelID)
+
+    @property
+    def author(self) -> discord.User:
+        "Returns the host of the giveaway if it is cached"
+        return self.bot.get_user(self.authorID)
 
     @property
     def guild(self) -> discord.Guild:
         "Returns the guild the giveaway is running in"
-        return self.message.guild
-
-    def calculate_next_refresh(self) -> timedelta:
-        "Returns the datetime when the giveaway should refresh"
-        time_left = self.duration.seconds
-        if time_left > 24 * 3600: interval = 3 * 3600 # 3 hours at (> 1 day)
-        elif time_left > 3 * 3600: interval = 3600 # 1 hour at (3 hour - 24 hour)
-        elif time_left > 3600: interval = 15 * 60 # 15 minutes at (1 hour - 3hour)
-        elif time_left > 20 * 60: interval = 3 * 60 # 3 minutes at (20 minutes - 1 hour)
-        elif time_left > 5 * 60: interval = 60 # 1 minute at (5 minutes - 20 minutes)
-        elif time_left > 30: interval = 15 # 15 seconds at (30 seconds - 5 minutes)
-        else: interval = 5 # 5 seconds at (< 30 seconds)
-
-        # now return either the time when the giveaway ends or the next refresh interval
-        return min(self.endsat, datetime.utcnow() + timedelta(seconds=interval))
+        return self.bot.get_guild(self.guildID)
+
+    def seconds_left(self) -> float:
+        return self.ends - time.time()
+
+    @property
+    def duration(self) -> timedelta:
+        "Gives the timedelta object for the time left for the giveaway to finish"
+        return timedelta(seconds=self.seconds_left())
+
+    @property
+    def time_left(self) -> timedelta:
+        "Gives the time left as displayed on the message, rounded down to the refresh interval"
+        return timedelta(seconds=displayed_seconds(self.seconds_left(), self.unit))
+
+    @property
+    def jump_url(self) -> str:
+        "Returns the url of the giveaway message"
+        return f'https://discord.com/channels/{self.guildID}/{self.channelID}/{self.messageID}'
+
+    def calculate_next_refresh(self, planner: RefreshPlanner = None) -> float:
+        """
+        Returns the epoch timestamp when the displayed time left changes next, or when the giveaway ends
+
+        The countdown moves in steps of the refresh interval, as widened by the planner if any
+        """
+        seconds_left = self.seconds_left()
+        self.unit = planner.interval(seconds_left) if planner else refresh_interval(seconds_left)
+        return self.ends - displayed_seconds(seconds_left, self.unit)
+
+    def last_moments(self) -> str:
+        "Returns what is displayed once less than a refresh interval is left"
+        return f'less than {friendly_duration(timedelta(seconds=self.unit), long=True)}'
 
     def get_embed(self) -> discord.Embed:
         "Returns an embed that is displayed while the giveaway is running"
@@ -94,46 +177,90 @@ class Giveaway:
         embed.description = '\n'.join([
             '**React with 🎉 to enter**\n',
             f'**Winner Count:** `{self.winners}`',
-            f'**Time Left:** **{friendly_duration(self.duration, long=True)}**',
-            f'**Hosted By:** {self.author.mention}'
+            f'**Time Left:** **{friendly_duration(self.time_left, long=True) or self.last_moments()}**',
+            f'**Hosted By:** <@{self.authorID}>'
         ])
         embed.timestamp = self.endsat
         return embed.set_footer(text='Ends At:')
 
-    async def fetch_message(self):
-        "Fetches the message and caches it with the reactions"
-        self.message = await self.channel.fetch_message(self.messageID)
+    async def fetch_message(self) -> discord.Message:
+        "Fetches the message with its reactions, it is not kept"
+        channel = self.channel or await self.bot.fetch_channel(self.channelID) # raises NotFound if it was deleted
+        return await channel.fetch_message(self.messageID)
+
+    async def edit(self, **fields):
+        "Edits the giveaway message from its ids, raises NotFound if the message or channel is gone"
+        if 'embed' in fields:
+            fields['embed'] = fields['embed'].to_dict()
+        await self.bot.http.edit_message(self.channelID, self.messageID, **fields)
+
+    async def delete(self):
+        "Deletes the giveaway message, without fetching it"
+        await self.bot.http.delete_message(self.channelID, self.messageID)
 
     async def create(self) -> discord.Message:
         "Creates the giveaway message"
         embed = self.get_embed()
-        self.message = await self.channel.send("🎉 **GIVEAWAY STARTED** 🎉", embed=embed)
-        self.messageID = self.message.id
-        return self.message
+        message = await self.channel.send("🎉 **GIVEAWAY STARTED** 🎉", embed=embed)
+        self.messageID = message.id
+        return message
 
-    async def refresh(self):
-        "Refreshes the giveaway and edits the message with a new embed"
-        self.next_refresh = self.calculate_next_refresh()
-        await self.message.edit(embed=self.get_embed())
+    async def refresh(self, renders: RenderCache = None, planner: RefreshPlanner = None):
+        "Refreshes the giveaway and edits the message with a new embed, unless it is the same as the last one sent"
+        self.next_refresh = self.calculate_next_refresh(planner)
+        embed = self.get_embed()
+        if renders is not None and not renders.changed(self.messageID, embed):
+            return
 
-    async def finish(self):
-        "Finishes the giveaway and displays the winners if any"
-        self.finished = True
+        try:
+            await self.edit(embed=embed)
+        except discord.errors.HTTPException:
+            if renders is not None:
+                renders.forget(self.messageID)
+            raise
+        if renders is not None:
+            renders.edited()
+
+    def announcement(self, selection: Selection) -> str:
+        "Returns the message announcing the winners in the channel"
+        if not selection.winners:
+            return f'❌ Could not determine a winner for **{self.title}**'
+
+        str_winners = ', '.join(f'<@{w}>' for w in selection.winners)
+        return f'🎉 Congratulations {str_winners}! You won **{self.title}**\n{self.jump_url}'
+
+    def ended_embed(self, selection: Selection) -> discord.Embed:
+        "Returns the embed displayed once the giveaway has ended"
         embed = discord.Embed(title=self.title)
         embed.set_footer(text='Ended At:')
         embed.timestamp = datetime.utcnow()
-
-        await self.fetch_message() # need to fetch reactions first
-        winners = await select_winners(self.message, self.winners)
-        if not winners:
+        if not selection.winners:
             embed.description = f"The Giveaway has ended, not enough people voted.\n**Votes Required:** `{self.winners}`"
-            await self.channel.send('❌ Could not determine a winner')
         else:
-            str_winners = ', '.join(w.mention for w in winners)
-            embed.description = f"**Winner(s): {str_winners}**"
-            await self.channel.send(f'🎉 Congratulations {str_winners}! You won **{self.title}**\n{self.message.jump_url}')
-
-        return await self.message.edit(content="🎉 **GIVEAWAY ENDED** 🎉", embed=embed)
+            embed.description = f"**Winner(s): {', '.join(f'<@{w}>' for w in selection.winners)}**"
+        return embed
+
+    async def select_winners(self) -> Selection:
+        "Selects the winners from the reactions of the message"
+        message = await self.fetch_message() # need to fetch reactions first
+        # 8 bytes per eligible entrant, archived as is
+        return await select_winners(message, self.winners, array('Q'))
+
+    def archive(self, selection: Selection) -> dict:
+        "Returns the archived form of the ended giveaway, with its eligible entrants so that it can be rerolled"
+        pool = selection.pool or ()
+        if len(pool) > MAX_ARCHIVED_ENTRANTS:
+            # By index, arrays are not sequences to random.sample
+            pool = [pool[i] for i in rng.sample(range(len(pool)), MAX_ARCHIVED_ENTRANTS)]
+        return {
+            'messageID': self.messageID,
+            'guildID': self.guildID,
+            'channelID': self.channelID,
+            'title': self.title,
+            'endedat': datetime.utcnow(),
+            'winners': list(selection.winners or ()),
+            'eligible': pack_ids(pool)
+        }
 
 
 class GiveawayNotFound(BaseException):
@@ -143,101 +270,488 @@ class GiveawayNotFound(BaseException):
 class GiveawayCog(commands.Cog, name="🎉 Giveaway Commands"):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.running = []
-
-        self.giveaway_loop.start()
+        self.running = GiveawayRegistry(
+            gauge=bot.metrics.gauge('giveaway_running_per_shard', 'Giveaways run by this process, per shard of their guild', ('shard',)),
+            shard_of=bot.shard_of
+        )
+        self.scheduler = Scheduler(self.dispatch_giveaways)
+        self.workers = WorkerPool(bot.worker_concurrency, bot.channel_concurrency)
+        self.entrants = EntrantTracker(bot.writer)
+        self.eligibility = EligibilityResolver(bot)
+        self.renders = RenderCache(bot.metrics.counter('giveaway_edits_total', 'Countdown edits, sent or suppressed because nothing visible changed', ('result',)))
+        lag = getattr(bot, 'loop_lag', None)
+        self.planner = RefreshPlanner(
+            global_edits=bot.edit_budget,
+            lag=lambda: lag.recent if lag else 0,
+            ratelimits=bot.metrics.counter('discord_rest_ratelimited_total', 'Discord REST responses with status 429', ('route',)).total
+        )
+        self.leases = None
+        if bot.lease_duration:
+            self.leases = bot.storage.leases(bot.instance_id, bot.lease_duration)
+        self._lease_task = None
+        self.reconciling = False
+        # Giveaways that are due together are finished together, the short window catches the
+        # deadlines of a finish window that the scheduler converted to slightly different times
+        self.finisher = Coalescer(self.finish_giveaways, window=0.05)
+        # Failed finishes of each giveaway, for the retry backoff
+        self.finish_failures = {}
+        # Giveaways created or deleted by other processes
+        self.changes = getattr(bot, 'changes', None)
+        if self.changes:
+            self.changes.subscribe('giveaways', self.apply_change)
+            self.changes.resets.append(self.resync)
+
+        metrics = bot.metrics
+        self.schedule_lag = metrics.histogram('giveaway_schedule_lag_seconds', 'How late due giveaways are handed over to the workers')
+        self.job_latency = metrics.histogram('giveaway_job_seconds', 'Time taken to refresh or finish a giveaway', ('kind',))
+        self.finish_delay = metrics.histogram('giveaway_finish_delay_seconds', 'Time between the end of a giveaway and its winners being announced')
+        self.finish_batch = metrics.histogram('giveaway_finish_batch_size', 'Giveaways finished together', buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500))
+        metrics.gauge('giveaway_running', 'Giveaways run by this process', function=lambda: len(self.running))
+        metrics.gauge('giveaway_scheduled', 'Giveaways waiting for their next refresh', function=lambda: len(self.scheduler))
+        metrics.gauge('giveaway_due_queue', 'Due giveaways waiting for a worker', function=lambda: self.workers.pending)
+        metrics.gauge('giveaway_refresh_scale', 'How much refresh intervals are widened because of the load', function=lambda: self.planner.scale)
+        metrics.gauge('giveaway_refresh_deferred', 'Refreshes put off because the edit budget was spent', function=lambda: self.planner.deferred)
+
+        self.workers.start()
+        self.entrants.start()
+        self._startup = self.bot.loop.create_task(self.start_scheduler())
 
     def cog_unload(self):
-        self.giveaway_loop.cancel()
-
-    @tasks.loop(seconds=5)
-    async def giveaway_loop(self):
-        "This loop runs every 5 seconds and refreshes giveaways"
-        now = datetime.utcnow()
-        for giveaway in self.running:
-            if giveaway.next_refresh <= now:
+        self._startup.cancel()
+        if self.changes:
+            self.changes.unsubscribe('giveaways', self.apply_change)
+            self.changes.resets.remove(self.resync)
+        if self._lease_task:
+            self._lease_task.cancel()
+        self.scheduler.cancel()
+        self.workers.close()
+        self.finisher.close()
+        self.entrants.close()
+
+    def schedule(self, giveaway: Giveaway):
+        "Schedules the giveaway to be run at its next refresh, finishes are moved to the end of their `FINISH_WINDOW`"
+        if giveaway.next_refresh >= giveaway.ends:
+            giveaway.next_refresh = math.ceil(giveaway.next_refresh / FINISH_WINDOW) * FINISH_WINDOW
+        self.scheduler.schedule(giveaway.messageID, giveaway, giveaway.next_refresh)
+
+    async def dispatch_giveaways(self, giveaways: list):
+        """
+        Hands due giveaways over to the worker pool, the giveaways ending first are refreshed before the others
+
+        Ended giveaways are handed over to the finisher instead, the ones of the same finish window are finished in one batch
+        """
+        now = time.time()
+        for giveaway in giveaways:
+            self.schedule_lag.observe(max(now - giveaway.next_refresh, 0))
+            if giveaway.ends <= now:
+                self.finisher.add(giveaway.messageID, giveaway)
+            else:
+                self.workers.submit(giveaway.ends, giveaway.channelID, self.run_giveaway, giveaway)
+
+    async def run_giveaway(self, giveaway: Giveaway):
+        "Called by the scheduler when a giveaway is due, refreshes it and schedules the next refresh"
+        kind = 'finish' if giveaway.ends <= time.time() else 'refresh'
+        start = time.perf_counter()
+        try:
+            await self.refresh_giveaway(giveaway)
+        except discord.errors.NotFound:
+            # If the channel / message is not found then delete the giveaway
+            await self.delete_giveaway(giveaway)
+        finally:
+            self.job_latency.observe(time.perf_counter() - start, kind=kind)
+            if not giveaway.finished:
+                self.schedule(giveaway)
+            else:
+                self.running.remove(giveaway)
+
+    async def start_scheduler(self):
+        """
+        Loads the giveaways of the guilds served by this process, reinitializes them and starts the scheduler
+
+        The giveaways are read while the gateway connects and scheduled once the guilds are known,
+        both steps give the event loop back every `LOAD_BATCH` giveaways. A process serving only some
+        shards waits for its guilds first, so that only their giveaways are read.
+        Giveaways are rebuilt from their stored ids only, messages are fetched the first time they are needed.
+        Giveaways whose message was deleted are removed on their first failed edit
+        """
+        startup = self.bot.startup
+        with startup.phase('giveaways'):
+            start = time.perf_counter()
+            documents = []
+            guilds = None
+            if self.bot.shard_ids is not None:
+                await self.bot.wait_until_ready()
+                guilds = [g.id for g in self.bot.guilds]
+            with startup.phase('giveaways.fetch'):
+                async for data in self.bot.storage.iter_giveaways(guilds):
+                    # Giveaways created before guildID was stored are matched by their channel once it is cached
+                    if 'guildID' not in data or self.bot.owns_guild(data['guildID']):
+                        documents.append(data)
+                        if len(documents) % LOAD_BATCH == 0:
+                            await asyncio.sleep(0)
+
+            await self.bot.wait_until_ready()
+            with startup.phase('giveaways.schedule'):
+                guilds = {g.id for g in self.bot.guilds}
+                for i, data in enumerate(documents, 1):
+                    if i % LOAD_BATCH == 0:
+                        await asyncio.sleep(0)
+                    if self.running.get(data['messageID']):
+                        continue # Created while the giveaways were read
+
+                    giveaway = Giveaway(self.bot, **data)
+                    if 'guildID' not in data:
+                        if giveaway.guildID is None and self.bot.shard_ids is not None:
+                            continue # Channel is not cached, it belongs to another process (or was deleted)
+                        if giveaway.guildID is not None:
+                            self.bot.writer.update('giveaways', {'messageID': giveaway.messageID}, {'$set': {'guildID': giveaway.guildID}})
+                    elif giveaway.guildID not in guilds:
+                        continue # The bot is not in the guild anymore
+
+                    self.load_giveaway(giveaway, data)
+
+                self.scheduler.start()
+            self.time_to_schedulable = time.perf_counter() - start
+        print(f"Scheduled {len(self.running)} giveaways in {round(self.time_to_schedulable * 1000, 2)}ms")
+
+        if self.leases:
+            self._lease_task = self.bot.loop.create_task(self.lease_loop())
+
+        if self.bot.warmup_concurrency:
+            await self.warmup(self.bot.warmup_concurrency)
+        await self.reconcile_entrants()
+
+    def load_giveaway(self, giveaway: Giveaway, data: dict):
+        "Adds a giveaway loaded from the database to the running giveaways and schedules it"
+        if data.get('announced'):
+            return # Closed by the instance that announced it, or the one that takes over its lease
+
+        self.running.add(giveaway)
+        self.entrants.track(giveaway.messageID, data.get('entrants', ()))
+        self.schedule(giveaway)
+
+    async def lease_loop(self):
+        "Renews the leases of this instance, claims giveaways that end soon and takes over the ones of dead instances"
+        while True:
+            try:
+                for messageID in await self.leases.renew():
+                    giveaway = self.running.get(messageID)
+                    if giveaway and not self.bot.owns_guild(giveaway.guildID):
+                        self.drop_giveaway(giveaway) # Taken over by the instance that serves its guild
+
+                claimed = await self.leases.claim({'guildID': {'$in': [g.id for g in self.bot.guilds]}})
+                claimed += await self.leases.claim_expired()
+                for data in claimed:
+                    if data.get('announced'):
+                        await self.close_announced(data)
+                    elif not self.running.get(data['messageID']):
+                        self.load_giveaway(Giveaway(self.bot, **data), data)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Failed to renew or claim giveaway leases')
+
+            await asyncio.sleep(self.leases.duration / 3)
+
+    async def reconcile_entrants(self, concurrency: int = 2):
+        "Fetches the reactions of running giveaways to catch entrants that were missed while offline"
+        if self.reconciling:
+            return
+        # A few workers go through the giveaways, instead of a task for each of them
+        giveaways = iter(list(self.running))
+
+        async def reconcile():
+            for giveaway in giveaways:
+                if giveaway.finished:
+                    continue
+                try:
+                    await self.entrants.reconcile(self.bot.http, giveaway)
+                except discord.errors.HTTPException:
+                    pass # Stale giveaways are deleted on their next refresh
+
+        self.reconciling = True
+        try:
+            await asyncio.gather(*[reconcile() for _ in range(concurrency)])
+        finally:
+            self.reconciling = False
+
+    async def warmup(self, concurrency: int):
+        "Checks the messages of running giveaways ahead of time, deletes the giveaways whose message is gone"
+        giveaways = iter(list(self.running))
+
+        async def fetch():
+            for giveaway in giveaways:
+                if giveaway.finished:
+                    continue
                 try:
-                    await self.refresh_giveaway(giveaway)
+                    await giveaway.fetch_message()
+                except discord.errors.NotFound:
+                    await self.delete_giveaway(giveaway)
+                except discord.errors.HTTPException:
+                    pass
+
+        await asyncio.gather(*[fetch() for _ in range(concurrency)])
+
+    def drop_giveaway(self, giveaway: Giveaway):
+        "Stops running a giveaway in this process, without touching the database"
+        giveaway.finished = True
+        self.finish_failures.pop(giveaway.messageID, None)
+        self.scheduler.unschedule(giveaway.messageID)
+        self.entrants.untrack(giveaway.messageID)
+        self.renders.forget(giveaway.messageID)
+        self.running.remove(giveaway)
+        if self.leases:
+            self.leases.release(giveaway.messageID)
+
+    def apply_change(self, change):
+        "Runs the giveaways created by other processes in the guilds of this one, stops the ones they deleted"
+        giveaway = self.running.get(change.key)
+        if change.operation == 'delete':
+            if giveaway and not giveaway.finished:
+                self.drop_giveaway(giveaway)
+            return
+
+        data = change.document
+        # With leases, giveaways are claimed by the lease loop instead
+        if giveaway or self.leases or data is None or self.bot.get_guild(data.get('guildID')) is None:
+            return
+        self.load_giveaway(Giveaway(self.bot, **data), data)
+
+    async def resync(self):
+        "Runs the stored giveaways that are missing and stops the ones that were deleted, once changes were lost"
+        # The giveaways created from now on are not stored yet
+        running = list(self.running)
+        await self.bot.writer.flush()
+        stored = set()
+        async for data in self.bot.storage.iter_giveaways():
+            stored.add(data['messageID'])
+            if not self.leases and not self.running.get(data['messageID']) and self.bot.get_guild(data.get('guildID')) is not None:
+                self.load_giveaway(Giveaway(self.bot, **data), data)
+
+        for giveaway in running:
+            if giveaway.messageID not in stored and not giveaway.finished:
+                self.drop_giveaway(giveaway)
+
+    def retry_finish(self, giveaway: Giveaway):
+        "Schedules a giveaway that failed to finish to be finished again, later after each failure"
+        failures = self.finish_failures[giveaway.messageID] = self.finish_failures.get(giveaway.messageID, 0) + 1
+        giveaway.finished = False
+        giveaway.next_refresh = time.time() + min(FINISH_RETRY * 2 ** (failures - 1), MAX_FINISH_RETRY)
+        self.schedule(giveaway)
+
+    async def delete_giveaway(self, giveaway: Giveaway):
+        "Deletes a giveaway from the database"
+        self.bot.writer.delete('giveaways', { 'messageID': giveaway.messageID })
+        self.drop_giveaway(giveaway)
+
+    async def select_winners(self, giveaway: Giveaway) -> Selection:
+        "Selects the winners among the tracked entrants, or from the reactions if they are not tracked"
+        entrants = self.entrants.get(giveaway.messageID)
+        if entrants is not None and giveaway.guild is not None:
+            return await self.eligibility.select(giveaway.guild, giveaway.messageID, entrants, giveaway.winners)
+        elif entrants is not None and giveaway.guildID:
+            # Taken over from a dead instance, the guild is not cached here
+            return await self.eligibility.select_remote(giveaway.guildID, giveaway.messageID, entrants, giveaway.winners)
+        return await giveaway.select_winners()
+
+    async def finish_giveaway(self, giveaway: Giveaway):
+        "Finishes a giveaway and deletes it"
+        await self.finish_giveaways([giveaway])
+
+    async def finish_giveaways(self, giveaways: list):
+        """
+        Finishes giveaways that ended together and deletes them
+
+        Winners are selected concurrently, the announcements of each channel are merged into as few
+        messages as possible and the database writes of the whole batch are flushed at once
+        """
+        giveaways = [g for g in giveaways if not g.finished]
+        if not giveaways:
+            return
+
+        for giveaway in giveaways:
+            giveaway.finished = True
+            self.scheduler.unschedule(giveaway.messageID)
+        self.finish_batch.observe(len(giveaways))
+        semaphore = asyncio.Semaphore(self.bot.worker_concurrency)
+
+        async def prepare(giveaway):
+            async with semaphore:
+                try:
+                    selection = await self.select_winners(giveaway)
+                    if self.leases and not await self.leases.fence(giveaway.messageID):
+                        # Another instance holds the lease or already announced the winners
+                        return self.drop_giveaway(giveaway)
+                    return selection
                 except discord.errors.NotFound:
                     # If the channel / message is not found then delete the giveaway
                     await self.delete_giveaway(giveaway)
+                except Exception:
+                    log.exception('Failed to select the winners of giveaway %s', giveaway.messageID)
+                    self.retry_finish(giveaway)
+
+        selections = await asyncio.gather(*[prepare(g) for g in giveaways])
+        channels = {}
+        for giveaway, selection in zip(giveaways, selections):
+            if selection is not None:
+                channels.setdefault(giveaway.channelID, []).append((giveaway, selection))
 
-        self.running = [g for g in self.running if not g.finished]
+        # Winners are announced first, marking the messages as ended can wait
+        delays = []
+        announced = await asyncio.gather(*[self.announce(channelID, ended, delays, semaphore) for channelID, ended in channels.items()])
 
-    @giveaway_loop.before_loop
-    async def before_giveaway_loop(self):
-        "Loads all giveaways from database and reinitializes them"
-        await self.bot.wait_until_ready()
+        async def close(giveaway, selection):
+            async with semaphore:
+                await self.close_giveaway(giveaway, selection)
 
-        cursor = self.bot.db.giveaways.find() # gets all giveaways
-        async for data in cursor:
-            giveaway = Giveaway(self.bot, **data)
-            # try fetch the message and it to running, delete if not found
+        await asyncio.gather(*[close(g, s) for ended in announced for g, s in ended])
+        try:
+            await self.bot.writer.flush()
+        except Exception:
+            log.exception('Failed to write finished giveaways, they stay queued')
+
+        if len(giveaways) > 1 and delays:
+            delays.sort()
+            log.info('Finished %d giveaways in %d channels, announced after %.2fs (p50) / %.2fs (p99)', len(giveaways),
+                     len(channels), delays[len(delays) // 2], delays[min(int(len(delays) * 0.99), len(delays) - 1)])
+
+    async def announce(self, channelID: int, ended: list, delays: list, semaphore: asyncio.Semaphore) -> list:
+        """
+        Announces the winners of giveaways that ended in the same channel, in as few messages as possible
+
+        `ended` holds (giveaway, selection) pairs, the ones that were announced are returned.
+        The delay between the end of each giveaway and its announcement is added to `delays`
+        """
+        lines = [giveaway.announcement(selection) for giveaway, selection in ended]
+        announced = []
+        async with semaphore:
             try:
-                await giveaway.fetch_message()
+                for start, end in paginate(lines):
+                    await self.bot.http.send_message(channelID, '\n'.join(lines[start:end]))
+                    announced.extend(ended[start:end])
+                    if self.leases:
+                        await self.record_announced({g.messageID: list(s.winners or ()) for g, s in ended[start:end]})
             except discord.errors.NotFound:
-                await self.delete_giveaway(giveaway)
-            else:
-                self.running.append(giveaway)
+                for giveaway, _ in ended[len(announced):]:
+                    await self.delete_giveaway(giveaway)
+            except discord.errors.HTTPException:
+                log.exception('Failed to announce the winners of %d giveaways in channel %s', len(ended) - len(announced), channelID)
+                for giveaway, _ in ended[len(announced):]:
+                    self.retry_finish(giveaway)
+
+        now = time.time()
+        for giveaway, _ in announced:
+            delay = now - giveaway.ends
+            if delay >= 0: # Not ended early
+                self.finish_delay.observe(delay)
+                delays.append(delay)
+        return announced
+
+    async def record_announced(self, winners: dict):
+        "Records that the winners were announced, so that no other instance announces them again"
+        try:
+            await self.leases.announced(winners)
+        except Exception:
+            # Their documents are deleted once closed, only a crash until then would announce them again
+            log.exception('Failed to record the announcement of %d giveaways', len(winners))
 
-    async def delete_giveaway(self, giveaway: Giveaway):
-        "Deletes a giveaway from the database"
-        await self.bot.db.giveaways.delete_one({ 'messageID': giveaway.messageID })
-        giveaway.finished = True # In order to remove it from running
+    async def close_announced(self, data: dict):
+        "Closes a giveaway whose winners were announced by an instance that died before marking it as ended"
+        giveaway = Giveaway(self.bot, **data)
+        giveaway.finished = True
+        # Which entrants were eligible is not stored, rerolls draw from every stored entrant
+        entrants = data.get('entrants', [])
+        await self.close_giveaway(giveaway, Selection(data['announced']['winners'] or None, len(entrants), 0, entrants))
 
-    async def finish_giveaway(self, giveaway: Giveaway):
-        "Finishes a giveaway and deletes it"
-        await giveaway.finish()
-
-        # This is done to quickly find which was the last giveaway ran
-        # Its not necessary, but ensures that it finds the giveaway instead of looping through history
-        await self.bot.db.guilds.update_one(
-            {"guild": giveaway.guild.id},
-            {"$set": {"lastGiveaway": giveaway.messageID}}, # if you want it can be an array to store all giveaways ran
-            upsert=True
-        )
+    async def close_giveaway(self, giveaway: Giveaway, selection: Selection):
+        "Marks the message of an announced giveaway as ended and deletes the giveaway"
+        try:
+            await giveaway.edit(content="🎉 **GIVEAWAY ENDED** 🎉", embed=giveaway.ended_embed(selection))
+        except discord.errors.NotFound:
+            return await self.delete_giveaway(giveaway)
+        except discord.errors.HTTPException:
+            # The winners were announced, the giveaway must not be finished again
+            log.exception('Failed to edit the message of giveaway %s', giveaway.messageID)
 
-        return await self.delete_giveaway(giveaway)
+        # Kept until the archive TTL so that it can be rerolled without going through the reactions again
+        self.bot.writer.insert('archive', giveaway.archive(selection))
+        await self.delete_giveaway(giveaway)
 
     async def refresh_giveaway(self, giveaway: Giveaway):
         "Refreshes a giveaway, finishes it if the time is up"
         if giveaway.finished:
             return
-        if giveaway.endsat < datetime.utcnow():
+        seconds_left = giveaway.seconds_left()
+        if seconds_left <= 0:
             return await self.finish_giveaway(giveaway)
 
-        return await giveaway.refresh()
+        wait = self.planner.admit(giveaway.channelID, seconds_left)
+        if wait:
+            # Out of edit budget, try again once there is some unless the countdown changes before
+            giveaway.next_refresh = min(time.time() + wait, giveaway.calculate_next_refresh(self.planner), giveaway.ends)
+            return
+
+        return await giveaway.refresh(self.renders, self.planner)
 
     async def create_giveaway(self, **data) -> discord.Message:
         "Creates a new giveaway and saves it to the database"
         giveaway = Giveaway(self.bot, **data)
         message = await giveaway.create()
-        self.running.append(giveaway)
-
-        data.update({'messageID': message.id})
-        await self.bot.db.giveaways.insert_one(data)
+        self.renders.changed(giveaway.messageID, message.embeds[0])
+        self.running.add(giveaway)
+        self.entrants.track(giveaway.messageID)
+        self.schedule(giveaway)
+
+        data.update({'messageID': message.id, 'guildID': giveaway.guildID, 'entrants': []})
+        self.bot.writer.insert('giveaways', data)
+        await self.bot.writer.flush() # The giveaway message is already visible, it must not be lost
         return message
 
     def find_recent_giveaway(self, guildID: int, message: discord.Message = None) -> Giveaway:
         "Returns the giveaway with provided message or the most recent running giveaway"
-        lst = [g for g in self.running if g.guild.id == guildID]
-        if not lst:
+        giveaway = self.running.most_recent(guildID)
+        if not giveaway:
             raise GiveawayNotFound("❌ There are no giveaways running in this server")
 
-        if not message:
-            giveaway = lst[-1] # recently added to the list
-        else:
-            giveaway = next((g for g in lst if g.messageID == message.id), None)
-            if not giveaway:
+        if message:
+            giveaway = self.running.get(message.id)
+            if not giveaway or giveaway.guildID != guildID:
                 raise GiveawayNotFound("❌ Could not find that giveaway! Try again!")
 
         return giveaway
 
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        if not self.entrants.is_tracked(payload.message_id) or str(payload.emoji) != '🎉':
+            return
+        if payload.member and payload.member.bot:
+            return
+
+        self.entrants.add(payload.message_id, payload.user_id)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
+        if self.entrants.is_tracked(payload.message_id) and str(payload.emoji) == '🎉':
+            self.entrants.remove(payload.message_id, payload.user_id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        # Instead of waiting for their next edit to fail
+        for giveaway in self.running.in_channel(channel.id):
+            await self.delete_giveaway(giveaway)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # A new session may have missed reactions, the first ready is handled by start_scheduler.
+        # Sessions that drop again while the reactions are fetched don't start another pass
+        if self.scheduler.running:
+            await self.reconcile_entrants()
+
     async def cog_check(self, ctx):
         if ctx.author.guild_permissions.administrator:
             return True
 
-        roleid = ctx.get_config().get('giveawayrole')
+        roleid = (await ctx.get_config()).get('giveawayrole')
         return roleid and discord.utils.get(ctx.author.roles, id=roleid)
 
     @commands.guild_only()
@@ -311,7 +825,7 @@ class GiveawayCog(commands.Cog, name="🎉 Giveaway Commands"):
             await ctx.send(err)
         else:
             try:
-                await (msg or giveaway.message).delete()
+                await (msg.delete() if msg else giveaway.delete())
             except discord.errors.NotFound:
                 pass
 
@@ -323,44 +837,40 @@ class GiveawayCog(commands.Cog, name="🎉 Giveaway Commands"):
     @commands.command()
     async def glist(self, ctx: commands.Context):
         "Shows a list of running giveaways in the server"
-        lst = [g for g in self.running if g.guild.id == ctx.guild.id]
+        lst = self.running.in_guild(ctx.guild.id)
         if not lst:
             return await ctx.send("❌ There are no running giveaways in this server!")
 
         await ctx.send("\n".join([
-            f"**{i+1}]** `{g.messageID}` → {g.channel.mention} | `{g.winners}` **Winner(s)** | **Ends At:** {friendly_duration(g.duration)} | **Title:** `{g.title}`"
+            f"**{i+1}]** `{g.messageID}` → <#{g.channelID}> | `{g.winners}` **Winner(s)** | **Ends At:** {friendly_duration(g.duration)} | **Title:** `{g.title}`"
             for i, g in enumerate(lst)
         ]))
 
     @commands.guild_only()
-    @commands.bot_has_permissions(read_message_history=True)
     @commands.command()
-    async def greroll(self, ctx: commands.Context, *, msg: discord.Message = None):
-        "Rerolls the given message id or else rerolls the last giveaway"
-        if msg:
-            check = next((g for g in self.running if g.messageID == msg.id), None)
-            if check:
-                return await ctx.send("❌ This giveaway is running right now. Wait for it to end or use the `gend` command to stop it now!")
-        else:
-            config = await self.bot.db.guilds.find_one({'guild': ctx.guild.id})
-            if not config or "lastGiveaway" not in config:
-                return await ctx.send("❌ No giveaways were run in this guild!")
-
-            try:
-                msg = await ctx.channel.fetch_message(config.get("lastGiveaway"))
-            except discord.errors.NotFound:
-                return await ctx.send("❌ Could not find that giveaway message in this channel")
-
-        # Verify that its a giveaway message ...
-        if msg.author == self.bot.user:
-            winners = await select_winners(msg, 1)
-            if winners:
-                str_winners = ', '.join(w.mention for w in winners)
-                await ctx.send(f'🎉 **New winner is:** {str_winners}')
-            else:
-                await ctx.send("❌ Could not determine a winner")
-        else:
-            return await ctx.send("❌ Could not find that giveaway message in this channel")
+    async def greroll(self, ctx: commands.Context, *, message: message_id = None):
+        """
+        Rerolls the given message id or link or else rerolls the last giveaway, it can be used from any channel.
+        Previous winners are never drawn again
+        """
+        if message and self.running.get(message):
+            return await ctx.send("❌ This giveaway is running right now. Wait for it to end or use the `gend` command to stop it now!")
+
+        await self.bot.writer.flush() # The giveaway may still be queued for the archive
+        archived = await self.bot.storage.find_archived(ctx.guild.id, message)
+        if archived is None:
+            if message:
+                return await ctx.send("❌ Could not find that giveaway, it may have ended too long ago")
+            return await ctx.send("❌ No giveaways were run in this guild recently!")
+
+        previous = set(archived['winners'])
+        candidates = [u for u in unpack_ids(archived['eligible']) if u not in previous]
+        if not candidates:
+            return await ctx.send("❌ Could not determine a winner")
+
+        winner = rng.choice(candidates)
+        await self.bot.storage.add_archived_winner(archived['messageID'], winner)
+        await ctx.send(f"🎉 **New winner of {archived['title']} is:** <@{winner}>")
 
 
 def setup(bot):
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class Coalescer:
+    """
+    Groups keyed items that arrive within `window` seconds of the first one, and hands
+    them over together to `callback` (a coroutine function taking a list)
+
+    A group is handed over early once it holds `max_size` items. Adding an item that is
+    already waiting does nothing. Groups can run concurrently, errors are logged
+    """
+    def __init__(self, callback, *, window: float = 1, max_size: int = 500):
+        self.callback = callback
+        self.window = window
+        self.max_size = max_size
+
+        self._items = {}
+        self._timer = None
+        self._running = set()
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, key, item):
+        self._items.setdefault(key, item)
+        if len(self._items) >= self.max_size:
+            self._release()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.window, self._release)
+
+    def _release(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        items, self._items = list(self._items.values()), {}
+        task = asyncio.ensure_future(self._run(items))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, items: list):
+        try:
+            await self.callback(items)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception('Failed to handle a group of %d items', len(items))
+
+    def close(self):
+        "Cancels the running groups, items that are still waiting are dropped"
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for task in list(self._running):
+            task.cancel()
+        self._items = {}
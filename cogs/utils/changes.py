@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import time
+
+from .storage import ChangesLost
+
+log = logging.getLogger(__name__)
+
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class ChangeFeed:
+    """
+    Applies the giveaways and guild configs changed by any process to the caches of this one
+
+    - `open` starts watching, before anything is loaded so that what changes while loading is not missed
+    - `start` starts applying the changes, once everything is loaded
+    - Callbacks subscribed to a collection are called with each `Change` of that collection
+    - A failed stream is resumed after the last applied change, if the changes since then are gone
+      the callbacks in `resets` are called (and awaited if needed) to rebuild what they cached
+
+    The time between a change being stored and being applied is recorded, per collection
+    """
+    def __init__(self, storage, registry, *, retry: float = 5):
+        self.storage = storage
+        self.retry = retry
+        self.handlers = {}
+        self.resets = []
+        self.token = None
+
+        self.lag = registry.histogram('change_propagation_seconds', 'Time between a change being stored and being applied', ('collection',), buckets=LAG_BUCKETS)
+        self.applied = registry.counter('changes_applied_total', 'Changes made by any process applied to the caches', ('collection', 'operation'))
+        self.supported = True
+        self._stream = None
+        self._task = None
+
+    def subscribe(self, collection: str, callback):
+        self.handlers.setdefault(collection, []).append(callback)
+
+    def unsubscribe(self, collection: str, callback):
+        callbacks = self.handlers.get(collection, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+    async def _open(self) -> bool:
+        stream = self.storage.watch(self.token)
+        if stream is None:
+            self.supported = False
+            return False
+        try:
+            self._stream = await stream.open()
+        except NotImplementedError as err:
+            log.warning('Changes made by other processes will not be applied: %s', err)
+            self.supported = False
+            return False
+        return True
+
+    async def open(self) -> bool:
+        "Starts watching the changes, returns False if it failed or if the storage can't be watched"
+        try:
+            return self._stream is not None or await self._open()
+        except Exception:
+            log.exception('Failed to watch changes, trying again once started')
+            return False
+
+    def start(self):
+        "Starts applying the changes, the stream is opened first if needed"
+        if self._task is None and self.supported:
+            self._task = asyncio.ensure_future(self._run())
+
+    def apply(self, change):
+        for callback in self.handlers.get(change.collection, ()):
+            try:
+                callback(change)
+            except Exception:
+                log.exception('Failed to apply a change to %s', change.collection)
+
+        self.token = change.token
+        self.applied.inc(collection=change.collection, operation=change.operation)
+        self.lag.observe(max(time.time() - change.time, 0), collection=change.collection)
+
+    async def reset(self):
+        for callback in self.resets:
+            try:
+                result = callback()
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception:
+                log.exception('Failed to rebuild after losing changes')
+
+    async def _close_stream(self):
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            try:
+                await stream.close()
+            except Exception:
+                pass
+
+    async def _run(self):
+        while True:
+            try:
+                if self._stream is None and not await self._open():
+                    return
+                async for change in self._stream:
+                    self.apply(change)
+            except asyncio.CancelledError:
+                raise
+            except ChangesLost:
+                log.warning('Changes were lost, rebuilding the caches')
+                await self._close_stream()
+                # Watching again from now on, before rebuilding
+                self.token = None
+                if await self._open():
+                    await self.reset()
+                continue
+            except NotImplementedError as err:
+                # Motor only runs the aggregate once iterated, a standalone server fails here
+                log.warning('Changes made by other processes will not be applied: %s', err)
+                self.supported = False
+                await self._close_stream()
+                return
+            except Exception:
+                log.exception('Change stream failed, resuming in %ss', self.retry)
+
+            await self._close_stream()
+            await asyncio.sleep(self.retry)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self._close_stream()
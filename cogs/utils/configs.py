@@ -0,0 +1,151 @@
+from collections import OrderedDict
+import asyncio
+import time
+
+
+DEFAULT_CONFIG = {'prefix': 'm!', 'giveawayrole': None}
+
+
+def build_prefixes(mentions: tuple, config: dict) -> tuple:
+    "Returns the prefixes of a guild and the set of their first characters"
+    prefixes = mentions + (config.get('prefix') or DEFAULT_CONFIG['prefix'],)
+    return prefixes, frozenset(prefix[0] for prefix in prefixes)
+
+
+class GuildConfigCache:
+    """
+    Guild configs loaded on demand and kept in a size bounded LRU cache
+
+    - Entries expire `ttl` seconds after being loaded
+    - Concurrent misses for the same guild share a single query
+    - Guilds without a config are cached too, as an empty config
+
+    Returned configs only hold what is stored, use `DEFAULT_CONFIG` for the rest
+
+    The command prefixes of each guild are built once when its config is cached,
+    as a tuple ready for `str.startswith` along with the set of their first characters
+    """
+    def __init__(self, storage, *, maxsize: int = 10000, ttl: float = 600):
+        self.storage = storage
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self.mentions = ()
+        self.default_prefixes = build_prefixes(self.mentions, DEFAULT_CONFIG)
+        # guildID -> (expires, config, prefixes)
+        self._entries = OrderedDict()
+        self._loading = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def set_user(self, userID: int):
+        "Sets the bot user whose mentions are valid prefixes, rebuilding the cached prefixes"
+        self.mentions = (f'<@{userID}> ', f'<@!{userID}> ')
+        self.default_prefixes = build_prefixes(self.mentions, DEFAULT_CONFIG)
+        for guildID, (expires, config, _) in self._entries.items():
+            self._entries[guildID] = (expires, config, build_prefixes(self.mentions, config))
+
+    def _peek(self, guildID: int):
+        entry = self._entries.get(guildID)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+
+        self._entries.move_to_end(guildID)
+        return entry
+
+    def peek(self, guildID: int):
+        "Returns the cached config without loading it, None if it is not cached or expired"
+        entry = self._peek(guildID)
+        return entry and entry[1]
+
+    def peek_prefixes(self, guildID: int):
+        "Returns the cached (prefixes, first characters) of a guild, None if its config is not cached"
+        entry = self._peek(guildID)
+        return entry and entry[2]
+
+    async def get_prefixes(self, guildID: int) -> tuple:
+        "Returns the (prefixes, first characters) of a guild, loading its config if needed"
+        entry = self._peek(guildID)
+        if entry is not None:
+            return entry[2]
+
+        config = await self.get(guildID)
+        entry = self._entries.get(guildID)
+        # The load can be dropped by an invalidation, the prefixes are built for this call only then
+        return entry[2] if entry is not None else build_prefixes(self.mentions, config)
+
+    async def get(self, guildID: int) -> dict:
+        "Returns the config of a guild, loading it from the storage if needed"
+        config = self.peek(guildID)
+        if config is not None:
+            return config
+
+        future = self._loading.get(guildID)
+        if future is None:
+            future = self._loading[guildID] = asyncio.ensure_future(self._load(guildID))
+            future.add_done_callback(lambda f: self._loaded(guildID, f))
+
+        return await asyncio.shield(future)
+
+    async def _load(self, guildID: int) -> dict:
+        return await self.storage.get_config(guildID)
+
+    def _loaded(self, guildID: int, future: asyncio.Future):
+        # An invalidation while loading drops the load, it may hold the old config
+        if self._loading.get(guildID) is not future:
+            return
+
+        del self._loading[guildID]
+        if not future.cancelled() and future.exception() is None:
+            self.set(guildID, future.result())
+
+    def set(self, guildID: int, config: dict):
+        self._entries[guildID] = (time.monotonic() + self.ttl, config, build_prefixes(self.mentions, config))
+        self._entries.move_to_end(guildID)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    async def warm(self, owns=lambda guildID: True) -> int:
+        """
+        Loads the stored configs of the guilds `owns` returns True for in a single query, up to the size of the cache
+
+        Returns the amount of configs loaded
+        """
+        loaded = 0
+        async for config in self.storage.iter_configs():
+            guildID = config.pop('guild', None)
+            if guildID is None or not owns(guildID) or guildID in self._entries or guildID in self._loading:
+                continue
+
+            self.set(guildID, config)
+            loaded += 1
+            if loaded >= self.maxsize:
+                break
+        return loaded
+
+    def fill(self, guildIDs):
+        "Caches an empty config for the guilds that are not cached yet, once every stored config was loaded by `warm`"
+        for guildID in guildIDs:
+            if len(self._entries) >= self.maxsize:
+                return
+            if guildID not in self._entries and guildID not in self._loading:
+                self.set(guildID, {})
+
+    def invalidate(self, guildID: int):
+        "Drops the cached config, the next access loads it again"
+        self._entries.pop(guildID, None)
+        self._loading.pop(guildID, None)
+
+    def apply(self, change):
+        "Applies a config changed by any process (a `Change`), only if the guild is cached"
+        if change.key not in self._entries and change.key not in self._loading:
+            return
+        # A load started before the change may return the old config
+        self._loading.pop(change.key, None)
+        self.set(change.key, change.document or {})
+
+    def clear(self):
+        "Drops every cached config"
+        self._entries.clear()
+        self._loading.clear()
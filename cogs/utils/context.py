@@ -2,30 +2,26 @@ import inspect
 
 from discord.ext import commands
 
+from .configs import DEFAULT_CONFIG
+
 
 class PromptCancelled(Exception):
     pass
 
 
 class Context(commands.Context):
-    def get_config(self):
+    async def get_config(self):
         # Default Config
-        config = {'prefix': 'm!', 'giveawayrole': None}
+        config = dict(DEFAULT_CONFIG)
         if not self.guild:
             return config
 
-        config.update(self.bot.guild_config.get(self.guild.id, {}))
+        config.update(await self.bot.configs.get(self.guild.id))
         return config
 
     async def update_config(self, data):
-        await self.bot.db.guilds.update_one(
-            {"guild": self.guild.id},
-            {"$set": data},
-            upsert=True
-        )
-        config = self.bot.guild_config.get(self.guild.id, {})
-        config.update(data)
-        self.bot.guild_config[self.guild.id] = config
+        await self.bot.storage.update_config(self.guild.id, data)
+        self.bot.configs.invalidate(self.guild.id)
 
     async def prompt(self, question, *, converter=str, timeout=60):
         def check(msg):
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import time
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from .metrics import MongoListener, PoolListener
+
+log = logging.getLogger(__name__)
+
+
+class Database:
+    """
+    The database the bot uses for its whole life, with a single connection pool
+
+    Collections are accessed from it directly (`database.giveaways`, `database['guilds']`).
+    Once started, the server is pinged every `health_interval` seconds: `healthy` and the
+    `mongo_up` gauge tell whether the last ping succeeded, and its latency is recorded.
+    Reads and writes interrupted by a network error or a failover are retried once by the driver
+
+    `memory://` uses the in-memory stand-in of `benchmarks.memorydb` instead, for development and tests only.
+    `client` can be given to share one between instances
+    """
+    def __init__(self, uri: str, registry, loop: asyncio.AbstractEventLoop, *, name: str = 'dpy', client=None,
+                 min_pool_size: int = 0, max_pool_size: int = 100, server_selection_timeout: float = 30,
+                 connect_timeout: float = 20, socket_timeout: float = None, retry_reads: bool = True,
+                 retry_writes: bool = True, health_interval: float = 30):
+        if client is None and uri.startswith('memory://'):
+            from benchmarks.memorydb import MemoryClient
+            client = MemoryClient()
+        elif client is None:
+            client = AsyncIOMotorClient(
+                uri,
+                minPoolSize=min_pool_size,
+                maxPoolSize=max_pool_size,
+                serverSelectionTimeoutMS=int(server_selection_timeout * 1000),
+                connectTimeoutMS=int(connect_timeout * 1000),
+                socketTimeoutMS=socket_timeout and int(socket_timeout * 1000),
+                retryReads=retry_reads,
+                retryWrites=retry_writes,
+                event_listeners=[MongoListener(registry, loop), PoolListener(registry, loop)]
+            )
+
+        self.client = client
+        self.db = client[name]
+        self.max_pool_size = max_pool_size
+        self.health_interval = health_interval
+        self.healthy = None
+
+        self.up = registry.gauge('mongo_up', 'Whether the last health check of the database succeeded')
+        self.ping_latency = registry.histogram('mongo_ping_seconds', 'Latency of the database health checks')
+        self._task = None
+
+    def __getitem__(self, name: str):
+        return self.db[name]
+
+    def __getattr__(self, name: str):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.db, name)
+
+    async def ping(self) -> float:
+        "Pings the server, returns the latency in seconds"
+        start = time.perf_counter()
+        await self.db.command('ping')
+        latency = time.perf_counter() - start
+        self.ping_latency.observe(latency)
+        return latency
+
+    async def check(self) -> bool:
+        "Runs a health check, state changes are logged"
+        try:
+            await self.ping()
+        except Exception as err:
+            if self.healthy is not False:
+                log.error('Database health check failed: %s', err)
+            healthy = False
+        else:
+            if self.healthy is False:
+                log.info('Database is reachable again')
+            healthy = True
+
+        self.healthy = healthy
+        self.up.set(int(healthy))
+        return healthy
+
+    async def _run(self):
+        while True:
+            await self.check()
+            await asyncio.sleep(self.health_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        "Stops the health checks and closes the connection pool"
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.client.close()
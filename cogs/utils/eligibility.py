@@ -0,0 +1,153 @@
+from collections import OrderedDict
+import time
+
+import discord
+
+from .selection import Selection, rng
+
+
+class MemberInfo:
+    "The parts of a member needed to decide whether they can win"
+    __slots__ = ('member', 'bot', 'roles', 'expires')
+
+    def __init__(self, member: bool, bot: bool = False, roles=(), *, expires: float):
+        self.member = member
+        self.bot = bot
+        self.roles = frozenset(roles)
+        self.expires = expires
+
+    @property
+    def eligible(self) -> bool:
+        return self.member and not self.bot
+
+
+class EligibilityResolver:
+    """
+    Resolves entrant ids to guild members in bulk
+
+    - Members already in the library cache are used directly
+    - Large guilds with many unknown entrants are chunked once through the gateway
+    - Otherwise unknown entrants are queried by id, 100 at a time
+
+    Resolved membership, bot flag and roles are cached for `ttl` seconds, and the
+    eligible entrants of a giveaway are kept (up to `keep`) so rerolls don't resolve them again
+    """
+    QUERY_LIMIT = 100
+
+    def __init__(self, bot, *, ttl: float = 600, chunk_threshold: int = 1000, keep: int = 100):
+        self.bot = bot
+        self.ttl = ttl
+        self.chunk_threshold = chunk_threshold
+        self.keep = keep
+
+        self._members = {}
+        self._giveaways = OrderedDict()
+        self._next_purge = time.monotonic() + ttl
+
+    def _store(self, guildID: int, userID: int, member) -> MemberInfo:
+        expires = time.monotonic() + self.ttl
+        if member is None:
+            info = MemberInfo(False, expires=expires)
+        else:
+            info = MemberInfo(True, member.bot, (r.id for r in member.roles), expires=expires)
+
+        self._members[(guildID, userID)] = info
+        return info
+
+    async def resolve(self, guild, user_ids) -> dict:
+        "Returns a MemberInfo for each user id"
+        now = time.monotonic()
+        if now >= self._next_purge:
+            self.purge()
+
+        resolved, unknown = {}, []
+        for userID in user_ids:
+            info = self._members.get((guild.id, userID))
+            if info is not None and info.expires > now:
+                resolved[userID] = info
+                continue
+
+            member = guild.get_member(userID)
+            if member is not None:
+                resolved[userID] = self._store(guild.id, userID, member)
+            else:
+                unknown.append(userID)
+
+        if not unknown:
+            return resolved
+
+        if guild.large and not guild.chunked and len(unknown) >= self.chunk_threshold:
+            # Cheaper to receive the whole member list once than to query each id
+            await self.bot.request_offline_members(guild)
+            for userID in unknown:
+                resolved[userID] = self._store(guild.id, userID, guild.get_member(userID))
+            return resolved
+
+        if not guild.large or guild.chunked:
+            # Every member is already cached, the unknown ids have left the guild
+            for userID in unknown:
+                resolved[userID] = self._store(guild.id, userID, None)
+            return resolved
+
+        for i in range(0, len(unknown), self.QUERY_LIMIT):
+            chunk = unknown[i:i + self.QUERY_LIMIT]
+            members = await guild.query_members(user_ids=chunk, limit=self.QUERY_LIMIT, cache=False)
+            found = {m.id: m for m in members}
+            for userID in chunk:
+                resolved[userID] = self._store(guild.id, userID, found.get(userID))
+
+        return resolved
+
+    async def select(self, guild, messageID: int, entrants, winner_count: int) -> Selection:
+        "Selects winner ids out of the eligible entrants of a giveaway"
+        eligible = self._giveaways.get(messageID)
+        if eligible is None:
+            resolved = await self.resolve(guild, entrants)
+            eligible = [u for u, info in resolved.items() if info.eligible]
+
+            self._giveaways[messageID] = eligible
+            while len(self._giveaways) > self.keep:
+                self._giveaways.popitem(last=False)
+
+        ineligible = max(len(entrants) - len(eligible), 0)
+        if len(eligible) < winner_count:
+            return Selection(None, len(eligible), ineligible, eligible)
+
+        return Selection(rng.sample(eligible, winner_count), len(eligible), ineligible, eligible)
+
+    async def select_remote(self, guildID: int, messageID: int, entrants, winner_count: int) -> Selection:
+        """
+        Selects winner ids for a guild that is not cached by this process (eg. after taking over
+        the giveaway of a dead instance), random entrants are checked through the API until enough are found
+        """
+        eligible = self._giveaways.get(messageID)
+        if eligible is not None:
+            return await self.select(None, messageID, entrants, winner_count)
+
+        winners, rejected = [], set()
+        for userID in rng.sample(list(entrants), len(entrants)):
+            try:
+                data = await self.bot.http.get_member(guildID, userID)
+            except discord.NotFound:
+                rejected.add(userID)
+                continue
+
+            if data['user'].get('bot'):
+                rejected.add(userID)
+                continue
+
+            winners.append(userID)
+            if len(winners) == winner_count:
+                break
+
+        # Entrants that were not checked are assumed to be eligible
+        pool = [u for u in entrants if u not in rejected]
+        if len(winners) < winner_count:
+            return Selection(None, len(winners), len(rejected), pool)
+        return Selection(winners, len(winners), len(rejected), pool)
+
+    def purge(self):
+        "Drops expired members from the cache"
+        now = time.monotonic()
+        self._members = {k: v for k, v in self._members.items() if v.expires > now}
+        self._next_purge = now + self.ttl
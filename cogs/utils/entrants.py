@@ -0,0 +1,134 @@
+async def fetch_entrants(http, channelID: int, messageID: int, emoji: str = '🎉') -> set:
+    "Paginates every user that reacted with the emoji, returns the ids of the ones that are not bots"
+    entrants = set()
+    after = None
+    while True:
+        page = await http.get_reaction_users(channelID, messageID, emoji, 100, after=after)
+        entrants.update(int(u['id']) for u in page if not u.get('bot'))
+        if len(page) < 100:
+            return entrants
+
+        after = page[-1]['id']
+
+
+class EntrantTracker:
+    """
+    Keeps the entrants of running giveaways up to date from raw reaction events
+
+    Changes are kept in memory and queued as `entrants` updates on the giveaway documents
+    whenever the write queue flushes, which is brought forward once `batch_size` changes are pending
+    """
+    def __init__(self, writer, *, batch_size: int = 500):
+        self.writer = writer
+        self.batch_size = batch_size
+
+        self._entrants = {}
+        self._added = {}
+        self._removed = {}
+        self._pending = 0
+        self._reconciling = {}
+
+    def is_tracked(self, messageID: int) -> bool:
+        return messageID in self._entrants
+
+    def get(self, messageID: int) -> set:
+        "Returns the entrant ids of a tracked giveaway, None if it is not tracked"
+        return self._entrants.get(messageID)
+
+    def track(self, messageID: int, entrants=()):
+        "Starts tracking a giveaway with already known entrants"
+        self._entrants[messageID] = set(entrants)
+
+    def untrack(self, messageID: int):
+        "Stops tracking a giveaway and drops any pending changes"
+        self._entrants.pop(messageID, None)
+        self._pending -= len(self._added.pop(messageID, ())) + len(self._removed.pop(messageID, ()))
+        self._reconciling.pop(messageID, None)
+
+    def add(self, messageID: int, userID: int):
+        if messageID not in self._entrants:
+            return
+
+        self._entrants[messageID].add(userID)
+        self._change(messageID, userID, self._added, self._removed)
+        if messageID in self._reconciling:
+            self._reconciling[messageID][userID] = True
+
+    def remove(self, messageID: int, userID: int):
+        if messageID not in self._entrants:
+            return
+
+        self._entrants[messageID].discard(userID)
+        self._change(messageID, userID, self._removed, self._added)
+        if messageID in self._reconciling:
+            self._reconciling[messageID][userID] = False
+
+    def _change(self, messageID, userID, into, opposite):
+        opposite_ids = opposite.get(messageID)
+        if opposite_ids and userID in opposite_ids:
+            opposite_ids.discard(userID)
+            self._pending -= 1
+
+        ids = into.setdefault(messageID, set())
+        if userID not in ids:
+            ids.add(userID)
+            self._pending += 1
+
+        if self._pending >= self.batch_size:
+            self.writer.wake()
+
+    async def reconcile(self, http, giveaway, emoji: str = '🎉'):
+        """
+        Replaces the tracked entrants of a giveaway with the users that actually reacted
+
+        This catches reactions that were added or removed while the bot was offline.
+        Events received while the reactions are being paginated are applied on top
+        """
+        messageID = giveaway.messageID
+        if messageID not in self._entrants:
+            return
+
+        self._reconciling[messageID] = changes = {}
+        try:
+            entrants = await fetch_entrants(http, giveaway.channelID, messageID, emoji)
+        finally:
+            self._reconciling.pop(messageID, None)
+
+        if messageID not in self._entrants:
+            return # ended while reconciling
+
+        for userID, present in changes.items():
+            if present:
+                entrants.add(userID)
+            else:
+                entrants.discard(userID)
+
+        self._entrants[messageID] = entrants
+        self._pending -= len(self._added.pop(messageID, ())) + len(self._removed.pop(messageID, ()))
+        self.writer.update('giveaways', {'messageID': messageID}, {'$set': {'entrants': list(entrants)}})
+
+    def flush(self):
+        "Queues every pending change on the write queue"
+        if not self._pending:
+            return
+
+        added, removed = self._added, self._removed
+        self._added, self._removed, self._pending = {}, {}, 0
+
+        for messageID, ids in added.items():
+            if ids:
+                self.writer.update('giveaways', {'messageID': messageID}, {'$addToSet': {'entrants': {'$each': list(ids)}}})
+        for messageID, ids in removed.items():
+            if ids:
+                self.writer.update('giveaways', {'messageID': messageID}, {'$pull': {'entrants': {'$in': list(ids)}}})
+
+    def start(self):
+        "Hooks into the write queue so that pending changes are queued before it flushes"
+        if self.flush not in self.writer.hooks:
+            self.writer.hooks.append(self.flush)
+
+    def close(self):
+        "Unhooks from the write queue and queues whatever is still pending"
+        if self.flush in self.writer.hooks:
+            self.writer.hooks.remove(self.flush)
+        self.flush()
@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta
+import os
+import socket
+import uuid
+
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+
+from .schema import GIVEAWAY_PROJECTION
+
+
+def instance_id() -> str:
+    "Returns an id that is unique to this process"
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+class LeaseManager:
+    """
+    Leases on giveaways, stored in the `lease` field (owner, expires, token) of giveaway documents
+
+    - `claim` takes the unleased giveaways that end within `horizon` seconds
+    - `claim_expired` takes over giveaways whose lease expired, eg. when their instance died
+    - `renew` extends the leases held by this instance and reports the ones it lost
+
+    Every claim is a single `find_one_and_update` and increments the lease token, so two
+    instances can never hold the same lease. Announcing winners is fenced through `fence`,
+    which only succeeds for one instance at a time, and recorded with the winners through `announced` once sent.
+    A giveaway whose winners were not announced can be taken over and finished by another instance,
+    one whose winners were announced can only be taken over to be closed
+    """
+    def __init__(self, collection, owner: str, *, duration: float = 60, horizon: float = 300, batch: int = 100):
+        self.collection = collection
+        self.owner = owner
+        self.duration = duration
+        self.horizon = horizon
+        self.batch = batch
+        self.held = {}
+
+    def _expires(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=self.duration)
+
+    async def _claim(self, query: dict) -> list:
+        claimed = []
+        for _ in range(self.batch):
+            data = await self.collection.find_one_and_update(
+                query,
+                {'$set': {'lease.owner': self.owner, 'lease.expires': self._expires()}, '$inc': {'lease.token': 1}},
+                projection=GIVEAWAY_PROJECTION,
+                sort=[('endsat', ASCENDING)],
+                return_document=ReturnDocument.AFTER
+            )
+            if data is None:
+                break
+
+            self.held[data['messageID']] = data['lease']['token']
+            claimed.append(data)
+
+        return claimed
+
+    async def claim(self, filter: dict = None) -> list:
+        "Claims unleased giveaways that end soon (optionally matching `filter`), returns their documents"
+        now = datetime.utcnow()
+        query = {
+            'endsat': {'$lte': now + timedelta(seconds=self.horizon)},
+            'announced': {'$exists': False},
+            '$or': [{'lease': {'$exists': False}}, {'lease.expires': {'$lt': now}}]
+        }
+        if filter:
+            query = {'$and': [query, filter]}
+
+        return await self._claim(query)
+
+    async def claim_expired(self, grace: float = None) -> list:
+        """
+        Claims giveaways that end soon whose lease expired more than `grace` seconds ago,
+        the ones that were already announced (see `announced`) included
+
+        The grace period (one lease duration by default) leaves the instance that serves
+        the guild a chance to claim it first
+        """
+        now = datetime.utcnow()
+        grace = self.duration if grace is None else grace
+        return await self._claim({
+            'endsat': {'$lte': now + timedelta(seconds=self.horizon)},
+            'lease.expires': {'$lt': now - timedelta(seconds=grace)}
+        })
+
+    async def renew(self) -> list:
+        "Extends every lease held by this instance, returns the message ids of the leases that were lost"
+        if not self.held:
+            return []
+
+        ids = list(self.held)
+        await self.collection.update_many(
+            {'messageID': {'$in': ids}, 'lease.owner': self.owner},
+            {'$set': {'lease.expires': self._expires()}}
+        )
+
+        cursor = self.collection.find({'messageID': {'$in': ids}, 'lease.owner': self.owner}, {'_id': 0, 'messageID': 1})
+        kept = {data['messageID'] async for data in cursor}
+        lost = [m for m in ids if m not in kept]
+        for messageID in lost:
+            self.held.pop(messageID, None)
+
+        return lost
+
+    async def fence(self, messageID: int) -> bool:
+        """
+        Takes the lease of the giveaway exclusively, returns False if another instance holds
+        its lease or already announced its winners. Winners must only be announced if this returns True
+        """
+        now = datetime.utcnow()
+        free = [{'lease': {'$exists': False}}, {'lease.expires': {'$lt': now}}]
+        if messageID in self.held:
+            free.append({'lease.owner': self.owner, 'lease.token': self.held[messageID]})
+
+        data = await self.collection.find_one_and_update(
+            {'messageID': messageID, 'announced': {'$exists': False}, '$or': free},
+            {'$set': {'lease.owner': self.owner, 'lease.expires': self._expires()}, '$inc': {'lease.token': 1}},
+            projection={'_id': 0, 'lease': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if data is None:
+            return False
+
+        self.held[messageID] = data['lease']['token']
+        return True
+
+    async def announced(self, winners: dict):
+        """
+        Records that the winners of fenced giveaways were announced, they can't be fenced again
+
+        `winners` maps the message id of each giveaway to its winner ids, stored in `announced`
+        so that another instance can close the giveaway if this one dies before
+        """
+        await self.collection.bulk_write([
+            UpdateOne({'messageID': messageID, 'lease.owner': self.owner}, {'$set': {'announced': {'owner': self.owner, 'winners': ids}}})
+            for messageID, ids in winners.items()
+        ], ordered=False)
+
+    def release(self, messageID: int):
+        "Forgets a lease, eg. once the giveaway is deleted"
+        self.held.pop(messageID, None)
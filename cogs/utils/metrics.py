@@ -0,0 +1,367 @@
+"""
+Counters, gauges and histograms updated as things happen, and exposed in the Prometheus text format
+
+Everything is updated from the event loop, observations made in other threads
+(eg. by the mongodb driver) are handed over to the loop first
+"""
+from bisect import bisect_left
+from functools import partial
+import asyncio
+import logging
+import time
+
+from aiohttp import web
+from discord.errors import HTTPException
+from pymongo import monitoring
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    labels = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[n] for n in self.labels)
+
+    def series(self) -> dict:
+        "Returns the value of every label set, as {label values: value}"
+        return dict(self._values)
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for key, value in self._values.items():
+            lines.append(f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def total(self) -> float:
+        return sum(self._values.values())
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down
+
+    Unlabelled gauges can read their value from `function` when rendered instead, for
+    values that are already maintained somewhere else (eg. the length of a queue)
+    """
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), function=None):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        if self.function is not None:
+            return self.function()
+        return self._values.get(self._key(labels), 0)
+
+    def series(self) -> dict:
+        if self.function is not None:
+            return {(): self.function()}
+        return super().series()
+
+    def render(self) -> list:
+        if self.function is None:
+            return super().render()
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {_format_value(self.function())}']
+
+
+class Histogram(Metric):
+    "Counts observations in cumulative buckets, along with their sum"
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        data = self._values.get(key)
+        if data is None:
+            # per bucket counts (not cumulative), sum
+            data = self._values[key] = [[0] * len(self.buckets), 0]
+
+        data[0][bisect_left(self.buckets, value)] += 1
+        data[1] += value
+
+    def count(self, **labels) -> int:
+        data = self._values.get(self._key(labels))
+        return sum(data[0]) if data else 0
+
+    def sum(self, **labels) -> float:
+        data = self._values.get(self._key(labels))
+        return data[1] if data else 0
+
+    def quantile(self, q: float, **labels) -> float:
+        "Estimates a quantile by interpolating within its bucket, None without observations"
+        data = self._values.get(self._key(labels))
+        if not data:
+            return None
+
+        counts = data[0]
+        rank = q * sum(counts)
+        seen = 0
+        for i, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i else 0
+                upper = self.buckets[i]
+                if upper == float('inf'):
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return None
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="{}"'.format(_format_value(bound))
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {cumulative}')
+        return lines
+
+
+class Registry:
+    "Holds every metric by name, asking for an existing metric returns it"
+    def __init__(self):
+        self._metrics = {}
+
+    def _get(self, cls, name: str, *args, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, *args, **kwargs)
+        elif type(metric) is not cls:
+            raise ValueError(f'{name} is already registered as a {metric.type}')
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: tuple = (), function=None) -> Gauge:
+        gauge = self._get(Gauge, name, help, labels)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def get(self, name: str):
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        "Returns every metric in the Prometheus text format"
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class RateLimitHandler(logging.Handler):
+    "Counts the 429s discord.py logs (and retries), by route"
+    def __init__(self, counter: Counter):
+        super().__init__(logging.WARNING)
+        self.counter = counter
+
+    def emit(self, record: logging.LogRecord):
+        if not isinstance(record.msg, str):
+            return
+        if record.msg.startswith('We are being rate limited'):
+            # The bucket is channel_id:guild_id:path
+            self.counter.inc(route=str(record.args[1]).split(':', 2)[-1])
+        elif record.msg.startswith('Global rate limit'):
+            self.counter.inc(route='global')
+
+
+def instrument_http(http, registry: Registry):
+    "Measures the latency of every Discord REST request and counts 429s and errors, by route"
+    latency = registry.histogram('discord_rest_latency_seconds', 'Discord REST request latency, rate limit waits included', ('method', 'route'))
+    errors = registry.counter('discord_rest_errors_total', 'Discord REST requests that failed', ('route', 'status'))
+    limited = registry.counter('discord_rest_ratelimited_total', 'Discord REST responses with status 429', ('route',))
+    request = http.request
+
+    async def timed_request(route, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await request(route, **kwargs)
+        except HTTPException as err:
+            errors.inc(route=route.path, status=err.status)
+            raise
+        finally:
+            latency.observe(time.perf_counter() - start, method=route.method, route=route.path)
+
+    http.request = timed_request
+    logging.getLogger('discord.http').addHandler(RateLimitHandler(limited))
+
+
+class MongoListener(monitoring.CommandListener):
+    "Measures mongodb command latency, the driver calls it from its own threads"
+    def __init__(self, registry: Registry, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.latency = registry.histogram('mongo_command_latency_seconds', 'MongoDB command latency', ('command',))
+        self.failures = registry.counter('mongo_command_failures_total', 'MongoDB commands that failed', ('command',))
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.loop.call_soon_threadsafe(partial(self.latency.observe, event.duration_micros / 1e6, command=event.command_name))
+
+    def failed(self, event):
+        self.loop.call_soon_threadsafe(partial(self.latency.observe, event.duration_micros / 1e6, command=event.command_name))
+        self.loop.call_soon_threadsafe(partial(self.failures.inc, command=event.command_name))
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    "Tracks the connections of the mongodb connection pools, the driver calls it from its own threads"
+    def __init__(self, registry: Registry, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.open = registry.gauge('mongo_pool_connections', 'Open connections in the mongodb connection pool', ('address',))
+        self.in_use = registry.gauge('mongo_pool_checked_out', 'Connections checked out of the mongodb connection pool', ('address',))
+        self.failures = registry.counter('mongo_pool_checkout_failures_total', 'Connections that could not be checked out', ('reason',))
+
+    def _call(self, func, *args, **kwargs):
+        self.loop.call_soon_threadsafe(partial(func, *args, **kwargs))
+
+    @staticmethod
+    def _address(event) -> str:
+        return '{}:{}'.format(*event.address)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        self._call(self.open.set, 0, address=self._address(event))
+        self._call(self.in_use.set, 0, address=self._address(event))
+
+    def connection_created(self, event):
+        self._call(self.open.inc, address=self._address(event))
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._call(self.open.dec, address=self._address(event))
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._call(self.failures.inc, reason=event.reason)
+
+    def connection_checked_out(self, event):
+        self._call(self.in_use.inc, address=self._address(event))
+
+    def connection_checked_in(self, event):
+        self._call(self.in_use.dec, address=self._address(event))
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop wakes up a task that sleeps every `interval` seconds
+
+    `recent` is a moving average of the last measurements
+    """
+    def __init__(self, registry: Registry, interval: float = 0.5):
+        self.interval = interval
+        self.lag = registry.histogram('event_loop_lag_seconds', 'How late the event loop runs scheduled callbacks')
+        self.recent = 0
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = loop.time() - start - self.interval
+            self.lag.observe(lag)
+            self.recent = 0.8 * self.recent + 0.2 * lag
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class MetricsServer:
+    "Serves the registry at /metrics"
+    def __init__(self, registry: Registry, host: str = '127.0.0.1', port: int = 9100):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.registry.render().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        log.info('Serving metrics on http://%s:%s/metrics', self.host, self.port)
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
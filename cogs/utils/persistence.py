@@ -0,0 +1,180 @@
+from collections import OrderedDict
+import asyncio
+import logging
+
+from pymongo import DeleteOne, InsertOne, UpdateOne
+
+log = logging.getLogger(__name__)
+
+INSERT, UPDATE, DELETE = 'insert', 'update', 'delete'
+
+
+class WriteError(Exception):
+    """
+    Queued writes that were rejected and would be rejected again (eg. a duplicate key)
+
+    `index` is the position of the rejected write in its batch: the writes before it were applied and
+    the ones after it were not run. None if it is not known, the whole batch is then dropped
+    """
+    def __init__(self, message, index: int = None):
+        super().__init__(message)
+        self.index = index
+
+
+class Operation:
+    "A queued write on a single document"
+    __slots__ = ('kind', 'filter', 'payload', 'upsert')
+
+    def __init__(self, kind: str, filter: dict, payload: dict = None, upsert: bool = False):
+        self.kind = kind
+        self.filter = filter
+        self.payload = payload
+        self.upsert = upsert
+
+    @property
+    def only_sets(self) -> bool:
+        return self.kind == UPDATE and set(self.payload) == {'$set'}
+
+    def to_request(self):
+        if self.kind == INSERT:
+            return InsertOne(self.payload)
+        if self.kind == UPDATE:
+            return UpdateOne(self.filter, self.payload, upsert=self.upsert)
+        return DeleteOne(self.filter)
+
+
+class WriteBehindQueue:
+    """
+    Queues storage writes and flushes them in batches, applied in order through `Storage.write`
+
+    Writes are flushed every `interval` seconds or once `batch_size` writes are pending.
+    Writes to the same document (same collection and filter) are coalesced:
+
+    - `$set` updates are merged into a pending insert or `$set` update
+    - a delete drops the writes queued before it, and drops the insert too if the document was never written
+
+    Callers that need their writes to be durable await `flush()`. Callables in `hooks`
+    are called before every flush, so that other components can queue their own pending writes
+    """
+    def __init__(self, storage, *, interval: float = 1, batch_size: int = 500):
+        self.storage = storage
+        self.interval = interval
+        self.batch_size = batch_size
+        self.hooks = []
+
+        self._pending = OrderedDict()
+        self._size = 0
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return self._size
+
+    def insert(self, collection: str, document: dict, key: str = 'messageID'):
+        "Queues an insert, `key` is the field that identifies the document for coalescing"
+        self._push(collection, Operation(INSERT, {key: document[key]}, document))
+
+    def update(self, collection: str, filter: dict, update: dict, *, upsert: bool = False):
+        self._push(collection, Operation(UPDATE, filter, update, upsert))
+
+    def delete(self, collection: str, filter: dict):
+        self._push(collection, Operation(DELETE, filter))
+
+    def wake(self):
+        "Flushes as soon as possible"
+        self._wakeup.set()
+
+    def _push(self, collection: str, operation: Operation):
+        key = (collection, tuple(sorted(operation.filter.items())))
+        ops = self._pending.setdefault(key, [])
+
+        if operation.kind == DELETE and ops:
+            self._size -= len(ops)
+            if ops[0].kind == INSERT:
+                del self._pending[key] # The document was never written
+                return
+            ops.clear()
+
+        elif operation.only_sets and ops:
+            last = ops[-1]
+            fields = operation.payload['$set']
+            if last.kind == INSERT and not any('.' in field for field in fields):
+                last.payload.update(fields)
+                return
+            if last.only_sets:
+                last.payload['$set'].update(fields)
+                last.upsert = last.upsert or operation.upsert
+                return
+
+        ops.append(operation)
+        self._size += 1
+        if self._size >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        "Writes everything queued so far, one batch per collection"
+        for hook in self.hooks:
+            hook()
+
+        async with self._lock:
+            if not self._pending:
+                return
+
+            pending, self._pending, self._size = self._pending, OrderedDict(), 0
+            collections = OrderedDict()
+            for (collection, _), ops in pending.items():
+                collections.setdefault(collection, []).extend(ops)
+
+            while collections:
+                collection, ops = collections.popitem(last=False)
+                try:
+                    await self.storage.write(collection, ops)
+                except WriteError as err:
+                    # Bad writes would fail again, they are dropped but the writes that were not run are retried
+                    log.error('Dropped a failed write on %s: %s', collection, err)
+                    if err.index is not None and err.index + 1 < len(ops):
+                        collections[collection] = ops[err.index + 1:]
+                        collections.move_to_end(collection, last=False)
+                except Exception:
+                    collections[collection] = ops
+                    collections.move_to_end(collection, last=False)
+                    self._requeue(collections)
+                    raise
+
+    def _requeue(self, collections: OrderedDict):
+        "Puts unwritten writes back in front of the writes that were queued after them"
+        pending = OrderedDict()
+        for collection, ops in collections.items():
+            for op in ops:
+                pending.setdefault((collection, tuple(sorted(op.filter.items()))), []).append(op)
+
+        for key, later in self._pending.items():
+            pending.setdefault(key, []).extend(later)
+
+        self._pending = pending
+        self._size = sum(len(ops) for ops in pending.values())
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        "Stops the flush loop and writes everything that is still pending"
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                log.exception('Failed to flush queued writes')
@@ -0,0 +1,126 @@
+import time
+
+
+def refresh_interval(seconds_left: float) -> int:
+    "Returns how often (in seconds) the time left should change on the message"
+    if seconds_left > 24 * 3600: interval = 3 * 3600 # 3 hours at (> 1 day)
+    elif seconds_left > 3 * 3600: interval = 3600 # 1 hour at (3 hour - 24 hour)
+    elif seconds_left > 3600: interval = 15 * 60 # 15 minutes at (1 hour - 3hour)
+    elif seconds_left > 20 * 60: interval = 3 * 60 # 3 minutes at (20 minutes - 1 hour)
+    elif seconds_left > 5 * 60: interval = 60 # 1 minute at (5 minutes - 20 minutes)
+    elif seconds_left > 30: interval = 15 # 15 seconds at (30 seconds - 5 minutes)
+    else: interval = 5 # 5 seconds at (< 30 seconds)
+
+    return interval
+
+
+class TokenBucket:
+    "`capacity` tokens refilled continuously at `rate` tokens per second"
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated')
+
+    def __init__(self, capacity: float, rate: float, now: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def wait(self, needed: float) -> float:
+        "Seconds until `needed` tokens are available, the bucket must be refilled first"
+        return max(needed - self.tokens, 0) / self.rate
+
+
+class RefreshPlanner:
+    """
+    Shares the edit budget between the countdown refreshes of every giveaway
+
+    - Each channel can be edited `channel_edits` times per `channel_period` seconds (what Discord allows),
+      and all channels together `global_edits` times per second
+    - Refreshes are spent by urgency: a giveaway in its final minute can use every token left, while
+      longer giveaways have to leave part of each bucket (see `RESERVES`) for the ones that end sooner
+    - Every `period` seconds, the refresh intervals are doubled (up to `max_scale`) if the event loop
+      lag or the rate of 429s is too high, and halved back towards their normal values once both are low
+
+    `lag` and `ratelimits` are callables returning the recent event loop lag in seconds, and the total
+    number of 429s received so far
+    """
+    # (seconds left, share of the bucket that must be left for more urgent giveaways)
+    RESERVES = ((60, 0), (3600, 0.25), (float('inf'), 0.5))
+
+    def __init__(self, *, channel_edits: int = 5, channel_period: float = 5, global_edits: float = 30,
+                 lag=lambda: 0, ratelimits=lambda: 0, max_lag: float = 0.25, max_ratelimits: float = 0.5,
+                 max_scale: int = 8, period: float = 10):
+        self.channel_edits = channel_edits
+        self.channel_rate = channel_edits / channel_period
+        self.lag = lag
+        self.ratelimits = ratelimits
+        self.max_lag = max_lag
+        self.max_ratelimits = max_ratelimits
+        self.max_scale = max_scale
+        self.period = period
+
+        self.scale = 1
+        self.deferred = 0
+        now = time.monotonic()
+        self._global = TokenBucket(global_edits, global_edits, now)
+        self._channels = {}
+        self._next_adjust = now + period
+        self._ratelimits = ratelimits()
+
+    def interval(self, seconds_left: float) -> int:
+        "Returns the refresh interval of a giveaway, widened under load"
+        return refresh_interval(seconds_left) * self.scale
+
+    def reserve(self, seconds_left: float) -> float:
+        for threshold, reserve in self.RESERVES:
+            if seconds_left <= threshold:
+                return reserve
+
+    def _buckets(self, channelID: int, now: float):
+        bucket = self._channels.get(channelID)
+        if bucket is None:
+            bucket = self._channels[channelID] = TokenBucket(self.channel_edits, self.channel_rate, now)
+        bucket.refill(now)
+        self._global.refill(now)
+        return bucket, self._global
+
+    def admit(self, channelID: int, seconds_left: float) -> float:
+        """
+        Takes an edit from the budget of the channel, returns 0 if it was taken
+        or else how many seconds to wait before trying again
+        """
+        now = time.monotonic()
+        if now >= self._next_adjust:
+            self.adjust(now)
+
+        reserve = self.reserve(seconds_left)
+        waits = [bucket.wait(1 + bucket.capacity * reserve) for bucket in self._buckets(channelID, now)]
+        if any(waits):
+            self.deferred += 1
+            return max(waits)
+
+        for bucket in self._buckets(channelID, now):
+            bucket.tokens -= 1
+        return 0
+
+    def adjust(self, now: float = None):
+        "Widens or narrows the refresh intervals depending on the load"
+        now = time.monotonic() if now is None else now
+        elapsed = now - self._next_adjust + self.period
+        ratelimits = self.ratelimits()
+        rate = (ratelimits - self._ratelimits) / elapsed if elapsed > 0 else 0
+        self._ratelimits = ratelimits
+
+        lag = self.lag()
+        if lag > self.max_lag or rate > self.max_ratelimits:
+            self.scale = min(self.scale * 2, self.max_scale)
+        elif lag < self.max_lag / 2 and rate == 0:
+            self.scale = max(self.scale // 2, 1)
+
+        # Buckets that are full again are the same as new ones
+        self._channels = {k: b for k, b in self._channels.items() if b.refill(now) < b.capacity}
+        self._next_adjust = now + self.period
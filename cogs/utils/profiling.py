@@ -0,0 +1,175 @@
+"""
+Profiling tools that only run while they are asked to, nothing is hooked otherwise
+
+- `StackSampler` samples the stack of the event loop thread from another thread
+- `BlockingDetector` reports the tasks that hold the event loop for longer than a threshold
+- `format_top` / `format_diff` summarize tracemalloc snapshots
+"""
+from collections import Counter
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class StackSampler:
+    """
+    Samples the stack of a thread every `interval` seconds
+
+    Stacks are counted in the collapsed format (root;...;leaf count) that flame graph tools read
+    """
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(_frame_name(frame))
+            frame = frame.f_back
+
+        self.stacks[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self) -> str:
+        return '\n'.join(f'{stack} {count}' for stack, count in self.stacks.most_common())
+
+    def top(self, limit: int = 25) -> str:
+        "Returns the functions found in most samples, by own time (leaf) and total time (anywhere in the stack)"
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for name in set(frames):
+                total[name] += count
+
+        lines = [f'{self.samples} samples every {self.interval * 1000:g}ms', '', 'own%   total%  function']
+        for name, count in own.most_common(limit):
+            lines.append(f'{count / self.samples:6.1%} {total[name] / self.samples:6.1%}  {name}')
+        return '\n'.join(lines)
+
+
+class BlockingDetector:
+    """
+    Reports what runs on the event loop when it does not get back to its callbacks within `threshold` seconds
+
+    A callback rescheduled on the loop marks it as responsive, a watchdog thread
+    takes the stack of the loop thread and the running task when it stops being called
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, threshold: float = 0.1, *, keep: int = 50):
+        self.loop = loop
+        self.threshold = threshold
+        self.keep = keep
+        self.reports = []
+        self.dropped = 0
+
+        self._beat = time.monotonic()
+        self._open = None
+        self._handle = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._thread_id = None
+
+    def _heartbeat(self):
+        now = time.monotonic()
+        if self._open is not None:
+            self._open['blocked'] = now - self._beat
+            self._open = None
+        self._beat = now
+        self._handle = self.loop.call_later(self.threshold / 4, self._heartbeat)
+
+    def _report(self):
+        frame = sys._current_frames().get(self._thread_id)
+        task = asyncio.current_task(self.loop)
+        report = {
+            'task': repr(task) if task else 'no task (callback or event loop internals)',
+            'blocked': time.monotonic() - self._beat,
+            'stack': ''.join(traceback.format_stack(frame)) if frame else ''
+        }
+        if len(self.reports) < self.keep:
+            self.reports.append(report)
+        else:
+            self.dropped += 1
+        return report
+
+    def _watch(self):
+        while not self._stop.wait(self.threshold / 4):
+            beat = self._beat
+            if self._open is None and time.monotonic() - beat > self.threshold:
+                report = self._report()
+                if self._beat == beat: # Still blocked, the next heartbeat records for how long
+                    self._open = report
+                else:
+                    report['blocked'] = self._beat - beat
+
+    def start(self):
+        "Must be called from the event loop thread"
+        self._thread_id = threading.get_ident()
+        self._heartbeat()
+        self._thread = threading.Thread(target=self._watch, name='blocking-detector', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._handle.cancel()
+
+    def format(self) -> str:
+        lines = [f'{len(self.reports) + self.dropped} blocks over {self.threshold * 1000:g}ms']
+        if self.dropped:
+            lines.append(f'(only the first {self.keep} are shown)')
+        for report in self.reports:
+            lines += ['', f"Blocked for {report['blocked'] * 1000:.1f}ms by {report['task']}", report['stack']]
+        return '\n'.join(lines)
+
+
+def take_snapshot() -> tracemalloc.Snapshot:
+    "Takes a tracemalloc snapshot without the allocations of tracemalloc itself"
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>')
+    ])
+
+
+def format_top(snapshot: tracemalloc.Snapshot, limit: int = 25) -> str:
+    "Returns the lines that allocated the most memory still alive"
+    stats = snapshot.statistics('lineno')
+    total = sum(stat.size for stat in stats)
+    lines = [f'{total / 1024 ** 2:.1f} MiB traced in {len(stats)} lines', '']
+    lines += [str(stat) for stat in stats[:limit]]
+    return '\n'.join(lines)
+
+
+def format_diff(old: tracemalloc.Snapshot, new: tracemalloc.Snapshot, limit: int = 25) -> str:
+    "Returns the lines whose allocations grew or shrank the most between two snapshots"
+    stats = new.compare_to(old, 'lineno')
+    change = sum(stat.size_diff for stat in stats)
+    lines = [f'{change / 1024 ** 2:+.2f} MiB since the previous snapshot', '']
+    lines += [str(stat) for stat in stats[:limit]]
+    return '\n'.join(lines)
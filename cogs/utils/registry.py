@@ -0,0 +1,78 @@
+class GiveawayRegistry:
+    """
+    In-memory index of the running giveaways
+
+    - Lookup by message id is a dict access
+    - Giveaways of a guild are kept in insertion order, so the most recent one is the last key
+    - Giveaways of a channel are kept as a set of message ids
+    - If a `gauge` is given, it counts the giveaways of each shard (its `shard` label, from `shard_of(guildID)`)
+
+    Anything stored must have `messageID`, `guildID` and `channelID` attributes
+    """
+    def __init__(self, *, gauge=None, shard_of=None):
+        self.gauge = gauge
+        self.shard_of = shard_of
+        self._by_message = {}
+        self._by_guild = {}
+        self._by_channel = {}
+
+    def __len__(self):
+        return len(self._by_message)
+
+    def __iter__(self):
+        return iter(list(self._by_message.values()))
+
+    def __contains__(self, giveaway):
+        return giveaway.messageID in self._by_message
+
+    def add(self, giveaway):
+        "Adds a giveaway to the registry, replacing any giveaway with the same message id"
+        self.remove(giveaway)
+        self._by_message[giveaway.messageID] = giveaway
+        self._by_guild.setdefault(giveaway.guildID, {})[giveaway.messageID] = giveaway
+        self._by_channel.setdefault(giveaway.channelID, set()).add(giveaway.messageID)
+        if self.gauge is not None and giveaway.guildID:
+            self.gauge.inc(shard=self.shard_of(giveaway.guildID))
+
+    def remove(self, giveaway) -> bool:
+        "Removes a giveaway from the registry, returns whether it was registered"
+        messageID = giveaway.messageID
+        if messageID not in self._by_message:
+            return False
+
+        giveaway = self._by_message.pop(messageID)
+
+        guild = self._by_guild[giveaway.guildID]
+        del guild[messageID]
+        if not guild:
+            del self._by_guild[giveaway.guildID]
+
+        channel = self._by_channel[giveaway.channelID]
+        channel.discard(messageID)
+        if not channel:
+            del self._by_channel[giveaway.channelID]
+
+        if self.gauge is not None and giveaway.guildID:
+            self.gauge.dec(shard=self.shard_of(giveaway.guildID))
+
+        return True
+
+    def get(self, messageID: int):
+        "Returns the giveaway for the message id or None"
+        return self._by_message.get(messageID)
+
+    def in_guild(self, guildID: int) -> list:
+        "Returns the giveaways running in a guild, oldest first"
+        return list(self._by_guild.get(guildID, {}).values())
+
+    def in_channel(self, channelID: int) -> list:
+        "Returns the giveaways running in a channel"
+        return [self._by_message[m] for m in self._by_channel.get(channelID, ())]
+
+    def most_recent(self, guildID: int):
+        "Returns the most recently started giveaway in a guild or None"
+        guild = self._by_guild.get(guildID)
+        if not guild:
+            return None
+
+        return guild[next(reversed(guild))]
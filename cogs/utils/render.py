@@ -0,0 +1,47 @@
+import hashlib
+import json
+import math
+
+# Wake ups can be a little early, this keeps them from rendering the previous value again
+TOLERANCE = 0.5
+
+
+def displayed_seconds(time_left: float, unit: int) -> int:
+    "Rounds the time left down to the unit shown on the countdown, so that it never shows more than what is left"
+    return max(math.floor((time_left - TOLERANCE) / unit), 0) * unit
+
+
+class RenderCache:
+    """
+    Remembers a hash of the last embed sent for each message, so that
+    edits which would not change anything visible can be skipped
+
+    `edits` is a counter labelled by result: `sent` for the edits that went through (see `edited`)
+    and `suppressed` for the ones that were skipped
+    """
+    def __init__(self, edits):
+        self._hashes = {}
+        self.edits = edits
+
+    @staticmethod
+    def digest(embed) -> bytes:
+        content = json.dumps(embed.to_dict(), sort_keys=True)
+        return hashlib.blake2b(content.encode(), digest_size=8).digest()
+
+    def changed(self, key, embed) -> bool:
+        "Returns whether the embed differs from the last one sent for the key, and records it as sent if so"
+        digest = self.digest(embed)
+        if self._hashes.get(key) == digest:
+            self.edits.inc(result='suppressed')
+            return False
+
+        self._hashes[key] = digest
+        return True
+
+    def edited(self):
+        "Counts an edit that went through"
+        self.edits.inc(result='sent')
+
+    def forget(self, key):
+        "Forgets what was sent for the key, eg. after a failed edit"
+        self._hashes.pop(key, None)
@@ -0,0 +1,121 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+def to_monotonic(when: float) -> float:
+    "Converts an epoch timestamp into a deadline on the monotonic clock"
+    return time.monotonic() + (when - time.time())
+
+
+class Scheduler:
+    """
+    Deadline driven scheduler backed by a binary heap
+
+    Items are keyed (usually by message id) and each key has at most one live deadline.
+    Rescheduling or removing a key marks the old heap entry as dead instead of
+    searching the heap for it, dead entries are simply dropped when they reach the top.
+
+    The runner sleeps until the earliest deadline and is woken up early whenever
+    an earlier deadline is added or an entry is removed. Items that are due together
+    are handed over to `callback` in a single list.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def schedule(self, key, item, when: float):
+        "Schedules (or reschedules) the item with the given key to be called at `when`, an epoch timestamp"
+        self._discard(key)
+        entry = [to_monotonic(when), next(self._counter), key, item]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+
+        # Only need to wake the runner if this is the new earliest deadline
+        if self._heap[0] is entry:
+            self._wakeup.set()
+
+    def unschedule(self, key):
+        "Removes the key from the scheduler, does nothing if it is not scheduled"
+        if self._discard(key):
+            self._wakeup.set()
+
+    def _discard(self, key) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+
+        entry[-1] = None # Mark as dead, popped lazily
+        return True
+
+    def next_deadline(self):
+        "Returns the earliest live monotonic deadline or None if nothing is scheduled"
+        while self._heap and self._heap[0][-1] is None:
+            heapq.heappop(self._heap)
+
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float = None) -> list:
+        "Pops every live item whose deadline has passed"
+        now = time.monotonic() if now is None else now
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if entry[-1] is None:
+                continue
+
+            del self._entries[entry[2]]
+            due.append(entry[-1])
+
+        return due
+
+    def start(self):
+        if not self.running:
+            self._task = asyncio.ensure_future(self._run())
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            deadline = self.next_deadline()
+            if deadline is None:
+                await self._wakeup.wait()
+                continue
+
+            timeout = deadline - time.monotonic()
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            due = self.pop_due()
+            try:
+                await self.callback(due)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Scheduled callback failed for %d items', len(due))
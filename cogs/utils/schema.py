@@ -0,0 +1,104 @@
+from datetime import datetime
+import logging
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+log = logging.getLogger(__name__)
+
+
+INDEXES = {
+    'giveaways': [
+        IndexModel([('messageID', ASCENDING)], name='messageID', unique=True),
+        IndexModel([('endsat', ASCENDING)], name='endsat'),
+        IndexModel([('guildID', ASCENDING)], name='guildID')
+    ],
+    'guilds': [
+        IndexModel([('guild', ASCENDING)], name='guild', unique=True)
+    ],
+    'archive': [
+        IndexModel([('messageID', ASCENDING)], name='messageID', unique=True),
+        IndexModel([('guildID', ASCENDING), ('endedat', DESCENDING)], name='guildID_endedat')
+    ]
+}
+
+# Ended giveaways are kept in the archive for a week by default
+ARCHIVE_TTL = 7 * 24 * 3600
+
+# Only the fields that are actually used are read
+CONFIG_PROJECTION = {'_id': 0, 'guild': 1, 'prefix': 1, 'giveawayrole': 1}
+GIVEAWAY_PROJECTION = {'_id': 0}
+ARCHIVE_PROJECTION = {'_id': 0, 'messageID': 1, 'guildID': 1, 'title': 1, 'winners': 1, 'eligible': 1}
+
+# The changes other processes apply to their caches, giveaway updates (entrants, leases) are left out
+CHANGES_PIPELINE = [{'$match': {'$or': [
+    {'ns.coll': 'guilds', 'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}},
+    {'ns.coll': 'giveaways', 'operationType': {'$in': ['insert', 'delete']}}
+]}}]
+
+
+def giveaways_of(guild_ids) -> dict:
+    "Filter of the giveaways of the given guilds, and of those stored before their guild was"
+    return {'$or': [{'guildID': {'$in': list(guild_ids)}}, {'guildID': {'$exists': False}}]}
+
+
+def main_queries():
+    "Returns the main queries run by the bot as (name, collection, filter, projection)"
+    return [
+        ('giveaway by message', 'giveaways', {'messageID': 0}, GIVEAWAY_PROJECTION),
+        ('giveaways due', 'giveaways', {'endsat': {'$lte': datetime.utcnow()}}, GIVEAWAY_PROJECTION),
+        ('giveaways by guild', 'giveaways', giveaways_of([0]), GIVEAWAY_PROJECTION),
+        ('config by guild', 'guilds', {'guild': 0}, CONFIG_PROJECTION),
+        ('ended giveaway by message', 'archive', {'messageID': 0}, ARCHIVE_PROJECTION),
+        ('last ended giveaway by guild', 'archive', {'guildID': 0}, ARCHIVE_PROJECTION)
+    ]
+
+
+async def ensure_indexes(db, *, archive_ttl: int = ARCHIVE_TTL):
+    """
+    Creates the indexes the bot relies on, existing indexes are left as they are
+
+    Archived giveaways expire `archive_ttl` seconds after they ended, the expiry of an existing TTL index is updated
+    """
+    for collection, indexes in INDEXES.items():
+        try:
+            await db[collection].create_indexes(indexes)
+        except OperationFailure as err:
+            # Usually duplicates that prevent a unique index, the bot still works without it
+            log.error('Could not create indexes on %s: %s', collection, err)
+
+    try:
+        await db.archive.create_indexes([IndexModel([('endedat', ASCENDING)], name='endedat', expireAfterSeconds=archive_ttl)])
+    except OperationFailure:
+        # The index exists with another expiry
+        await db.command('collMod', 'archive', index={'name': 'endedat', 'expireAfterSeconds': archive_ttl})
+
+
+def summarize_plan(plan: dict) -> str:
+    "Returns the stages of a winning plan, eg. PROJECTION_SIMPLE <- FETCH <- IXSCAN(messageID)"
+    stages = []
+    while plan:
+        stage = plan.get('stage', '?')
+        if 'indexName' in plan:
+            stage += f"({plan['indexName']})"
+        stages.append(stage)
+        plan = plan.get('inputStage')
+
+    return ' <- '.join(stages)
+
+
+async def explain(db) -> list:
+    "Runs explain on each of the main queries and returns a short summary for each"
+    results = []
+    for name, collection, filter, projection in main_queries():
+        explained = await db[collection].find(filter, projection).limit(1).explain()
+        stats = explained.get('executionStats', {})
+        results.append({
+            'query': name,
+            'plan': summarize_plan(explained.get('queryPlanner', {}).get('winningPlan', {})),
+            'keys': stats.get('totalKeysExamined'),
+            'docs': stats.get('totalDocsExamined'),
+            'ms': stats.get('executionTimeMillis')
+        })
+
+    return results
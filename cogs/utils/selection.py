@@ -0,0 +1,66 @@
+from array import array
+import random
+
+# Winners should not be predictable from previous draws
+rng = random.SystemRandom()
+
+
+class Selection:
+    """
+    Result of a winner selection, `winners` is None if there were not enough eligible entrants
+
+    `pool` holds the ids of the eligible entrants the winners were drawn from (a list or an `array('Q')`), when they were kept
+    """
+    __slots__ = ('winners', 'eligible', 'ineligible', 'pool')
+
+    def __init__(self, winners, eligible: int, ineligible: int, pool=None):
+        self.winners = winners
+        self.eligible = eligible
+        self.ineligible = ineligible
+        self.pool = pool
+
+    def __repr__(self):
+        return f'<Selection winners={self.winners!r} eligible={self.eligible} ineligible={self.ineligible}>'
+
+
+async def reservoir_sample(iterator, k: int, check=None) -> Selection:
+    """
+    Selects `k` items uniformly at random from an async iterator in a single pass
+
+    Only a k sized reservoir is kept in memory, so the iterator can be consumed page by page
+    no matter how large it is. Items for which `check(item)` is falsy are counted as ineligible and skipped
+    """
+    reservoir = []
+    eligible = ineligible = 0
+
+    async for item in iterator:
+        if check is not None and not check(item):
+            ineligible += 1
+            continue
+
+        if eligible < k:
+            reservoir.append(item)
+        else:
+            index = rng.randrange(eligible + 1)
+            if index < k:
+                reservoir[index] = item
+        eligible += 1
+
+    if eligible < k:
+        return Selection(None, eligible, ineligible)
+
+    rng.shuffle(reservoir)
+    return Selection(reservoir, eligible, ineligible)
+
+
+def pack_ids(ids) -> bytes:
+    "Packs user ids into 8 bytes each, the compact form entrants are archived in"
+    if isinstance(ids, array) and ids.typecode == 'Q':
+        return ids.tobytes()
+    return array('Q', ids).tobytes()
+
+
+def unpack_ids(data: bytes) -> list:
+    ids = array('Q')
+    ids.frombytes(data)
+    return ids.tolist()
@@ -0,0 +1,351 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import groupby
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+
+from .persistence import INSERT, UPDATE, DELETE, WriteError
+from .schema import ARCHIVE_TTL
+from .storage import Storage
+from .time import to_timestamp
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS giveaways (
+    messageID INTEGER PRIMARY KEY,
+    guildID INTEGER,
+    channelID INTEGER NOT NULL,
+    authorID INTEGER,
+    title TEXT,
+    endsat REAL NOT NULL,
+    winners INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS giveaways_guildID ON giveaways (guildID);
+CREATE INDEX IF NOT EXISTS giveaways_endsat ON giveaways (endsat);
+
+CREATE TABLE IF NOT EXISTS entrants (
+    messageID INTEGER NOT NULL,
+    userID INTEGER NOT NULL,
+    PRIMARY KEY (messageID, userID)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS guilds (
+    guild INTEGER PRIMARY KEY,
+    prefix TEXT,
+    giveawayrole INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS archive (
+    messageID INTEGER PRIMARY KEY,
+    guildID INTEGER,
+    channelID INTEGER,
+    title TEXT,
+    endedat REAL NOT NULL,
+    winners TEXT NOT NULL,
+    eligible BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS archive_guildID_endedat ON archive (guildID, endedat DESC);
+CREATE INDEX IF NOT EXISTS archive_endedat ON archive (endedat);
+"""
+
+GIVEAWAY_COLUMNS = ('messageID', 'guildID', 'channelID', 'authorID', 'title', 'endsat', 'winners')
+CONFIG_COLUMNS = ('prefix', 'giveawayrole')
+ARCHIVE_COLUMNS = ('messageID', 'guildID', 'channelID', 'title', 'endedat', 'winners', 'eligible')
+
+# The main queries, as in `schema.main_queries`
+MAIN_QUERIES = [
+    ('giveaway by message', 'SELECT * FROM giveaways WHERE messageID = 0'),
+    ('giveaways due', 'SELECT * FROM giveaways WHERE endsat <= 0'),
+    ('giveaways by guild', 'SELECT * FROM giveaways WHERE guildID IN (0) OR guildID IS NULL'),
+    ('config by guild', 'SELECT * FROM guilds WHERE guild = 0'),
+    ('ended giveaway by message', 'SELECT * FROM archive WHERE messageID = 0'),
+    ('last ended giveaway by guild', 'SELECT * FROM archive WHERE guildID = 0 ORDER BY endedat DESC LIMIT 1')
+]
+
+
+def _to_row(document: dict, columns: tuple) -> tuple:
+    row = []
+    for column in columns:
+        value = document.get(column)
+        if isinstance(value, datetime):
+            value = to_timestamp(value)
+        elif column == 'winners' and isinstance(value, list):
+            value = json.dumps(value)
+        row.append(value)
+    return tuple(row)
+
+
+class SQLiteStorage(Storage):
+    """
+    Stores everything in a single SQLite file, for deployments running a single process
+
+    - Queries run on a dedicated thread with its own connection, the event loop never waits for the disk
+    - The database is in WAL mode, reads don't block on writes and commits only append to the log
+    - Each batch of queued writes is applied in a single transaction, each write under a savepoint
+    - Entrants are rows of their own table so that reactions only insert or delete a row
+
+    Archived giveaways past their TTL are purged every `purge_interval` seconds. Leases are not supported
+    """
+    def __init__(self, path: str, *, purge_interval: float = 60):
+        self.path = path
+        self.purge_interval = purge_interval
+        self.archive_ttl = ARCHIVE_TTL
+
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='sqlite')
+        self._connection = None
+        self._task = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # Only ever called from the storage thread
+        if self._connection is None:
+            # Autocommit, transactions are explicit
+            connection = sqlite3.connect(self.path, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    async def _run(self, func, *args):
+        "Runs `func(connection, *args)` on the storage thread"
+        return await asyncio.get_event_loop().run_in_executor(self._executor, lambda: func(self._connect(), *args))
+
+    async def _transaction(self, func, *args):
+        "Runs `func(connection, *args)` on the storage thread within a transaction"
+        def run(connection):
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(connection, *args)
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+            return result
+
+        return await self._run(run)
+
+    async def setup(self, *, archive_ttl: int = ARCHIVE_TTL):
+        self.archive_ttl = archive_ttl
+        await self._run(lambda connection: None)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._purge_loop())
+
+    async def _purge_loop(self):
+        while True:
+            try:
+                await self.purge_archive()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Failed to purge the archive')
+            await asyncio.sleep(self.purge_interval)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        def close(connection):
+            connection.close()
+            self._connection = None
+
+        if self._connection is not None:
+            await self._run(close)
+        self._executor.shutdown(wait=False)
+
+    # Giveaways
+
+    def _insert_giveaway(self, connection, data: dict):
+        connection.execute(f'INSERT INTO giveaways VALUES ({", ".join("?" * len(GIVEAWAY_COLUMNS))})', _to_row(data, GIVEAWAY_COLUMNS))
+        self._add_entrants(connection, data['messageID'], data.get('entrants', ()))
+
+    def _add_entrants(self, connection, messageID: int, ids):
+        # Like an update of a missing document, nothing is added to a deleted giveaway
+        connection.executemany(
+            'INSERT OR IGNORE INTO entrants SELECT ?, ? WHERE EXISTS (SELECT 1 FROM giveaways WHERE messageID = ?)',
+            ((messageID, userID, messageID) for userID in ids)
+        )
+
+    def _delete_giveaway(self, connection, messageID: int):
+        connection.execute('DELETE FROM giveaways WHERE messageID = ?', (messageID,))
+        connection.execute('DELETE FROM entrants WHERE messageID = ?', (messageID,))
+
+    def _giveaways(self, connection, guild_ids=None) -> list:
+        where = ''
+        if guild_ids is not None:
+            # There can be more guilds than bound parameters allowed in a query
+            connection.execute('CREATE TEMP TABLE IF NOT EXISTS selected_guilds (guild INTEGER PRIMARY KEY)')
+            connection.execute('DELETE FROM selected_guilds')
+            connection.executemany('INSERT OR IGNORE INTO selected_guilds VALUES (?)', ((guildID,) for guildID in guild_ids))
+            where = ' WHERE guildID IN (SELECT guild FROM selected_guilds) OR guildID IS NULL'
+
+        entrants = {}
+        selected = f' WHERE messageID IN (SELECT messageID FROM giveaways{where})' if where else ''
+        rows = connection.execute(f'SELECT messageID, userID FROM entrants{selected} ORDER BY messageID')
+        for messageID, group in groupby(rows, key=lambda row: row[0]):
+            entrants[messageID] = [userID for _, userID in group]
+
+        giveaways = []
+        for row in connection.execute(f'SELECT {", ".join(GIVEAWAY_COLUMNS)} FROM giveaways{where}'):
+            data = dict(zip(GIVEAWAY_COLUMNS, row))
+            data['endsat'] = datetime.utcfromtimestamp(data['endsat'])
+            data['entrants'] = entrants.get(data['messageID'], [])
+            giveaways.append(data)
+        return giveaways
+
+    async def iter_giveaways(self, guild_ids=None):
+        for data in await self._run(self._giveaways, guild_ids):
+            yield data
+
+    async def insert_giveaway(self, data: dict):
+        try:
+            await self._transaction(self._insert_giveaway, data)
+        except sqlite3.IntegrityError as err:
+            raise WriteError(str(err)) from err
+
+    async def delete_giveaway(self, messageID: int):
+        await self._transaction(self._delete_giveaway, messageID)
+
+    # Guild configs
+
+    def _update_config(self, connection, guildID: int, fields: dict):
+        columns = [c for c in fields if c in CONFIG_COLUMNS]
+        if len(columns) != len(fields):
+            raise WriteError(f'Unknown config fields: {set(fields) - set(CONFIG_COLUMNS)}')
+
+        connection.execute(
+            f'INSERT INTO guilds (guild, {", ".join(columns)}) VALUES (?{", ?" * len(columns)}) '
+            f'ON CONFLICT (guild) DO UPDATE SET {", ".join(f"{c} = excluded.{c}" for c in columns)}',
+            (guildID, *(fields[c] for c in columns))
+        )
+
+    async def get_config(self, guildID: int) -> dict:
+        def get(connection):
+            row = connection.execute(f'SELECT {", ".join(CONFIG_COLUMNS)} FROM guilds WHERE guild = ?', (guildID,)).fetchone()
+            return {c: v for c, v in zip(CONFIG_COLUMNS, row) if v is not None} if row else {}
+
+        return await self._run(get)
+
+    async def iter_configs(self):
+        def configs(connection):
+            rows = connection.execute(f'SELECT guild, {", ".join(CONFIG_COLUMNS)} FROM guilds')
+            return [{c: v for c, v in zip(('guild',) + CONFIG_COLUMNS, row) if v is not None} for row in rows]
+
+        for config in await self._run(configs):
+            yield config
+
+    async def update_config(self, guildID: int, fields: dict):
+        await self._transaction(self._update_config, guildID, fields)
+
+    # Archive
+
+    async def find_archived(self, guildID: int, messageID: int = None) -> dict:
+        def find(connection):
+            query = f'SELECT {", ".join(ARCHIVE_COLUMNS)} FROM archive WHERE guildID = ? AND endedat >= ?'
+            params = [guildID, time.time() - self.archive_ttl]
+            if messageID:
+                query += ' AND messageID = ?'
+                params.append(messageID)
+            row = connection.execute(query + ' ORDER BY endedat DESC LIMIT 1', params).fetchone()
+            if row is None:
+                return None
+
+            archived = dict(zip(ARCHIVE_COLUMNS, row))
+            archived['endedat'] = datetime.utcfromtimestamp(archived['endedat'])
+            archived['winners'] = json.loads(archived['winners'])
+            return archived
+
+        return await self._run(find)
+
+    async def add_archived_winner(self, messageID: int, userID: int):
+        def add(connection):
+            row = connection.execute('SELECT winners FROM archive WHERE messageID = ?', (messageID,)).fetchone()
+            if row is not None and userID not in json.loads(row[0]):
+                connection.execute('UPDATE archive SET winners = ? WHERE messageID = ?', (json.dumps(json.loads(row[0]) + [userID]), messageID))
+
+        await self._transaction(add)
+
+    async def purge_archive(self) -> int:
+        "Deletes the archived giveaways past their TTL, returns how many were deleted"
+        return await self._transaction(
+            lambda connection: connection.execute('DELETE FROM archive WHERE endedat < ?', (time.time() - self.archive_ttl,)).rowcount
+        )
+
+    # Queued writes
+
+    def _apply(self, connection, collection: str, op):
+        if collection == 'giveaways':
+            if op.kind == INSERT:
+                return self._insert_giveaway(connection, op.payload)
+
+            messageID = op.filter.get('messageID')
+            if set(op.filter) != {'messageID'}:
+                raise WriteError(f'Unsupported filter on giveaways: {op.filter}')
+            if op.kind == DELETE:
+                return self._delete_giveaway(connection, messageID)
+
+            for operator, fields in op.payload.items():
+                for field, value in fields.items():
+                    if field == 'entrants' and operator == '$set':
+                        connection.execute('DELETE FROM entrants WHERE messageID = ?', (messageID,))
+                        self._add_entrants(connection, messageID, value)
+                    elif field == 'entrants' and operator == '$addToSet':
+                        self._add_entrants(connection, messageID, value['$each'] if isinstance(value, dict) else [value])
+                    elif field == 'entrants' and operator == '$pull':
+                        ids = value['$in'] if isinstance(value, dict) else [value]
+                        connection.executemany('DELETE FROM entrants WHERE messageID = ? AND userID = ?', ((messageID, u) for u in ids))
+                    elif operator == '$set' and field in GIVEAWAY_COLUMNS:
+                        connection.execute(f'UPDATE giveaways SET {field} = ? WHERE messageID = ?', _to_row({field: value}, (field,)) + (messageID,))
+                    else:
+                        raise WriteError(f'Unsupported update on giveaways: {operator} {field}')
+            return
+
+        if collection == 'archive' and op.kind == INSERT:
+            return connection.execute(f'INSERT INTO archive VALUES ({", ".join("?" * len(ARCHIVE_COLUMNS))})', _to_row(op.payload, ARCHIVE_COLUMNS))
+        if collection == 'archive' and op.kind == DELETE:
+            return connection.execute('DELETE FROM archive WHERE messageID = ?', (op.filter['messageID'],))
+        if collection == 'guilds' and op.kind == UPDATE and set(op.payload) == {'$set'}:
+            return self._update_config(connection, op.filter['guild'], op.payload['$set'])
+
+        raise WriteError(f'Unsupported {op.kind} on {collection}')
+
+    async def write(self, collection: str, operations: list):
+        def write(connection):
+            # Like an ordered bulk write, the writes before a rejected one are kept and the ones after it are not run
+            for index, op in enumerate(operations):
+                connection.execute('SAVEPOINT operation')
+                try:
+                    self._apply(connection, collection, op)
+                except (sqlite3.IntegrityError, WriteError) as err:
+                    connection.execute('ROLLBACK TO operation')
+                    connection.execute('RELEASE operation')
+                    return index, err
+                connection.execute('RELEASE operation')
+            return None, None
+
+        index, err = await self._transaction(write)
+        if err is not None:
+            raise WriteError(str(err), index=index) from err
+
+    async def explain(self) -> list:
+        def explain(connection):
+            results = []
+            for name, query in MAIN_QUERIES:
+                start = time.perf_counter()
+                plan = connection.execute(f'EXPLAIN QUERY PLAN {query}').fetchall()
+                results.append({
+                    'query': name,
+                    'plan': ' <- '.join(row[-1] for row in reversed(plan)),
+                    'keys': None,
+                    'docs': None,
+                    'ms': round((time.perf_counter() - start) * 1000, 3)
+                })
+            return results
+
+        return await self._run(explain)
@@ -0,0 +1,52 @@
+from contextlib import contextmanager
+import asyncio
+import time
+
+
+class StartupReport:
+    """
+    Times the phases of the startup of the process, relative to when it began
+
+    Phases can overlap and nest, each one is timed with `with report.phase('name'):`.
+    `settled` waits until no phase is running anymore
+    """
+    def __init__(self, registry=None):
+        self.began = time.perf_counter()
+        # name -> [start, end], relative to `began`
+        self.phases = {}
+        self.gauge = registry and registry.gauge('startup_phase_seconds', 'Time taken by each phase of the startup', ('phase',))
+
+        self._open = 0
+        self._settled = asyncio.Event()
+        self._settled.set()
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.began
+
+    @contextmanager
+    def phase(self, name: str):
+        timing = self.phases[name] = [self.elapsed(), None]
+        self._open += 1
+        self._settled.clear()
+        try:
+            yield
+        finally:
+            timing[1] = self.elapsed()
+            if self.gauge:
+                self.gauge.set(timing[1] - timing[0], phase=name)
+            self._open -= 1
+            if not self._open:
+                self._settled.set()
+
+    async def settled(self):
+        await self._settled.wait()
+
+    def format(self) -> str:
+        width = max(map(len, self.phases), default=5)
+        lines = [f"{'phase':<{width}}  {'start':>7}  {'end':>7}  {'took':>7}"]
+        for name, (start, end) in sorted(self.phases.items(), key=lambda item: item[1][0]):
+            if end is None:
+                lines.append(f'{name:<{width}}  {start:>7.3f}  {"...":>7}')
+            else:
+                lines.append(f'{name:<{width}}  {start:>7.3f}  {end:>7.3f}  {end - start:>7.3f}')
+        return '\n'.join(lines)
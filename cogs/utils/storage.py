@@ -0,0 +1,291 @@
+"""
+Everything the bot stores goes through a `Storage`: giveaways, guild configs and the archive of ended giveaways
+
+`MongoStorage` keeps them in MongoDB (or the in-memory stand-in), `SQLiteStorage` (in `.sqlite`)
+in a single SQLite file for deployments running a single process
+"""
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+import time
+
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from .leases import LeaseManager
+from .persistence import INSERT, WriteError
+from .schema import (ARCHIVE_PROJECTION, ARCHIVE_TTL, CHANGES_PIPELINE, CONFIG_PROJECTION, GIVEAWAY_PROJECTION,
+                     ensure_indexes, explain, giveaways_of)
+from .time import to_timestamp
+
+# The field identifying the documents of each watched collection
+CHANGE_KEYS = {'giveaways': 'messageID', 'guilds': 'guild'}
+CONFIG_FIELDS = [field for field, included in CONFIG_PROJECTION.items() if included and field != 'guild']
+
+
+class ChangesLost(Exception):
+    "The changes since the resume token are gone, what was built from the stored data must be rebuilt"
+
+
+class Change:
+    """
+    A giveaway or guild config that was created, updated or deleted by any process
+
+    `key` is the message id of a giveaway or the guild id of a config. `document` is shaped like
+    what the storage returns (a config has no `guild` id), None when deleted. `time` is when the change
+    was stored, as an epoch timestamp
+    """
+    __slots__ = ('collection', 'operation', 'key', 'document', 'time', 'token')
+
+    def __init__(self, collection: str, operation: str, key: int, document: dict, time: float, token=None):
+        self.collection = collection
+        self.operation = operation
+        self.key = key
+        self.document = document
+        self.time = time
+        self.token = token
+
+    @classmethod
+    def from_event(cls, event: dict):
+        "Builds a change from a mongodb change event, None if the changed document can't be identified"
+        collection = event['ns']['coll']
+        field = CHANGE_KEYS[collection]
+        document = event.get('fullDocument')
+        # Documents are keyed by their id, except those inserted before they were
+        _id = event['documentKey']['_id']
+        key = (document or {}).get(field, _id if isinstance(_id, int) else None)
+        if key is None:
+            return None
+
+        if document is not None:
+            if collection == 'guilds':
+                document = {k: document[k] for k in CONFIG_FIELDS if k in document}
+            else:
+                document = {k: v for k, v in document.items() if k != '_id'}
+
+        operation = event['operationType']
+        if 'wallTime' in event:
+            changed = to_timestamp(event['wallTime'])
+        elif 'clusterTime' in event:
+            changed = event['clusterTime'].time
+        else:
+            changed = time.time()
+        return cls(collection, 'update' if operation == 'replace' else operation, key, document, changed, event['_id'])
+
+
+class ChangeStream:
+    """
+    The `Change`s of a motor (or in-memory) change stream, iterated once opened (or within `async with stream:`)
+
+    Raises `ChangesLost` when it can't resume from its token and `NotImplementedError` when the server
+    has no change streams (a standalone server)
+    """
+    def __init__(self, db, resume_after=None):
+        self.db = db
+        self.resume_after = resume_after
+        self.stream = None
+
+    async def open(self):
+        "Starts watching, the changes made from then on are returned"
+        if self.stream is not None:
+            return self
+        start = None
+        if self.resume_after is None:
+            # Motor only runs the aggregate on the first iteration, so the start is pinned to the
+            # current operation time instead. A change made at that exact time may be returned again,
+            # applying it twice is harmless
+            try:
+                reply = await self.db.command('ping')
+            except OperationFailure as err:
+                raise self._error(err) from err
+            start = reply.get('operationTime')
+            if start is None:
+                raise NotImplementedError('Change streams need a replica set')
+        self.stream = self.db.watch(
+            CHANGES_PIPELINE,
+            full_document='updateLookup',
+            resume_after=self.resume_after,
+            start_at_operation_time=start
+        )
+        return self
+
+    async def close(self):
+        if self.stream is not None:
+            await self.stream.close()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def _error(self, err: OperationFailure) -> Exception:
+        if err.code == 286: # ChangeStreamHistoryLost
+            return ChangesLost(str(err))
+        if err.code == 40573: # Change streams need a replica set
+            return NotImplementedError(str(err))
+        return err
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        try:
+            async for event in self.stream:
+                change = Change.from_event(event)
+                if change is not None:
+                    yield change
+        except OperationFailure as err:
+            raise self._error(err) from err
+
+
+class Storage(ABC):
+    """
+    The operations the bot runs on its data
+
+    Giveaways and archived giveaways are dicts shaped like their MongoDB documents, with naive UTC datetimes.
+    Writes queued on the `WriteBehindQueue` are applied in batches through `write`, other writes are immediate.
+    Backends implement every abstract method, `start`, `leases` and `watch` are optional
+    """
+    @abstractmethod
+    async def setup(self, *, archive_ttl: int = ARCHIVE_TTL):
+        "Creates what the storage relies on (tables, indexes), archived giveaways expire after `archive_ttl` seconds"
+        raise NotImplementedError
+
+    def start(self):
+        "Starts the background tasks of the storage, if any"
+
+    @abstractmethod
+    async def close(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_giveaways(self, guild_ids=None):
+        """
+        Returns an async iterator over the stored giveaways, with their entrants
+
+        Only the giveaways of `guild_ids` and those stored without a guild id are returned, if given
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def insert_giveaway(self, data: dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete_giveaway(self, messageID: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_config(self, guildID: int) -> dict:
+        "Returns the stored config of a guild without its id, an empty dict if there is none"
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_configs(self):
+        "Returns an async iterator over every stored guild config, with its `guild` id"
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update_config(self, guildID: int, fields: dict):
+        "Sets fields of a guild config, creating it if needed"
+        raise NotImplementedError
+
+    @abstractmethod
+    async def find_archived(self, guildID: int, messageID: int = None) -> dict:
+        "Returns an archived giveaway of the guild, the one that ended last if no message id is given. None if there is none"
+        raise NotImplementedError
+
+    @abstractmethod
+    async def add_archived_winner(self, messageID: int, userID: int):
+        "Adds a winner drawn by a reroll to an archived giveaway"
+        raise NotImplementedError
+
+    @abstractmethod
+    async def write(self, collection: str, operations: list):
+        "Applies queued `Operation`s in order, stops at the first rejected one and raises `WriteError` with its index"
+        raise NotImplementedError
+
+    def leases(self, owner: str, duration: float) -> LeaseManager:
+        "Returns a lease manager for the giveaways, when several instances can share the storage"
+        raise NotImplementedError(f'{type(self).__name__} does not support leases')
+
+    def watch(self, resume_after=None) -> ChangeStream:
+        """
+        Returns a stream of the giveaways created or deleted and the guild configs changed by any process,
+        after the change with the given token. None if only a single process can use the storage
+        """
+        return None
+
+    @abstractmethod
+    async def explain(self) -> list:
+        "Returns how the main queries are run, as dicts with the query, its plan and what it examined"
+        raise NotImplementedError
+
+
+class MongoStorage(Storage):
+    "Stores everything in the `giveaways`, `guilds` and `archive` collections of a `Database`"
+    def __init__(self, database):
+        self.database = database
+        self.archive_ttl = ARCHIVE_TTL
+
+    async def setup(self, *, archive_ttl: int = ARCHIVE_TTL):
+        self.archive_ttl = archive_ttl
+        await ensure_indexes(self.database, archive_ttl=archive_ttl)
+
+    def start(self):
+        self.database.start()
+
+    async def close(self):
+        await self.database.close()
+
+    def iter_giveaways(self, guild_ids=None):
+        return self.database.giveaways.find({} if guild_ids is None else giveaways_of(guild_ids), GIVEAWAY_PROJECTION)
+
+    async def insert_giveaway(self, data: dict):
+        # Keyed by the message id, so that deletions can be told apart in change streams
+        await self.database.giveaways.insert_one(dict(data, _id=data['messageID']))
+
+    async def delete_giveaway(self, messageID: int):
+        await self.database.giveaways.delete_one({'messageID': messageID})
+
+    async def get_config(self, guildID: int) -> dict:
+        config = await self.database.guilds.find_one({'guild': guildID}, CONFIG_PROJECTION) or {}
+        config.pop('guild', None)
+        return config
+
+    def iter_configs(self):
+        return self.database.guilds.find({}, CONFIG_PROJECTION)
+
+    async def update_config(self, guildID: int, fields: dict):
+        await self.database.guilds.update_one({'guild': guildID}, {'$set': fields, '$setOnInsert': {'_id': guildID}}, upsert=True)
+
+    async def find_archived(self, guildID: int, messageID: int = None) -> dict:
+        # The TTL monitor only runs every minute, expired giveaways may still be there
+        query = {'guildID': guildID, 'endedat': {'$gte': datetime.utcnow() - timedelta(seconds=self.archive_ttl)}}
+        if messageID:
+            query['messageID'] = messageID
+        archived = await self.database.archive.find(query, ARCHIVE_PROJECTION).sort('endedat', -1).limit(1).to_list(1)
+        return archived[0] if archived else None
+
+    async def add_archived_winner(self, messageID: int, userID: int):
+        await self.database.archive.update_one({'messageID': messageID}, {'$addToSet': {'winners': userID}})
+
+    async def write(self, collection: str, operations: list):
+        if collection == 'giveaways':
+            for op in operations:
+                if op.kind == INSERT:
+                    op.payload.setdefault('_id', op.payload['messageID'])
+        try:
+            await self.database[collection].bulk_write([op.to_request() for op in operations], ordered=True)
+        except BulkWriteError as err:
+            errors = err.details.get('writeErrors') or [{}]
+            # Ordered, only the first rejected write stopped the batch
+            raise WriteError(errors[0].get('errmsg', err), index=errors[0].get('index')) from err
+
+    def leases(self, owner: str, duration: float) -> LeaseManager:
+        return LeaseManager(self.database.giveaways, owner, duration=duration)
+
+    async def explain(self) -> list:
+        return await explain(self.database)
+
+    def watch(self, resume_after=None) -> ChangeStream:
+        return ChangeStream(self.database.db, resume_after)
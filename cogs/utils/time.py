@@ -1,4 +1,4 @@
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 import re
 
 from discord.ext import commands
@@ -21,6 +21,11 @@ def friendly_duration(td: timedelta, long=False) -> str:
     return ' '.join(f'{num}{word}' for (num, word) in zip([days, hours, minutes, seconds], words) if num > 0)
 
 
+def to_timestamp(dt: datetime) -> float:
+    "Converts a naive UTC datetime (as stored in the database) into an epoch timestamp"
+    return dt.replace(tzinfo=timezone.utc).timestamp()
+
+
 regex = re.compile(r'(?:(\d+) *(s|m|h|d))+?')
 formats = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
 
@@ -1,3 +1,17 @@
 def codeblock(code: str, language: str) -> str:
     """Adds a codeblock formatting for the code"""
     return f"```{language}\n{code}\n```"
+
+
+def paginate(lines: list, limit: int = 2000) -> list:
+    """Splits lines into as few messages as possible, each one at most `limit` characters long once joined.
+    Returns the (start, end) slice of the lines in each message"""
+    pages, start, size = [], 0, 0
+    for i, line in enumerate(lines):
+        if i > start and size + len(line) + 1 > limit:
+            pages.append((start, i))
+            start, size = i, 0
+        size = size + len(line) + 1 if i > start else len(line)
+    if start < len(lines):
+        pages.append((start, len(lines)))
+    return pages
@@ -0,0 +1,76 @@
+import asyncio
+import heapq
+import itertools
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    """
+    Runs submitted jobs on a fixed number of workers
+
+    - `concurrency` is the global amount of jobs that can run at once
+    - `per_key` is the amount of jobs that can run at once for the same key (eg. a channel id)
+
+    Jobs with a lower priority run first. Jobs for a key that is already at its limit
+    are parked on that key instead of holding a worker, and are released once a job
+    for that key finishes. Errors raised by a job are logged and never reach other jobs.
+    """
+    def __init__(self, concurrency: int = 10, per_key: int = 2):
+        self.concurrency = concurrency
+        self.per_key = per_key
+
+        self._queue = asyncio.PriorityQueue()
+        self._counter = itertools.count()
+        self._active = {}
+        self._parked = {}
+        self._workers = []
+
+    @property
+    def pending(self) -> int:
+        "Amount of jobs that are waiting to be run"
+        return self._queue.qsize() + sum(len(p) for p in self._parked.values())
+
+    def start(self):
+        if not self._workers:
+            self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.concurrency)]
+
+    def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+
+    def submit(self, priority: int, key, func, *args):
+        "Queues `func(*args)` to be run, func must be a coroutine function"
+        job = (priority, next(self._counter), key, func, args)
+        if self._active.get(key, 0) < self.per_key:
+            self._active[key] = self._active.get(key, 0) + 1
+            self._queue.put_nowait(job)
+        else:
+            heapq.heappush(self._parked.setdefault(key, []), job)
+
+    def _release(self, key):
+        parked = self._parked.get(key)
+        if parked:
+            # The slot is handed over to the next job for this key
+            self._queue.put_nowait(heapq.heappop(parked))
+            if not parked:
+                del self._parked[key]
+            return
+
+        self._active[key] -= 1
+        if not self._active[key]:
+            del self._active[key]
+
+    async def _worker(self):
+        while True:
+            _, _, key, func, args = await self._queue.get()
+            try:
+                await func(*args)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Job %s%r failed', getattr(func, '__name__', func), args)
+            finally:
+                self._release(key)
@@ -0,0 +1,18 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def loop():
+    "A new event loop for each test, set as the current one since the bot and its fakes look it up"
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    # Background tasks left by the test (workers, write queues) are cancelled before closing
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.close()
+    asyncio.set_event_loop(None)
@@ -0,0 +1,147 @@
+"""
+Several instances sharing one database through leases, each winner must be announced exactly once
+"""
+from collections import Counter
+from datetime import datetime, timedelta
+import asyncio
+import re
+
+from benchmarks.fakes import FakeBot
+from benchmarks.memorydb import MemoryClient
+from cogs.giveaway import GiveawayCog
+
+LEASE_DURATION = 1
+JUMP_URL = re.compile(r'/channels/\d+/\d+/(\d+)')
+
+
+class Instance:
+    """
+    A bot process running the giveaway cog, the announcements it sends are recorded
+
+    Instances given the same `client` and `reactions` (message id -> sorted user ids) share their data and messages
+    """
+    def __init__(self, client: MemoryClient, reactions: dict, name: str):
+        self.bot = FakeBot(guilds=2, channels=2, members=10, latency=0.001, client=client)
+        self.bot.http.reactions = reactions
+        self.bot.lease_duration = LEASE_DURATION
+        self.bot.instance_id = name
+        self.announced = []
+        self.edited = []
+        self.cog = None
+
+        send, edit = self.bot.http.send_message, self.bot.http.edit_message
+
+        async def send_message(channelID, content=None, **fields):
+            data = await send(channelID, content, **fields)
+            self.announced.extend(int(m) for m in JUMP_URL.findall(content or ''))
+            return data
+
+        async def edit_message(channelID, messageID, **fields):
+            data = await edit(channelID, messageID, **fields)
+            if fields.get('content') == '🎉 **GIVEAWAY ENDED** 🎉':
+                self.edited.append(messageID)
+            return data
+
+        self.bot.http.send_message, self.bot.http.edit_message = send_message, edit_message
+
+    async def start(self):
+        await self.bot.connect()
+        self.cog = GiveawayCog(self.bot)
+        while not self.cog.scheduler.running:
+            await asyncio.sleep(0.01)
+
+    def kill(self):
+        "Stops everything at once, its leases are neither renewed nor released"
+        cog, self.cog = self.cog, None
+        cog.cog_unload()
+
+
+async def store_giveaways(bot: FakeBot, count: int, ends: float) -> dict:
+    """
+    Stores `count` giveaways ending within the next `ends` seconds, every member of the guild entered them
+
+    Returns the guild id of each giveaway by message id
+    """
+    guilds = {}
+    for i in range(count):
+        channel = bot.channels[i % len(bot.channels)]
+        messageID = bot.http.next_id()
+        guilds[messageID] = channel.guild.id
+        bot.http.reactions[messageID] = sorted(channel.guild.members)
+        await bot.storage.insert_giveaway({
+            'authorID': 1, 'channelID': channel.id, 'guildID': channel.guild.id, 'messageID': messageID,
+            'title': f'Giveaway {i}', 'endsat': datetime.utcnow() + timedelta(seconds=ends * (i + 1) / count),
+            'winners': 1, 'entrants': list(channel.guild.members)
+        })
+    return guilds
+
+
+async def wait_until_finished(bot: FakeBot, timeout: float = 15):
+    for _ in range(int(timeout * 10)):
+        if not await bot.database.giveaways.count_documents({}):
+            return
+        await asyncio.sleep(0.1)
+    raise AssertionError('giveaways left unfinished')
+
+
+async def close(instances: list):
+    for instance in instances:
+        if instance.cog is not None:
+            instance.cog.cog_unload()
+        await instance.bot.close()
+
+
+def test_one_announcement_per_giveaway(loop):
+    async def run():
+        client, reactions = MemoryClient(), {}
+        instances = [Instance(client, reactions, name) for name in ('a', 'b', 'c')]
+        guilds = await store_giveaways(instances[0].bot, 20, 2)
+        storage = instances[1].bot.storage
+        try:
+            for instance in instances:
+                await instance.start()
+            # Dies while holding the leases of the giveaways it claimed, they have to expire first
+            await asyncio.sleep(0.5)
+            instances[0].kill()
+            await wait_until_finished(instances[1].bot)
+            for instance in instances[1:]:
+                await instance.bot.writer.flush()
+            archived = [await storage.find_archived(guildID, messageID) for messageID, guildID in guilds.items()]
+        finally:
+            await close(instances)
+
+        assert Counter(m for instance in instances for m in instance.announced) == Counter(list(guilds))
+        assert all(a is not None and len(a['winners']) == 1 for a in archived)
+
+    loop.run_until_complete(run())
+
+
+def test_announced_giveaway_closed_by_new_owner(loop):
+    async def run():
+        client, reactions = MemoryClient(), {}
+        dead, alive = Instance(client, reactions, 'a'), Instance(client, reactions, 'b')
+        guilds = await store_giveaways(dead.bot, 1, 1)
+        ids = list(guilds)
+        try:
+            await dead.start()
+
+            async def crash(giveaway, selection):
+                # Dies after announcing the winners, before marking the message as ended
+                dead.kill()
+                raise asyncio.CancelledError
+            dead.cog.close_giveaway = crash
+            while not dead.announced:
+                await asyncio.sleep(0.05)
+
+            await alive.start()
+            await wait_until_finished(alive.bot)
+            await alive.bot.writer.flush()
+            archived = await alive.bot.storage.find_archived(guilds[ids[0]], ids[0])
+        finally:
+            await close([dead, alive])
+
+        assert dead.announced == ids and alive.announced == []
+        assert alive.edited == ids
+        assert archived is not None and len(archived['winners']) == 1
+
+    loop.run_until_complete(run())
@@ -0,0 +1,235 @@
+"""
+Every storage backend must behave the same, the checks run against the in-memory database and a temporary
+SQLite file, and against a real MongoDB server in a throwaway database if `TEST_MONGO_URI` is set
+"""
+from datetime import datetime, timedelta
+import asyncio
+import os
+import uuid
+
+import pytest
+
+from cogs.utils.configs import GuildConfigCache
+from cogs.utils.database import Database
+from cogs.utils.metrics import Registry
+from cogs.utils.persistence import WriteBehindQueue
+from cogs.utils.selection import pack_ids, unpack_ids
+from cogs.utils.sqlite import SQLiteStorage
+from cogs.utils.storage import MongoStorage
+
+GUILD = 1 << 32
+CHECKS = []
+
+
+def check(func):
+    CHECKS.append(func)
+    return func
+
+
+def giveaway(messageID: int, entrants=(), **fields) -> dict:
+    data = {
+        'messageID': messageID, 'guildID': GUILD, 'channelID': GUILD + 1, 'authorID': 1,
+        'title': 'Nitro', 'endsat': datetime(2030, 1, 1, 12, 30), 'winners': 1, 'entrants': list(entrants)
+    }
+    data.update(fields)
+    return data
+
+
+def archived(messageID: int, endedat: datetime, winners=(), eligible=()) -> dict:
+    return {
+        'messageID': messageID, 'guildID': GUILD, 'channelID': GUILD + 1, 'title': 'Nitro',
+        'endedat': endedat, 'winners': list(winners), 'eligible': pack_ids(eligible)
+    }
+
+
+async def giveaways(storage) -> dict:
+    return {data['messageID']: data async for data in storage.iter_giveaways()}
+
+
+def expect(actual, expected, what: str):
+    if actual != expected:
+        raise AssertionError(f'{what}: expected {expected!r}, got {actual!r}')
+
+
+@check
+async def giveaway_round_trip(storage, writer):
+    data = giveaway(1, [5, 3])
+    await storage.insert_giveaway(data)
+    stored = (await giveaways(storage))[1]
+    expect({k: v for k, v in stored.items() if k != 'entrants'}, {k: v for k, v in data.items() if k != 'entrants'}, 'giveaway')
+    expect(sorted(stored['entrants']), [3, 5], 'entrants')
+
+    await storage.delete_giveaway(1)
+    expect(await giveaways(storage), {}, 'giveaways after delete')
+
+
+@check
+async def giveaways_by_guild(storage, writer):
+    await storage.insert_giveaway(giveaway(1, [4]))
+    await storage.insert_giveaway(giveaway(2, [5], guildID=GUILD + 2))
+    # Stored before guildID was
+    legacy = giveaway(3, [6])
+    del legacy['guildID']
+    await storage.insert_giveaway(legacy)
+
+    stored = {data['messageID']: data async for data in storage.iter_giveaways([GUILD, GUILD + 5])}
+    expect(sorted(stored), [1, 3], 'giveaways of the guilds')
+    expect([stored[1]['entrants'], stored[3]['entrants']], [[4], [6]], 'entrants')
+    expect(sorted([data['messageID'] async for data in storage.iter_giveaways([])]), [3], 'giveaways of no guild')
+
+
+@check
+async def queued_entrant_updates(storage, writer):
+    writer.insert('giveaways', giveaway(1, [1]))
+    writer.update('giveaways', {'messageID': 1}, {'$addToSet': {'entrants': {'$each': [2, 3, 1]}}})
+    writer.update('giveaways', {'messageID': 1}, {'$pull': {'entrants': {'$in': [3]}}})
+    writer.update('giveaways', {'messageID': 1}, {'$set': {'guildID': GUILD + 2}})
+    # Like an update of a missing document, nothing is created
+    writer.update('giveaways', {'messageID': 2}, {'$addToSet': {'entrants': {'$each': [1]}}})
+    await writer.flush()
+
+    stored = await giveaways(storage)
+    expect(list(stored), [1], 'giveaways')
+    expect(sorted(stored[1]['entrants']), [1, 2], 'entrants')
+    expect(stored[1]['guildID'], GUILD + 2, 'guildID')
+
+    writer.update('giveaways', {'messageID': 1}, {'$set': {'entrants': [7]}})
+    await writer.flush()
+    expect((await giveaways(storage))[1]['entrants'], [7], 'entrants after $set')
+
+
+@check
+async def queued_finish(storage, writer):
+    await storage.insert_giveaway(giveaway(1, [1, 2]))
+    writer.insert('archive', archived(1, datetime.utcnow(), [2], [1, 2]))
+    writer.delete('giveaways', {'messageID': 1})
+    await writer.flush()
+
+    expect(await giveaways(storage), {}, 'giveaways')
+    found = await storage.find_archived(GUILD, 1)
+    expect((found['winners'], unpack_ids(found['eligible'])), ([2], [1, 2]), 'archived giveaway')
+
+
+@check
+async def rejected_writes_are_dropped(storage, writer):
+    await storage.insert_giveaway(giveaway(1))
+    writer.insert('giveaways', giveaway(1, title='Duplicate'))
+    await writer.flush()
+
+    expect(len(writer), 0, 'pending writes')
+    expect((await giveaways(storage))[1]['title'], 'Nitro', 'title')
+
+
+@check
+async def writes_after_a_rejected_one(storage, writer):
+    await storage.insert_giveaway(giveaway(1))
+    await storage.insert_giveaway(giveaway(2))
+    writer.insert('giveaways', giveaway(1, title='Duplicate'))
+    writer.delete('giveaways', {'messageID': 2})
+    writer.insert('giveaways', giveaway(3))
+    await writer.flush()
+
+    expect(len(writer), 0, 'pending writes')
+    expect(sorted(await giveaways(storage)), [1, 3], 'giveaways')
+    expect((await giveaways(storage))[1]['title'], 'Nitro', 'title')
+
+
+@check
+async def configs(storage, writer):
+    expect(await storage.get_config(GUILD), {}, 'missing config')
+    await storage.update_config(GUILD, {'prefix': '?'})
+    await storage.update_config(GUILD, {'giveawayrole': 42})
+    await storage.update_config(GUILD + 1, {'prefix': '!'})
+    expect(await storage.get_config(GUILD), {'prefix': '?', 'giveawayrole': 42}, 'config')
+
+    stored = {c['guild']: c async for c in storage.iter_configs()}
+    expect(stored, {GUILD: {'guild': GUILD, 'prefix': '?', 'giveawayrole': 42}, GUILD + 1: {'guild': GUILD + 1, 'prefix': '!'}}, 'configs')
+
+    cache = GuildConfigCache(storage)
+    expect(await cache.warm(), 2, 'warmed configs')
+    expect(cache.peek(GUILD + 1), {'prefix': '!'}, 'cached config')
+
+
+@check
+async def archive_lookup(storage, writer):
+    now = datetime.utcnow()
+    writer.insert('archive', archived(1, now - timedelta(hours=2)))
+    writer.insert('archive', archived(2, now - timedelta(hours=1), eligible=[4]))
+    writer.insert('archive', archived(3, now - timedelta(days=30)))
+    await writer.flush()
+
+    expect((await storage.find_archived(GUILD))['messageID'], 2, 'last ended giveaway')
+    expect((await storage.find_archived(GUILD, 1))['messageID'], 1, 'ended giveaway by message')
+    expect(await storage.find_archived(GUILD + 5), None, 'giveaway of another guild')
+    expect(await storage.find_archived(GUILD, 3), None, 'expired giveaway')
+
+    await storage.add_archived_winner(2, 4)
+    await storage.add_archived_winner(2, 4)
+    expect((await storage.find_archived(GUILD, 2))['winners'], [4], 'rerolled winners')
+
+
+@check
+async def changes(storage, writer):
+    stream = storage.watch()
+    if stream is None:
+        return # Only used by a single process
+
+    async def collect(stream, count: int) -> list:
+        changes = []
+        async for change in stream:
+            changes.append(change)
+            if len(changes) == count:
+                return changes
+
+    async with stream:
+        await storage.update_config(GUILD, {'prefix': '?'})
+        await storage.insert_giveaway(giveaway(1))
+        # Entrant updates are not watched
+        writer.update('giveaways', {'messageID': 1}, {'$addToSet': {'entrants': {'$each': [2]}}})
+        await writer.flush()
+        writer.delete('giveaways', {'messageID': 1})
+        await writer.flush()
+        await storage.update_config(GUILD, {'giveawayrole': 42})
+        changes = await asyncio.wait_for(collect(stream, 4), 10)
+
+    expect([(c.collection, c.operation, c.key, c.document) for c in changes], [
+        ('guilds', 'insert', GUILD, {'prefix': '?'}),
+        ('giveaways', 'insert', 1, giveaway(1)),
+        ('giveaways', 'delete', 1, None),
+        ('guilds', 'update', GUILD, {'prefix': '?', 'giveawayrole': 42})
+    ], 'changes')
+
+    async with storage.watch(changes[1].token) as stream:
+        resumed = await asyncio.wait_for(collect(stream, 2), 10)
+    expect([c.key for c in resumed], [1, GUILD], 'resumed changes')
+
+
+@check
+async def explain(storage, writer):
+    results = await storage.explain()
+    expect(all({'query', 'plan', 'ms'} <= set(r) for r in results), True, 'explain results')
+
+
+BACKENDS = ['memory', 'sqlite'] + (['mongo'] if os.environ.get('TEST_MONGO_URI') else [])
+
+
+@pytest.fixture(params=BACKENDS)
+def storage(request, loop, tmp_path):
+    "An empty storage of each backend"
+    if request.param == 'memory':
+        storage = MongoStorage(Database('memory://', Registry(), loop))
+    elif request.param == 'sqlite':
+        storage = SQLiteStorage(str(tmp_path / 'giveaways.db'))
+    else:
+        storage = MongoStorage(Database(os.environ['TEST_MONGO_URI'], Registry(), loop, name=f'tests_{uuid.uuid4().hex[:8]}'))
+
+    loop.run_until_complete(storage.setup())
+    yield storage
+    if request.param == 'mongo':
+        loop.run_until_complete(storage.database.client.drop_database(storage.database.db.name))
+    loop.run_until_complete(storage.close())
+
+
+@pytest.mark.parametrize('check', CHECKS, ids=lambda check: check.__name__)
+def test_storage(check, storage, loop):
+    loop.run_until_complete(check(storage, WriteBehindQueue(storage)))